@@ -37,6 +37,7 @@ class BaseConfig(object):
         args.result_root = os.path.join(args.DATA_ROOT, 'results/')
         args.tfrecords_root = os.path.join(args.DATA_ROOT, 'tfrecords2/')   # event-based
 #        args.tfrecords_root = os.path.join(args.DATA_ROOT, 'tfrecords/')   # session-based
+        args.event_store_root = os.path.join(args.DATA_ROOT, 'event_store/')   # event-based, see preprocess/event_store.py
 
         # for multimodal input
         args.feat = args.feat.split(',')
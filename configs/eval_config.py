@@ -56,4 +56,13 @@ class EvalConfig(BaseConfig):
                 help='Whether to reverse input sequence')
         self.parser.set_defaults(reverse=False)
 
-
+        self.parser.add_argument('--embed_split', type=str, default='test',
+                help='sessions embedded by embed.py, comma separated: train | val | test | all')
+        self.parser.add_argument('--eval_batch_size', type=int, default=256,
+                help='number of events per inference batch, events of consecutive sessions are packed together')
+        self.parser.add_argument('--emb_dtype', type=str, default='float32',
+                help='dtype of embeddings in the embedding store: float32 | float16')
+        self.parser.add_argument('--use_frozen', action="store_true",
+                help='Embed with the frozen graph of model_path (export_graph.py) instead of rebuilding the model')
+        self.parser.add_argument('--recompute_embedding', action="store_true",
+                help='Recompute embeddings even if they are in the embedding store')
@@ -43,7 +43,11 @@ class TrainConfig(BaseConfig):
                 help='training task: supervised | semi-supervised | zero-shot')
 
         self.parser.add_argument('--num_threads', type=int, default=2,
-                       help='number of threads for loading data in parallel')
+                       help='number of worker processes for loading data in parallel')
+        self.parser.add_argument('--prefetch', type=int, default=1,
+                       help='number of session batches prefetched while training')
+        self.parser.add_argument('--event_format', type=str, default='tfrecords',
+                       help='source of training events for event-based models: tfrecords | store (event store built by preprocess/tfrecords_to_store.py)')
         self.parser.add_argument('--batch_size', type=int, default=4,
                        help='Training batch size')
         self.parser.add_argument('--max_epochs', type=int, default=5,
@@ -72,6 +76,8 @@ class TrainConfig(BaseConfig):
                 help='methods for triplet selection: random | facenet |')
         self.parser.add_argument('--multimodal_select', type=str, default='random',
                 help='methods for multimodal selection: random | confidence |')
+        self.parser.add_argument('--pair_sim', type=str, default='cached',
+                help='how to compute multimodal similarity of all pairs: cached (embed each event once) | pairs (feed every pair to the encoders)')
         self.parser.add_argument('--alpha', type=float, default=0.2,
                        help='margin for triplet loss')
         self.parser.add_argument('--lambda_l2', type=float, default=0.0,
@@ -94,6 +100,9 @@ class TrainConfig(BaseConfig):
         self.parser.add_argument('--optimizer', type=str, default='ADAM',
                 help='optimizer: ADAM | RMSPROP | MOMEMTUM | ADADELTA | SGD | ADAGRAD')
 
+        self.parser.add_argument('--summary_steps', type=int, default=1,
+                       help='compute monitoring summaries (e.g. embedding_dists histogram) every summary_steps steps')
+
         self.parser.add_argument('--gpu', type=str, default=0,
                 help='Set CUDA_VISIBLE_DEVICES')
         self.parser.add_argument('--label_type', type=str, default='goal',
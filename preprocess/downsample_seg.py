@@ -1,9 +1,15 @@
+# Downsample semantic segmentation by 5x5 max-pooling followed by softmax
+#
+# The segmentation file is memory-mapped and processed in chunks of frames,
+# written into a preallocated memory-mapped output, so memory does not depend
+# on the session length.
+
 import glob
 import os
-import pdb
+import time
+import argparse
 import numpy as np
-import copy
-from skimage import measure
+from multiprocessing import Pool
 
 
 def softmax(x):    # important to do in-place for large array
@@ -20,34 +26,89 @@ def softmax(x):    # important to do in-place for large array
 seg_root = '/mnt/data/honda_100h_archive/semantic_segmentation/'
 feat_root = '/mnt/work/honda_100h/features/'
 
-L = 3    # number of pyramid levels
+POOL = 5    # max-pooling size
+
+def max_pool(seg, size):
+    """
+    Max-pooling over size x size spatial blocks, same as
+    skimage.measure.block_reduce(seg, (1,size,size,1), np.max)
+    (incomplete blocks at the border are padded with 0)
+
+    seg -- [n, H, W, D]
+    """
+
+    n, H, W, D = seg.shape
+    H_out = -(-H // size)
+    W_out = -(-W // size)
+    H_full = H // size * size
+    W_full = W // size * size
+
+    out = np.zeros((n, H_out, W_out, D), dtype=seg.dtype)
+    # complete blocks, rows then columns: each step only splits one axis of a
+    # slice, so it reduces a view of the input, not a copy of the chunk
+    rows = seg[:, :H_full].reshape(n, H//size, size, W, D).max(axis=2)
+    out[:, :H//size, :W//size] = rows[:, :, :W_full].reshape(n, H//size, W//size, size, D).max(axis=3)
+
+    # incomplete blocks, max with the zero padding
+    if H_full < H:
+        bottom = seg[:, H_full:, :W_full].reshape(n, H-H_full, W//size, size, D).max(axis=(1,3))
+        out[:, -1, :W//size] = np.maximum(bottom, 0)
+    if W_full < W:
+        right = seg[:, :H_full, W_full:].reshape(n, H//size, size, W-W_full, D).max(axis=(2,3))
+        out[:, :H//size, -1] = np.maximum(right, 0)
+    if H_full < H and W_full < W:
+        out[:, -1, -1] = np.maximum(seg[:, H_full:, W_full:].max(axis=(1,2)), 0)
 
-files = glob.glob(seg_root+'*.npy')
-for i, f in enumerate(files):
-    session_id = os.path.basename(f).replace('_seg.npy',"")
-    
-    output_name = os.path.basename(f).replace('.npy', '_down.npy')
-    print (i, '/', len(files)-1, ":", output_name)
-    if os.path.isfile(feat_root+output_name):
-        continue
+    return out
 
-    seg = np.load(f)
+def process_session(job):
+    """
+    Downsample one session, chunk by chunk
+
+    job -- (path of segmentation, output path, chunk size)
+    """
+
+    f, output_path, chunk_size = job
+    start_time = time.time()
+
+    seg = np.load(f, mmap_mode='r')
     N, H, W, D = seg.shape
-    print ("Original: ", N, H, W, D)
 
-    # for memory concern
-    feat1 = measure.block_reduce(seg[:N//2], (1,5,5,1), np.max)
-    seg = seg[N//2:]
-    feat2 = measure.block_reduce(seg, (1,5,5,1), np.max)
+    tmp_path = output_path + '.tmp{}.npy'.format(os.getpid())
+    feat = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=seg.dtype,
+                    shape=(N, -(-H // POOL), -(-W // POOL), D))
+    for start in range(0, N, chunk_size):
+        end = min(start+chunk_size, N)
+        feat[start:end] = softmax(max_pool(seg[start:end], POOL))
+    feat.flush()
+    shape = feat.shape
+    del feat
+    os.rename(tmp_path, output_path)
+
+    return output_path, (N, H, W, D), shape, time.time()-start_time
+
+def main():
 
-    del seg
-    feat = np.concatenate((feat1,feat2), axis=0)
-    del feat1
-    del feat2
-    N, H, W, D = feat.shape
-    print ("Downsampled: ", N, H, W, D)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', type=int, default=4,
+            help='number of sessions processed in parallel')
+    parser.add_argument('--chunk_size', type=int, default=64,
+            help='number of frames processed together')
+    args = parser.parse_args()
 
-    feat = softmax(feat)
+    jobs = []
+    for f in sorted(glob.glob(seg_root+'*.npy')):
+        output_name = os.path.basename(f).replace('.npy', '_down.npy')
+        if os.path.isfile(feat_root+output_name):
+            continue
+        jobs.append((f, feat_root+output_name, args.chunk_size))
 
-    np.save(feat_root+output_name, feat)
+    pool = Pool(args.num_workers)
+    for i, (output_path, original, downsampled, seconds) in enumerate(pool.imap_unordered(process_session, jobs)):
+        print (i+1, '/', len(jobs), ":", os.path.basename(output_path))
+        print ("Original: ", original, "Downsampled: ", downsampled, "%.1f s" % seconds)
+    pool.close()
+    pool.join()
 
+if __name__ == "__main__":
+    main()
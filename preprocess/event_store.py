@@ -0,0 +1,161 @@
+"""
+Columnar event store
+
+Replaces the per-event tfrecords (one SequenceExample per event, one FloatList
+per frame) by one flat binary file per session per modality. The frames of all
+events of a session are stored back to back with a fixed dtype, so any event is
+a memory-mapped slice without deserialization.
+
+Layout of store_root/:
+    <session_id>_<name>.bin -- frames of all events for modality name, [total_frames]+shape
+    <session_id>_index.pkl -- {'index': INDEX_DTYPE array, 'shapes': {name: shape},
+                               'dtypes': {name: dtype}}
+The pkl is written last, so a session is complete iff its pkl exists.
+"""
+
+import os
+import glob
+import pickle as pkl
+import numpy as np
+
+INDEX_DTYPE = np.dtype([('event_id', 'int32'),
+                        ('label', 'int32'),
+                        ('start', 'int64'),    # first frame of the event in the .bin files
+                        ('length', 'int32'),
+                        ('session_id', 'U16')])
+
+# per-process caches, opened lazily by the readers
+_META = {}
+_MEMMAPS = {}
+
+def store_paths(store_root, session_id, names):
+    """
+    Return the index path and the dictionary of data paths of one session
+    """
+
+    index_path = os.path.join(store_root, session_id+'_index.pkl')
+    data_paths = {name: os.path.join(store_root, '{}_{}.bin'.format(session_id, name)) for name in names}
+    return index_path, data_paths
+
+def write_session(store_root, session_id, events, dtype='float32'):
+    """
+    Write one session to the event store, frames are appended as they come
+    so the session is never held in memory
+
+    store_root -- folder of the event store
+    session_id -- session id
+    events -- iterable of (event_id, label, {name: frames [length, ...]})
+    dtype -- dtype of stored frames
+
+    return the index of the session
+    """
+
+    index = []
+    shapes = {}
+    fouts = {}
+    tmp_paths = {}
+    start = 0
+    try:
+        for event_id, label, feats in events:
+            length = None
+            for name, frames in feats.items():
+                if name not in fouts:
+                    _, data_paths = store_paths(store_root, session_id, [name])
+                    tmp_paths[name] = '{}.tmp{}'.format(data_paths[name], os.getpid())
+                    fouts[name] = open(tmp_paths[name], 'wb')
+                    shapes[name] = tuple(frames.shape[1:])
+                if tuple(frames.shape[1:]) != shapes[name]:
+                    raise ValueError("Inconsistent frame shape of {} in session {}".format(name, session_id))
+                if length is not None and frames.shape[0] != length:
+                    raise ValueError("Modalities have different lengths in session {}".format(session_id))
+                length = frames.shape[0]
+                np.ascontiguousarray(frames, dtype=dtype).tofile(fouts[name])
+            index.append((event_id, label, start, length, session_id))
+            start += length
+    except:
+        for name in fouts:
+            fouts[name].close()
+            os.remove(tmp_paths[name])
+        raise
+
+    index_path, data_paths = store_paths(store_root, session_id, fouts.keys())
+    for name in fouts:
+        fouts[name].close()
+        os.rename(tmp_paths[name], data_paths[name])
+
+    meta = {'index': np.array(index, dtype=INDEX_DTYPE),
+            'shapes': shapes,
+            'dtypes': {name: np.dtype(dtype).str for name in shapes}}
+    tmp_path = '{}.tmp{}'.format(index_path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        pkl.dump(meta, fout)
+    os.rename(tmp_path, index_path)
+
+    return meta['index']
+
+def list_sessions(store_root):
+    """
+    Session ids of all complete sessions in the store
+    """
+
+    return sorted([os.path.basename(p)[:-len('_index.pkl')] for p in glob.glob(os.path.join(store_root, '*_index.pkl'))])
+
+def load_session_meta(store_root, session_id):
+    """
+    Metadata of one session (cached)
+    """
+
+    key = (store_root, session_id)
+    if key not in _META:
+        index_path, _ = store_paths(store_root, session_id, [])
+        with open(index_path, 'rb') as fin:
+            _META[key] = pkl.load(fin)
+    return _META[key]
+
+def load_index(store_root, sessions=None):
+    """
+    Concatenated event index of the given sessions (all sessions if None)
+
+    sessions that are not in the store are skipped
+    """
+
+    if sessions is None:
+        sessions = list_sessions(store_root)
+    index = [load_session_meta(store_root, session_id)['index'] for session_id in sessions
+                if os.path.isfile(store_paths(store_root, session_id, [])[0])]
+    if len(index) == 0:
+        return np.zeros((0,), dtype=INDEX_DTYPE)
+    return np.concatenate(index)
+
+def open_modality(store_root, session_id, name):
+    """
+    Read-only memmap of all frames of one session for modality name (cached)
+    """
+
+    key = (store_root, session_id, name)
+    if key not in _MEMMAPS:
+        meta = load_session_meta(store_root, session_id)
+        _, data_paths = store_paths(store_root, session_id, [name])
+        dtype = np.dtype(meta['dtypes'][name])
+        shape = meta['shapes'][name]
+        total = os.path.getsize(data_paths[name]) // (dtype.itemsize * int(np.prod(shape)))
+        _MEMMAPS[key] = np.memmap(data_paths[name], dtype=dtype, mode='r', shape=(total,)+shape)
+    return _MEMMAPS[key]
+
+def read_event(store_root, entry, name):
+    """
+    Frames of one event, a view into the memmap
+
+    entry -- one row of the index
+    """
+
+    frames = open_modality(store_root, str(entry['session_id']), name)
+    start = int(entry['start'])
+    return frames[start : start+int(entry['length'])]
+
+def event_key(entry):
+    """
+    Key of one event, same as the basename of its tfrecords file
+    """
+
+    return '{}_{}'.format(entry['session_id'], entry['event_id'])
@@ -1,16 +1,19 @@
 # Extract spatial pyramid features of semantic segmentation
 # Reference: Semantic segmentation as image representation for scene recognition
+#
+# The segmentation file is memory-mapped and processed in chunks of frames,
+# so a session is never loaded as a whole. Within a chunk, the pixels are
+# summed once into the cells of the finest grid of bin boundaries, and the
+# bins of all pyramid levels are read from the summed-area table of that grid.
 
 import glob
 import os
-import pdb
+import time
+import argparse
 import numpy as np
-import copy
+from multiprocessing import Pool
 
 
-with open('/mnt/work/honda_100h/test_session.txt', 'r') as fin:
-    session_ids = fin.read().strip().split('\n')
-
 def softmax(x):    # important to do in-place for large array
     #return np.exp(x-np.max(x,axis=-1,keepdims=True)) / \
     #        np.sum(np.exp(x-np.max(x,axis=-1,keepdims=True)),axis=-1,keepdims=True)
@@ -27,40 +30,108 @@ feat_root = '/mnt/work/honda_100h/features/'
 
 L = 3    # number of pyramid levels
 
-files = glob.glob(seg_root+'*.npy')
-for i, f in enumerate(files):
-    session_id = os.path.basename(f).replace('_seg.npy',"")
-    if not session_id in session_ids:
-        continue
-    
-    output_name = os.path.basename(f).replace('.npy', '_sp.npy')
-    print (i, '/', len(files)-1, ":", output_name)
-    if os.path.isfile(feat_root+output_name):
-        continue
-
-    seg = np.load(f)
-    N, H, W, D = seg.shape
-    print (N)
-    seg = softmax(seg)
+def pyramid_bins(H, W, L):
+    """
+    Boundaries of the bins of all levels, [(y0, y1, x0, x1)], ordered by level then row-major
+    """
 
-    print ('here')
-    feat = []
-    # for each level
+    bins = []
     for l in range(L):
         h_size = H // (2**l)
         w_size = W // (2**l)
-        # for each bin
         for i in range(2**l):
             for j in range(2**l):
-                region = copy.copy(seg[:, i*h_size:(i+1)*h_size, j*w_size:(j+1)*w_size, :])
-                # get histogram (soft) within a bin
-                feat.append(np.mean(region, axis=(1,2)))
-                del region
+                bins.append((i*h_size, (i+1)*h_size, j*w_size, (j+1)*w_size))
+    return bins
+
+def spatial_pyramid(seg, bins):
+    """
+    Soft histograms of all bins for a chunk of frames
+
+    seg -- softmax scores, [n, H, W, D]
+    bins -- output of pyramid_bins
+    return [n, len(bins)*D]
+    """
+
+    ys = np.unique([b[0] for b in bins] + [b[1] for b in bins])
+    xs = np.unique([b[2] for b in bins] + [b[3] for b in bins])
 
-    del seg
-    print ('here')
+    # sum pixels into the cells between consecutive boundaries (one pass over the chunk)
+    cells = np.add.reduceat(seg[:, :ys[-1]], ys[:-1], axis=1, dtype='float64')
+    cells = np.add.reduceat(cells[:, :, :xs[-1]], xs[:-1], axis=2)
+
+    # summed-area table over the cell grid, sat[:, a, b] = sum of pixels above ys[a] and left of xs[b]
+    sat = np.zeros((seg.shape[0], len(ys), len(xs), seg.shape[-1]), dtype='float64')
+    sat[:, 1:, 1:] = np.cumsum(np.cumsum(cells, axis=1), axis=2)
+
+    feat = []
+    for y0, y1, x0, x1 in bins:
+        a0, a1 = np.searchsorted(ys, [y0, y1])
+        b0, b1 = np.searchsorted(xs, [x0, x1])
+        total = sat[:, a1, b1] - sat[:, a0, b1] - sat[:, a1, b0] + sat[:, a0, b0]
+        # get histogram (soft) within a bin
+        feat.append(total / ((y1-y0) * (x1-x0)))
 
     # concatenate features of different levels and bins
-    feat = np.concatenate(feat, axis=1)
-    np.save(feat_root+output_name, feat)
+    return np.concatenate(feat, axis=1)
+
+def process_session(job):
+    """
+    Extract spatial pyramid features of one session, chunk by chunk
+
+    job -- (path of segmentation, output path, chunk size)
+    """
+
+    f, output_path, chunk_size = job
+    start_time = time.time()
+
+    seg = np.load(f, mmap_mode='r')
+    N, H, W, D = seg.shape
+    bins = pyramid_bins(H, W, L)
+
+    tmp_path = output_path + '.tmp{}.npy'.format(os.getpid())
+    feat = np.lib.format.open_memmap(tmp_path, mode='w+',
+                    dtype=np.result_type(seg.dtype, np.float32), shape=(N, len(bins)*D))
+    for start in range(0, N, chunk_size):
+        end = min(start+chunk_size, N)
+        chunk = softmax(np.array(seg[start:end], dtype=feat.dtype))
+        feat[start:end] = spatial_pyramid(chunk, bins)
+    feat.flush()
+    del feat
+    os.rename(tmp_path, output_path)
+
+    return output_path, N, time.time()-start_time
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--session_file', type=str, default='/mnt/work/honda_100h/test_session.txt',
+            help='list of sessions to process')
+    parser.add_argument('--num_workers', type=int, default=4,
+            help='number of sessions processed in parallel')
+    parser.add_argument('--chunk_size', type=int, default=64,
+            help='number of frames processed together')
+    args = parser.parse_args()
+
+    with open(args.session_file, 'r') as fin:
+        session_ids = fin.read().strip().split('\n')
+
+    jobs = []
+    for f in sorted(glob.glob(seg_root+'*.npy')):
+        session_id = os.path.basename(f).replace('_seg.npy',"")
+        if not session_id in session_ids:
+            continue
+
+        output_name = os.path.basename(f).replace('.npy', '_sp.npy')
+        if os.path.isfile(feat_root+output_name):
+            continue
+        jobs.append((f, feat_root+output_name, args.chunk_size))
+
+    pool = Pool(args.num_workers)
+    for i, (output_path, N, seconds) in enumerate(pool.imap_unordered(process_session, jobs)):
+        print (i+1, '/', len(jobs), ":", os.path.basename(output_path), "%d frames, %.1f s" % (N, seconds))
+    pool.close()
+    pool.join()
 
+if __name__ == "__main__":
+    main()
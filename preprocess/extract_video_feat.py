@@ -0,0 +1,78 @@
+"""
+    Extract resnet features straight from the session videos
+
+    Frames are decoded by ffmpeg at sample_rate (see get_frames.py) and fed to
+    inception_resnet_v2 in batches, without writing jpg frames to disk.
+    Features of the last conv layer ([8, 8, 1536] per frame) are written to
+    feature_root/<session_id>.npy, the layout used by data_io.prepare_dataset.
+    Sessions with existing features are skipped.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append('../')
+from get_frames import data_root, video_path, expected_frames, read_frames, sample_rate
+from feat_extract_pipeline import load_model, run_batches
+from configs.base_config import load_session_list
+
+feature_root = '/mnt/work/honda_100h/features/'
+
+slim_dir = "/home/xyang/workspace/models/research/slim"
+checkpoints_dir = slim_dir + "/pretrain"
+checkpoints_file = checkpoints_dir + '/inception_resnet_v2_2016_08_30.ckpt'
+
+def build_model(input_batch):
+    sys.path.append(slim_dir)
+    from nets import inception
+    import tensorflow as tf
+    slim = tf.contrib.slim
+    image_size = inception.inception_resnet_v2.default_image_size
+
+    resized_images = tf.image.resize_images(
+        tf.image.convert_image_dtype(input_batch, dtype=tf.float32),
+        [image_size, image_size]
+        )
+    preprocessed_images = tf.multiply(tf.subtract(resized_images, 0.5), 2.0)
+
+    # Create the model, use the default arg scope to configure
+    # the batch norm parameters.
+    with slim.arg_scope(inception.inception_resnet_v2_arg_scope()):
+        logits, endpoints = inception.inception_resnet_v2(preprocessed_images,
+                                                          is_training=False)
+    return [endpoints['Conv2d_7b_1x1']]
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--session_file', type=str, default='all_session.txt',
+            help='session list in DATA_ROOT, e.g. all_session.txt, train_session.txt')
+    parser.add_argument('--batch_size', type=int, default=256,
+            help='number of frames per batch')
+    parser.add_argument('--width', type=int, default=300,
+            help='width of decoded frames')
+    parser.add_argument('--height', type=int, default=300,
+            help='height of decoded frames')
+    args = parser.parse_args()
+
+    size = (args.width, args.height)
+    sessions = load_session_list(os.path.join(data_root, args.session_file))
+    sessions = [s for s in sessions if not os.path.isfile(feature_root+s+'.npy')]
+    print ("{} sessions to extract".format(len(sessions)))
+
+    model = load_model(build_model, checkpoints_file, size)
+    for i, session_id in enumerate(sessions):
+        start_time = time.time()
+        video_filename = video_path(session_id)
+        # upper bound, the output is shrunk to the decoded frames
+        capacity = expected_frames(video_filename) + 2*sample_rate
+        feat, = run_batches(model, read_frames(video_filename, size, args.batch_size),
+                            capacity, [feature_root+session_id+'.npy'], video_filename)
+        print ("{} / {}: {}, {} frames, {:.1f} s".format(i+1, len(sessions), session_id,
+                    feat.shape[0], time.time()-start_time))
+    model[0].close()
+
+if __name__ == "__main__":
+    main()
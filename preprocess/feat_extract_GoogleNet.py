@@ -4,11 +4,13 @@ import numpy as np
 import sys
 import os
 import pdb
-from PIL import Image
+from feat_extract_pipeline import extract_feat as extract_feat_pipeline
 #import gensim
 
-def extract_feat(frames_name):
+def extract_feat(frames_name, output_path=None):
     """
+    output_path -- if given, features are written to this .npy file as they are produced
+
     Reference:
         1. Vasili's codes
         2. https://github.com/tensorflow/models/issues/429#issuecomment-277885861
@@ -25,16 +27,13 @@ def extract_feat(frames_name):
     slim = tf.contrib.slim
     image_size = inception.inception_v1.default_image_size
 
-    feat = []
-    with tf.Graph().as_default():
-        input_batch = tf.placeholder(dtype=tf.uint8,
-                                     shape=(batch_size, 300, 300, 3))
+    def build_model(input_batch):
         resized_images = tf.image.resize_images(
             tf.image.convert_image_dtype(input_batch, dtype=tf.float32),
             [image_size, image_size]
             )
         preprocessed_images = tf.multiply(tf.subtract(resized_images, 0.5), 2.0)
-        
+
         # Create the model, use the default arg scope to configure
         # the batch norm parameters.
         with slim.arg_scope(inception.inception_v1_arg_scope()):
@@ -42,26 +41,13 @@ def extract_feat(frames_name):
                                                         num_classes=1001,
                                                         is_training=False)
         pool5 = endpoints['AvgPool_0a_7x7']
+        # squeeze spatial dimensions only, batches can have a single image
+        return [tf.squeeze(pool5, axis=[1,2])]
 
-        with tf.Session() as sess:
-            saver = tf.train.Saver()
-            saver.restore(sess, checkpoints_file)
-
-            for i in range(0, len(frames_name), batch_size):
-                print (i, '/', len(frames_name))
-                current_batch = np.zeros((batch_size, 300, 300, 3), dtype=np.uint8)
-                for j in range(batch_size):
-                    if i+j == len(frames_name):
-                        j -= 1
-                        break
-                    img = Image.open(frames_name[i+j]).convert('RGB').resize((300,300))
-                    current_batch[j] = np.array(img)
-
-                feat_batch = sess.run(pool5, feed_dict={input_batch: current_batch})
-                feat_batch = np.squeeze(feat_batch)
-                feat.append(feat_batch[:j+1].astype('float32'))
-
-    return np.concatenate(feat, axis=0)
+    feat, = extract_feat_pipeline(frames_name, build_model, checkpoints_file,
+                                  batch_size=batch_size, size=(300,300),
+                                  output_paths=None if output_path is None else [output_path])
+    return feat
 
 data_root = '/mnt/work/CUB_200_2011/'
 images_root = data_root+'images/'
@@ -87,10 +73,8 @@ for i in range(len(image_files)):
         test_label.append(label)
 
 
-train_feat = extract_feat(train_files)
-test_feat = extract_feat(test_files)
+train_feat = extract_feat(train_files, output_root+'feat_train.npy')
+test_feat = extract_feat(test_files, output_root+'feat_test.npy')
 
-np.save(output_root+'feat_train.npy', train_feat)
-np.save(output_root+'feat_test.npy', test_feat)
 np.save(output_root+'label_train.npy', np.asarray(train_label, dtype='int32'))
 np.save(output_root+'label_test.npy', np.asarray(test_label, dtype='int32'))
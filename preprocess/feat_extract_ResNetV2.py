@@ -4,11 +4,13 @@ import numpy as np
 import sys
 import os
 import pdb
-from PIL import Image
+from feat_extract_pipeline import extract_feat as extract_feat_pipeline
 import gensim
 
-def extract_feat(frames_name):
+def extract_feat(frames_name, output_paths=None):
     """
+    output_paths -- if given, [feats path, probs path], .npy files written as the features are produced
+
     Reference:
         1. Vasili's codes
         2. https://github.com/tensorflow/models/issues/429#issuecomment-277885861
@@ -25,18 +27,13 @@ def extract_feat(frames_name):
     slim = tf.contrib.slim
     image_size = inception.inception_resnet_v2.default_image_size
 
-    feat_conv = []
-    feat_fc = []
-    probs = []
-    with tf.Graph().as_default():
-        input_batch = tf.placeholder(dtype=tf.uint8,
-                                     shape=(batch_size, 300, 300, 3))
+    def build_model(input_batch):
         resized_images = tf.image.resize_images(
             tf.image.convert_image_dtype(input_batch, dtype=tf.float32),
             [image_size, image_size]
             )
         preprocessed_images = tf.multiply(tf.subtract(resized_images, 0.5), 2.0)
-        
+
         # Create the model, use the default arg scope to configure
         # the batch norm parameters.
         with slim.arg_scope(inception.inception_resnet_v2_arg_scope()):
@@ -45,32 +42,12 @@ def extract_feat(frames_name):
         pre_pool = endpoints['Conv2d_7b_1x1']
         pre_logits_flatten = endpoints['PreLogitsFlatten']
         probabilities = endpoints['Predictions']
+        return [pre_logits_flatten, probabilities]
+#        return [pre_pool, pre_logits_flatten, probabilities]
 
-        with tf.Session() as sess:
-            saver = tf.train.Saver()
-            saver.restore(sess, checkpoints_file)
-
-            for i in range(0, len(frames_name), batch_size):
-                print i, '/', len(frames_name)
-                current_batch = np.zeros((batch_size, 300, 300, 3), dtype=np.uint8)
-                for j in range(batch_size):
-                    if i+j == len(frames_name):
-                        j -= 1
-                        break
-                    img = Image.open(frames_name[i+j]).convert('RGB').resize((300,300))
-                    current_batch[j] = np.array(img)
-
-                temp_conv, temp_fc, prob = sess.run([pre_pool,
-                                                     pre_logits_flatten,
-                                                     probabilities],
-                                                     feed_dict={input_batch:
-                                                         current_batch})
-#                feat_conv.append(temp_conv.astype('float32'))
-                feat_fc.append(temp_fc[:j+1].astype('float32'))
-                probs.append(prob[:j+1].astype('float32'))
-
-    return np.concatenate(feat_fc, axis=0), np.concatenate(probs, axis=0)
-#    return np.concatenate(feat_conv, axis=0), np.concatenate(feat_fc, axis=0), np.concatenate(probs, axis=0)
+    feat_fc, probs = extract_feat_pipeline(frames_name, build_model, checkpoints_file,
+                                           batch_size=batch_size, size=(300,300), output_paths=output_paths)
+    return feat_fc, probs
 
 result_dir = '/mnt/work/Stanford40/results/'
 label_dir = '/mnt/work/Stanford40/ImageSplits/'
@@ -79,7 +56,7 @@ image_dir = '/mnt/work/Stanford40/JPEGImages/'
 label_files = glob.glob(label_dir+'*')
 
 word2vec = gensim.models.KeyedVectors.load_word2vec_format('/home/xyang/Downloads/GoogleNews-vectors-negative300.bin', binary=True)
-text_dict = pkl.load(open(result_dir+'label.pkl','r'))['text_dict']    # for one-hot representation
+text_dict = pkl.load(open(result_dir+'label.pkl','rb'))['text_dict']    # for one-hot representation
 
 # load training data
 train_names = []
@@ -110,10 +87,11 @@ for f in label_files:
 
 train_text = np.concatenate(train_text, axis=0)
 
-train_feats, train_probs = extract_feat(train_names)
-train_data = {'names': train_names, 'feats': train_feats, 'label':train_labels, 'probs':train_probs, 'text':train_text}
+# feats and probs are memory-mapped .npy files next to the pickle
+extract_feat(train_names, [result_dir+'train_feats.npy', result_dir+'train_probs.npy'])
+train_data = {'names': train_names, 'label':train_labels, 'text':train_text}
 
-pkl.dump(train_data, open(result_dir+'train_data.pkl', 'w'))
+pkl.dump(train_data, open(result_dir+'train_data.pkl', 'wb'))
 
 
 # load testing data
@@ -137,8 +115,8 @@ for f in label_files:
 
 test_text = np.concatenate(test_text, axis=0)
 
-test_feats, test_probs = extract_feat(test_names)
-test_data = {'names': test_names, 'feats': test_feats, 'label':test_labels, 'probs':test_probs, 'text': test_text}
+extract_feat(test_names, [result_dir+'test_feats.npy', result_dir+'test_probs.npy'])
+test_data = {'names': test_names, 'label':test_labels, 'text': test_text}
 
-pkl.dump(test_data, open(result_dir+'test_data.pkl', 'w'))
+pkl.dump(test_data, open(result_dir+'test_data.pkl', 'wb'))
 
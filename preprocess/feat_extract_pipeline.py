@@ -0,0 +1,165 @@
+"""
+Pipelined CNN feature extraction shared by feat_extract_ResNetV2.py and feat_extract_GoogleNet.py
+
+Images are decoded and resized by a pool of worker processes, which keep at
+most queue_size uint8 batches ready while the model runs on the current one.
+The input placeholder has a variable batch size, so the last batch is not
+padded, and features can be written into memory-mapped .npy files as
+batches are produced. run_batches also takes batches from other sources,
+e.g. frames decoded from the videos (extract_video_feat.py).
+"""
+
+import os
+import time
+import collections
+import numpy as np
+from PIL import Image
+from multiprocessing import Pool
+
+from get_frames import truncate_npy
+
+def decode_batch(job):
+    """
+    Decode and resize one batch of images
+
+    job -- (list of image paths, (width, height))
+    return uint8 array, [batch_size, height, width, 3]
+    """
+
+    names, size = job
+    batch = np.empty((len(names), size[1], size[0], 3), dtype=np.uint8)
+    for j, name in enumerate(names):
+        batch[j] = np.asarray(Image.open(name).convert('RGB').resize(size))
+    return batch
+
+def decoded_batches(pool, frames_name, batch_size, size=(300,300), queue_size=4):
+    """
+    Iterate over decoded batches in order, decoding ahead in the pool
+
+    pool -- multiprocessing pool of decoder workers
+    frames_name -- list of image paths
+    queue_size -- maximum number of batches decoded ahead
+    """
+
+    jobs = [(frames_name[i:i+batch_size], size) for i in range(0, len(frames_name), batch_size)]
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(decode_batch, (job,)))
+        if len(pending) >= queue_size:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def load_model(build_model, checkpoints_file, size=(300,300)):
+    """
+    Build the graph and restore the pretrained model
+
+    build_model -- function(uint8 input tensor [None, height, width, 3]) -> list of output tensors,
+                   called within the graph before restoring checkpoints_file
+    checkpoints_file -- checkpoint of the pretrained model
+
+    return (session, input placeholder, list of output tensors)
+    """
+
+    import tensorflow as tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+        input_batch = tf.placeholder(dtype=tf.uint8,
+                                     shape=(None, size[1], size[0], 3))
+        fetches = build_model(input_batch)
+
+        sess = tf.Session(graph=graph)
+        saver = tf.train.Saver()
+        saver.restore(sess, checkpoints_file)
+
+    return sess, input_batch, fetches
+
+def run_batches(model, batches, num_frames, output_paths=None, name=None):
+    """
+    Run the model over batches of uint8 images, in order
+
+    model -- output of load_model
+    batches -- iterable of uint8 arrays, [batch_size, height, width, 3]
+    num_frames -- total number of frames, or an upper bound when output_paths is given
+                  (the outputs are then shrunk to the number of frames actually produced)
+    output_paths -- optional list of .npy paths, one per output, written as memory-mapped files
+    name -- name of the input in error messages, e.g. the video path
+
+    return list of float32 arrays, one per output, [num_frames, ...]
+    """
+
+    sess, input_batch, fetches = model
+    outputs = None
+    start = 0
+    start_time = time.time()
+    try:
+        for current_batch in batches:
+            print (start, '/', num_frames)
+            results = sess.run(fetches, feed_dict={input_batch: current_batch})
+
+            if outputs is None:
+                # allocate once the output shapes are known
+                outputs = []
+                for k, res in enumerate(results):
+                    shape = (num_frames,) + res.shape[1:]
+                    if output_paths is None:
+                        outputs.append(np.empty(shape, dtype='float32'))
+                    else:
+                        outputs.append(np.lib.format.open_memmap(output_paths[k]+'.tmp{}.npy'.format(os.getpid()),
+                                            mode='w+', dtype='float32', shape=shape))
+
+            end = start + current_batch.shape[0]
+            if end > num_frames:
+                raise ValueError("More frames than num_frames{}".format('' if name is None else ' in '+name))
+            for out, res in zip(outputs, results):
+                out[start:end] = res
+            start = end
+    except:
+        # no partial outputs are left behind
+        if outputs is not None and output_paths is not None:
+            tmp_paths = [out.filename for out in outputs]
+            del outputs
+            for tmp_path in tmp_paths:
+                os.remove(tmp_path)
+        raise
+
+    print ("%d frames, %.1f frames/s" % (start, start / max(time.time()-start_time, 1e-6)))
+
+    if outputs is None:
+        raise ValueError("No frames to process{}".format('' if name is None else ' in '+name))
+    if output_paths is not None:
+        tmp_paths = []
+        for out in outputs:
+            out.flush()
+            tmp_paths.append(out.filename)
+        del outputs, out    # close the memmaps before shrinking the files
+        for tmp_path, path in zip(tmp_paths, output_paths):
+            if start < num_frames:
+                truncate_npy(tmp_path, start)
+            os.rename(tmp_path, path)
+        outputs = [np.load(path, mmap_mode='r') for path in output_paths]
+    else:
+        outputs = [out[:start] for out in outputs]
+    return outputs
+
+def extract_feat(frames_name, build_model, checkpoints_file, batch_size=256, size=(300,300),
+                    num_workers=4, queue_size=4, output_paths=None):
+    """
+    Run a pretrained model over all images
+
+    frames_name -- list of image paths
+    build_model, checkpoints_file -- see load_model
+    output_paths -- see run_batches
+
+    return list of float32 arrays, one per output, [len(frames_name), ...]
+    """
+
+    # start the decoders before tensorflow creates its threads
+    with Pool(num_workers) as pool:
+        model = load_model(build_model, checkpoints_file, size)
+        try:
+            return run_batches(model, decoded_batches(pool, frames_name, batch_size, size, queue_size),
+                               len(frames_name), output_paths)
+        finally:
+            model[0].close()
@@ -1,85 +1,178 @@
+"""
+Generate event-based training data (one tfrecords file per event, or the event store)
+
+Sessions are processed in parallel by worker processes. Features are
+memory-mapped, so only the frames of the current event are read. Every output
+file is written to a temporary file and renamed, and finished sessions are
+recorded in a manifest in the output folder, so that reruns skip them.
+"""
+
+import os
+import time
+import argparse
 import numpy as np
 import pickle
 import tensorflow as tf
-import pdb
+from multiprocessing import Pool
+
+import event_store
 
 session_file = '/mnt/work/honda_100h/all_session.txt'
 label_root = '/mnt/work/honda_100h/labels/'
 feature_root = '/mnt/work/honda_100h/features/'
 tf_root = '/mnt/work/honda_100h/tfrecords2/'
+store_root = '/mnt/work/honda_100h/event_store/'
 
 MIN_LENGTH = 5
 MAX_LENGTH = 90
 
-with open(session_file, 'r') as fin:
-    session_count = 0
-    for line in fin:
-        session_id = line.strip()
-
-        # session label
-        label = pickle.load(open(label_root+session_id+'_goal.pkl','rb'))
-
-        ########## collect features here ##############
-        all_feats = []
-        names = []
-
-        # resnet feature
-        feats = np.load(feature_root+session_id+'.npy').astype('float32')
-        all_feats.append(feats)
-        names.append('resnet')
-
-        # sensor feature (normalized)
-        feats = np.load(feature_root+session_id+'_sensors_normalized.npy').astype('float32')
-        all_feats.append(feats)
-        names.append('sensors')
-
-
-        ##############################################
-
-        # Loop through labels and build SequenceExample protobuff
-        count = 0
-        for i in range(len(label['G'])):
-            print ("{}: {}, {} / {}".format(session_count, session_id, i+1, len(label['G'])))
-
-            length = label['s'][i+1] - label['s'][i]
-            if length > MIN_LENGTH:    # ignore short (background) clips
-                writer = tf.python_io.TFRecordWriter(tf_root+session_id+'_'+str(count)+'.tfrecords')
-
-                length = min(length, MAX_LENGTH)
-                lab = label['G'][i]
-
-                # define feature_lists
-                feature_list = {}
-                for j in range(len(all_feats)):
-                    feats = all_feats[j]
-                    event = feats[label['s'][i] : label['s'][i]+length]
-
-                    feature = []    # tf.train.Feature
-                    for k in range(event.shape[0]):
-                        feature.append(tf.train.Feature(float_list=tf.train.FloatList(value=event[k].flatten())))
-
-                    feature_list[names[j]] = tf.train.FeatureList(feature=feature)
-                feature_lists = tf.train.FeatureLists(feature_list=feature_list)
-
-                # define context
-                context = tf.train.Features(feature={'label':
-                                        tf.train.Feature(int64_list=tf.train.Int64List(value=[lab])),
-                                        'length':
-                                        tf.train.Feature(int64_list=tf.train.Int64List(value=[length])),
-                                        'session_id':
-                                        tf.train.Feature(bytes_list=tf.train.BytesList(value=[session_id.encode('utf-8')])),
-                                        'event_id':
-                                        tf.train.Feature(int64_list=tf.train.Int64List(value=[count]))})
-
-                # generate one Sequence Example
-                example = tf.train.SequenceExample(
-                        context = context,
-                        feature_lists = feature_lists)
-
-                # write to file
-                writer.write(example.SerializeToString())
-                writer.close()
-
-                count += 1
-
-        session_count += 1
+# (name, appendix of feature file) of the modalities to collect
+modalities = [('resnet', '.npy'),    # resnet feature
+              ('sensors', '_sensors_normalized.npy')]    # sensor feature (normalized)
+
+MANIFEST = 'manifest.txt'
+
+def session_events(session_id):
+    """
+    Iterate over the events of one session, (event_id, label, {name: frames})
+    """
+
+    # session label
+    with open(label_root+session_id+'_goal.pkl','rb') as fin:
+        label = pickle.load(fin)
+
+    # memory-mapped, frames are only read when an event is sliced
+    all_feats = {name: np.load(feature_root+session_id+appendix, mmap_mode='r')
+                    for name, appendix in modalities}
+
+    count = 0
+    for i in range(len(label['G'])):
+        length = label['s'][i+1] - label['s'][i]
+        if length > MIN_LENGTH:    # ignore short (background) clips
+            length = min(length, MAX_LENGTH)
+            start = label['s'][i]
+            feats = {name: np.asarray(feats[start : start+length], dtype='float32')
+                        for name, feats in all_feats.items()}
+
+            yield count, label['G'][i], feats
+            count += 1
+
+def write_tfrecord(path, session_id, event_id, lab, feats):
+    """
+    Write one event as a SequenceExample
+    """
+
+    length = list(feats.values())[0].shape[0]
+
+    # define feature_lists
+    feature_list = {}
+    for name, event in feats.items():
+        event = event.reshape(event.shape[0], -1)
+        feature = [tf.train.Feature(float_list=tf.train.FloatList(value=frame)) for frame in event]
+        feature_list[name] = tf.train.FeatureList(feature=feature)
+    feature_lists = tf.train.FeatureLists(feature_list=feature_list)
+
+    # define context
+    context = tf.train.Features(feature={'label':
+                            tf.train.Feature(int64_list=tf.train.Int64List(value=[lab])),
+                            'length':
+                            tf.train.Feature(int64_list=tf.train.Int64List(value=[length])),
+                            'session_id':
+                            tf.train.Feature(bytes_list=tf.train.BytesList(value=[session_id.encode('utf-8')])),
+                            'event_id':
+                            tf.train.Feature(int64_list=tf.train.Int64List(value=[event_id]))})
+
+    # generate one Sequence Example
+    example = tf.train.SequenceExample(
+            context = context,
+            feature_lists = feature_lists)
+
+    # write to a temporary file, rename when complete
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    writer = tf.python_io.TFRecordWriter(tmp_path)
+    writer.write(example.SerializeToString())
+    writer.close()
+    os.rename(tmp_path, path)
+
+def process_session(job):
+    """
+    Write all events of one session
+
+    job -- (session_id, output format, output root)
+    return (session_id, number of events, number of bytes of frames, seconds)
+    """
+
+    session_id, output, out_root = job
+    start_time = time.time()
+    num_bytes = [0]
+
+    def _count(events):
+        for event_id, lab, feats in events:
+            num_bytes[0] += sum([f.nbytes for f in feats.values()])
+            yield event_id, lab, feats
+
+    if output == 'tfrecords':
+        num_events = 0
+        for event_id, lab, feats in _count(session_events(session_id)):
+            write_tfrecord(out_root+session_id+'_'+str(event_id)+'.tfrecords',
+                    session_id, event_id, lab, feats)
+            num_events += 1
+    elif output == 'store':
+        num_events = len(event_store.write_session(out_root, session_id, _count(session_events(session_id))))
+    else:
+        raise NotImplementedError
+
+    return session_id, num_events, num_bytes[0], time.time() - start_time
+
+def load_manifest(out_root):
+    """
+    Session ids already finished in out_root
+    """
+
+    path = os.path.join(out_root, MANIFEST)
+    if not os.path.isfile(path):
+        return set()
+    with open(path, 'r') as fin:
+        return set([line.split('\t')[0] for line in fin if line.strip()])
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, default='tfrecords',
+            help='output format: tfrecords (one file per event) | store (see event_store.py)')
+    parser.add_argument('--num_workers', type=int, default=4,
+            help='number of sessions processed in parallel')
+    parser.add_argument('--session_file', type=str, default=session_file,
+            help='list of sessions to process')
+    args = parser.parse_args()
+
+    out_root = tf_root if args.output == 'tfrecords' else store_root
+    if not os.path.isdir(out_root):
+        os.makedirs(out_root)
+
+    with open(args.session_file, 'r') as fin:
+        session_ids = fin.read().strip().split('\n')
+    done = load_manifest(out_root)
+    jobs = [(session_id, args.output, out_root) for session_id in session_ids if session_id not in done]
+    print ("{} sessions, {} already finished".format(len(session_ids), len(session_ids)-len(jobs)))
+
+    start_time = time.time()
+    pool = Pool(args.num_workers)
+    with open(os.path.join(out_root, MANIFEST), 'a') as manifest:
+        for session_count, (session_id, num_events, num_bytes, seconds) in \
+                enumerate(pool.imap_unordered(process_session, jobs)):
+            # only the main process writes the manifest
+            manifest.write('{}\t{}\n'.format(session_id, num_events))
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+            seconds = max(seconds, 1e-6)
+            print ("{} / {}: {}, {} events, {:.1f} s, {:.1f} events/s, {:.1f} MB/s".format(
+                    session_count+1, len(jobs), session_id, num_events, seconds,
+                    num_events / seconds, num_bytes / seconds / 1024**2))
+    pool.close()
+    pool.join()
+    print ("Total time: {:.1f} s".format(time.time()-start_time))
+
+if __name__ == "__main__":
+    main()
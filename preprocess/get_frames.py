@@ -1,41 +1,192 @@
 """
     Extract video frames using ffmpeg
+
+    Sessions are processed by a bounded pool of ffmpeg subprocesses. Sessions
+    whose frames are already complete are skipped, incomplete ones are extracted again.
+    Frames are written as jpg files (frame_dir/<session_id>/frame_%04d.jpg), or
+    with --output memmap decoded straight into one uint8 array per session
+    (frame_dir/<session_id>.npy, [num_frames, height, width, 3]).
 """
 
 import os
 import sys
 import glob
-import pandas as pd
+import time
+import argparse
+import subprocess
+import numpy as np
 from multiprocessing import Pool
 import shutil
 
-frame_dir='/mnt/work/honda_100h/frames/'
+sys.path.append('../')
+from configs.base_config import load_session_list
+
+data_root = '/mnt/work/honda_100h/'
+frame_dir = '/mnt/work/honda_100h/frames/'
 sample_rate = 3    # 3 fps
 session_template = "{0}/{1}_{2}_{3}_ITS1/{4}/"
 
-def func(session_id):
-    if os.path.isdir(frame_dir+session_id):
-#        # pass if already extrated
-#        return
-        shutil.rmtree(frame_dir+session_id)
-
-    print session_id
-    os.makedirs(frame_dir+session_id)
-    session_folder = session_template.format('/mnt/work/honda_100h',
+def video_path(session_id):
+    session_folder = session_template.format(data_root.rstrip('/'),
                                                 session_id[:4],
                                                 session_id[4:6],
                                                 session_id[6:8],
                                                 session_id)
-    video_filename = glob.glob(session_folder + "camera/center/*mp4")[0]
+    return glob.glob(session_folder + "camera/center/*mp4")[0]
+
+def video_duration(video_filename):
+    """
+    Duration of the video in seconds
+    """
+
+    output = subprocess.check_output(['ffprobe', '-v', 'error',
+                                      '-show_entries', 'format=duration',
+                                      '-of', 'default=noprint_wrappers=1:nokey=1',
+                                      video_filename])
+    return float(output.strip())
+
+def expected_frames(video_filename):
+    return int(round(video_duration(video_filename) * sample_rate))
+
+def is_complete(num_frames, expected):
+    # the fps filter may round the last frame either way
+    return abs(num_frames - expected) <= 1
+
+def read_frames(video_filename, size, batch_size=256):
+    """
+    Decode frames at sample_rate straight from the video
+
+    size -- (width, height) of output frames
+    return iterator of uint8 batches, [batch_size, height, width, 3] (last batch may be smaller)
+    """
+
+    command = ["ffmpeg", '-v', 'error',
+               '-i', video_filename,
+               '-vf', 'fps={},scale={}:{}'.format(sample_rate, size[0], size[1]),
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:']
+    frame_bytes = size[0] * size[1] * 3
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=frame_bytes*batch_size)
+    try:
+        while True:
+            buf = proc.stdout.read(frame_bytes * batch_size)
+            n = len(buf) // frame_bytes
+            if n == 0:
+                break
+            yield np.frombuffer(buf[:n*frame_bytes], dtype=np.uint8).reshape(n, size[1], size[0], 3)
+    finally:
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise RuntimeError("ffmpeg failed on {}".format(video_filename))
+
+def truncate_npy(path, num_frames):
+    """
+    Shrink the first dimension of a .npy file in place
+    """
 
-    command = ["ffmpeg",
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version != (1, 0):
+            raise NotImplementedError
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        offset = f.tell()
+        # same header length, the new shape has no more digits
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order,
+                       'shape': (num_frames,)+shape[1:]}).encode('latin1')
+        header = header.ljust(offset - 10 - 1) + b'\n'
+        f.seek(10)
+        f.write(header)
+        f.truncate(offset + num_frames * int(np.prod(shape[1:])) * dtype.itemsize)
+
+def extract_jpg(session_id):
+    video_filename = video_path(session_id)
+    expected = expected_frames(video_filename)
+    output_dir = frame_dir + session_id
+    if os.path.isdir(output_dir):
+        if is_complete(len(glob.glob(output_dir+'/*.jpg')), expected):
+            return None
+        shutil.rmtree(output_dir)
+
+    # extract into a temporary folder, renamed when complete
+    tmp_dir = output_dir + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    command = ["ffmpeg", '-v', 'error',
                '-i', video_filename,
                '-vf', 'fps='+str(sample_rate),
-               frame_dir+session_id+'/frame_%04d.jpg']
-    os.system(' '.join(command))
+               tmp_dir+'/frame_%04d.jpg']
+    subprocess.check_call(command)
+    os.rename(tmp_dir, output_dir)
+
+    return len(glob.glob(output_dir+'/*.jpg'))
+
+def extract_memmap(session_id, size):
+    output_path = frame_dir + session_id + '.npy'
+    if os.path.isfile(output_path):
+        return None
+
+    video_filename = video_path(session_id)
+    # allocate for a bit more than expected and shrink at the end
+    capacity = expected_frames(video_filename) + 2*sample_rate
+
+    tmp_path = output_path + '.tmp.npy'
+    frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                      shape=(capacity, size[1], size[0], 3))
+    count = 0
+    for batch in read_frames(video_filename, size):
+        n = min(batch.shape[0], capacity-count)
+        frames[count:count+n] = batch[:n]
+        count += n
+    frames.flush()
+    del frames
+
+    truncate_npy(tmp_path, count)
+    os.rename(tmp_path, output_path)
+
+    return count
+
+def func(job):
+    session_id, output, size = job
+    start_time = time.time()
+    if output == 'jpg':
+        num_frames = extract_jpg(session_id)
+    elif output == 'memmap':
+        num_frames = extract_memmap(session_id, size)
+    else:
+        raise NotImplementedError
+    return session_id, num_frames, time.time() - start_time
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--session_file', type=str, default='all_session.txt',
+            help='session list in DATA_ROOT, e.g. all_session.txt, train_session.txt')
+    parser.add_argument('--num_workers', type=int, default=4,
+            help='number of ffmpeg processes running in parallel')
+    parser.add_argument('--output', type=str, default='jpg',
+            help='jpg: one jpg file per frame | memmap: one uint8 .npy array per session')
+    parser.add_argument('--width', type=int, default=300,
+            help='frame width for memmap output')
+    parser.add_argument('--height', type=int, default=300,
+            help='frame height for memmap output')
+    args = parser.parse_args()
 
+    sessions = load_session_list(os.path.join(data_root, args.session_file))
+    jobs = [(session_id, args.output, (args.width, args.height)) for session_id in sessions]
 
-sessions=['201710031645', '201710031224', '201710061311', '201710041209', '201710041351', '201710031436', '201710060950', '201710041448', '201710061114', '201710040938', '201710031458', '201710061345', '201710031247', '201710041102']
+    start_time = time.time()
+    pool = Pool(args.num_workers)
+    for i, (session_id, num_frames, seconds) in enumerate(pool.imap_unordered(func, jobs)):
+        if num_frames is None:
+            print ("{} / {}: {} already extracted".format(i+1, len(jobs), session_id))
+        else:
+            print ("{} / {}: {}, {} frames, {:.1f} s, {:.1f} frames/s".format(
+                    i+1, len(jobs), session_id, num_frames, seconds, num_frames / max(seconds, 1e-6)))
+    pool.close()
+    pool.join()
+    print ("Total time: {:.1f} s".format(time.time()-start_time))
 
-for session_id in sessions:
-    func(session_id)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Normalize canbus sensor data
+        ○ [accel, steer angle, steer speed, vel, brake, left, right, yaw]
+        ○ zero mean, unit std for accel, vel, brake
+        ○ unit std for steer angle, steer speed, yaw (keep the sign meaningful)
+        ○ -1, 1 for left and right
+
+Per-channel statistics are accumulated over memory-mapped sessions chunk by
+chunk and merged across sessions (parallel variant of Welford's algorithm),
+so no session is concatenated in memory. The statistics are saved to
+stats_path and reused by later runs, e.g. to normalize new sessions at
+inference time with the training statistics.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+sys.path.append('../')
+from configs.base_config import load_session_list
+
+data_root = '/mnt/work/honda_100h/'
+feature_root = '/mnt/work/honda_100h/features/'
+stats_path = feature_root + 'sensors_stats.npz'
+
+ZSCORE = [0, 3, 4]    # accel, vel, brake
+SCALE = [1, 2, 7]    # steer angle, steer speed, yaw
+SIGN = [5, 6]    # left, right turn signals
+
+CHUNK_SIZE = 100000
+
+def merge_stats(a, b):
+    """
+    Merge two (count, mean, M2) accumulators, M2 is the sum of squared deviations
+    """
+
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (float(count_b) / count)
+    m2 = m2_a + m2_b + delta**2 * (float(count_a) * count_b / count)
+    return count, mean, m2
+
+def session_stats(path):
+    """
+    (count, mean, M2) of one session, accumulated over chunks of frames
+    """
+
+    feats = np.load(path, mmap_mode='r')
+    dim = feats.shape[1]
+    stats = (0, np.zeros(dim), np.zeros(dim))
+    for start in range(0, feats.shape[0], CHUNK_SIZE):
+        chunk = np.asarray(feats[start:start+CHUNK_SIZE], dtype='float64')
+        mean = np.mean(chunk, axis=0)
+        stats = merge_stats(stats, (chunk.shape[0], mean, np.sum((chunk-mean)**2, axis=0)))
+    return stats
+
+def compute_stats(paths, num_workers=4):
+    """
+    Per-channel mean and std over all frames of all sessions
+
+    return dictionary {'mu', 'std', 'count'}
+    """
+
+    pool = Pool(num_workers)
+    stats = None
+    # merged in session order, results do not depend on scheduling
+    for s in pool.imap(session_stats, paths):
+        stats = s if stats is None else merge_stats(stats, s)
+    pool.close()
+    pool.join()
+
+    count, mean, m2 = stats
+    # population std, same as np.std of all frames
+    return {'mu': mean,
+            'std': np.sqrt(m2 / count) + np.finfo(float).tiny,
+            'count': count}
+
+def save_stats(path, stats):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **stats)
+    os.rename(tmp_path, path)
+
+def load_stats(path):
+    data = np.load(path)
+    return {key: data[key] for key in data.files}
+
+def normalize(feats, stats):
+    """
+    Apply the per-channel rules
+
+    feats -- sensor features, [N, 8]
+    stats -- output of compute_stats / load_stats
+    """
+
+    mu = stats['mu']
+    std = stats['std']
+    new_feats = np.array(feats)
+    new_feats[:, ZSCORE] = (feats[:, ZSCORE]-mu[ZSCORE]) / std[ZSCORE]
+    new_feats[:, SCALE] = feats[:, SCALE] / std[SCALE]
+    for c in SIGN:
+        new_feats[feats[:, c]==0, c] = -1
+    return new_feats
+
+def normalize_session(job):
+    session_id, stats = job
+    feats = np.load(feature_root+session_id+'_sensors.npy', mmap_mode='r')
+    output_path = feature_root+session_id+'_sensors_normalized.npy'
+    tmp_path = output_path + '.tmp.npy'
+    np.save(tmp_path, normalize(feats, stats))
+    os.rename(tmp_path, output_path)
+    return session_id
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--session_file', type=str, default='all_session.txt',
+            help='sessions to normalize (in DATA_ROOT)')
+    parser.add_argument('--stats_session_file', type=str, default='all_session.txt',
+            help='sessions used to compute the statistics (in DATA_ROOT)')
+    parser.add_argument('--recompute', action='store_true',
+            help='recompute the statistics even if stats_path exists')
+    parser.add_argument('--num_workers', type=int, default=4,
+            help='number of sessions processed in parallel')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if os.path.isfile(stats_path) and not args.recompute:
+        print ("Load statistics: " + stats_path)
+        stats = load_stats(stats_path)
+    else:
+        sessions = load_session_list(os.path.join(data_root, args.stats_session_file))
+        stats = compute_stats([feature_root+s+'_sensors.npy' for s in sessions], args.num_workers)
+        save_stats(stats_path, stats)
+        print ("Save statistics of %d frames: %s (%.1f s)" % (stats['count'], stats_path, time.time()-start_time))
+    print ("mu: ", stats['mu'])
+    print ("std: ", stats['std'])
+
+    sessions = load_session_list(os.path.join(data_root, args.session_file))
+    pool = Pool(args.num_workers)
+    for i, session_id in enumerate(pool.imap_unordered(normalize_session, [(s, stats) for s in sessions])):
+        print (i+1, '/', len(sessions), ":", session_id)
+    pool.close()
+    pool.join()
+    print ("Total time: %.1f s" % (time.time()-start_time))
+
+if __name__ == "__main__":
+    main()
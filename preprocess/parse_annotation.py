@@ -1,17 +1,27 @@
 import os
 import glob
 import pympi
+import time
+import argparse
 import pickle
-import h5py
 import numpy as np
-import pdb
-import pandas as pd
+from multiprocessing import Pool
 
 
-label_dir = '/mnt/work/honda_100h/labels_stimuli/'
 feature_dir = '/mnt/work/honda_100h/features/'
 
-label_dict = {}
+"""
+extract unoverlapped events, we are intereseted in the layers:
+u'\u88ab\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Stimuli-driven'
+u'\u4e3b\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Goal-oriented'
+u'\u539f\u56e0 Cause'
+"""
+
+# layer type -> (EAF layer, output folder, appendix of output files)
+layers = {'goal': (u'\u4e3b\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Goal-oriented',
+                   '/mnt/work/honda_100h/labels/', '_goal.pkl'),
+          'stimuli': (u'\u88ab\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Stimuli-driven',
+                      '/mnt/work/honda_100h/labels_stimuli/', '_stimuli.pkl')}
 
 def convert_seg(seg):
     """
@@ -22,29 +32,35 @@ def convert_seg(seg):
 
     Output
         s  -  starting position of each segment, list with size m+1, m is the number of segment
-        G  -  label of each segment, list with size m 
+        G  -  label of each segment, list with size m
     """
 
     N = seg.shape[0]
 
-    s = [0]
-    G = [seg[0]]
-    for i in range(1, N):
-        if not seg[i] == seg[i-1]:
-            s.append(i)
-            G.append(seg[i])
-    s.append(N)
+    # positions where the label changes
+    change = np.nonzero(seg[1:] != seg[:-1])[0] + 1
+    starts = np.concatenate(([0], change))
+
+    s = starts.tolist() + [N]
+    G = list(seg[starts])
 
     return s, G
 
-def parse_annotation(layer, session_id, N):
+def num_frames(path):
     """
-    N - number of frames of the video
-    videos are down-sampled to 3fps
-
-    Annotation is not so precise, +-3 seconds offset is possible
+    Number of frames of a .npy feature file, read from its header
     """
 
+    with open(path, 'rb') as fin:
+        version = np.lib.format.read_magic(fin)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(fin)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(fin)
+    return shape[0]
+
+def annotation_path(session_id):
+
 #        session_folder = self.session_template.format(self.cfg.DATA_ROOT,
 #                                                    session_id[:4],
 #                                                    session_id[4:6],
@@ -59,11 +75,30 @@ def parse_annotation(layer, session_id, N):
             session_id[6:8],
             session_id[8:10],
             session_id[10:12]))
-    annotation_filename = annotation_filename[0]
+    return annotation_filename[0]
+
+def read_annotations(session_id):
+    """
+    Parse the EAF file of one session once for all layers
+
+    return {layer type: list of annotations (begin in ms, end in ms, name)}
+    """
+
+    eafob = pympi.Elan.Eaf(annotation_path(session_id))
+    return {key: [tuple(a[:3]) for a in eafob.get_annotation_data_for_tier(layer[0])]
+                for key, layer in layers.items()}
+
+def build_label(annotations, N, label_dict):
+    """
+    N - number of frames of the video
+    videos are down-sampled to 3fps
+    label_dict - name -> label, updated with new names in order of appearance
+
+    Annotation is not so precise, +-3 seconds offset is possible
+    """
 
     label = np.zeros((N,), dtype='int32')
-    eafob = pympi.Elan.Eaf(annotation_filename)
-    for annotation in eafob.get_annotation_data_for_tier(layer):
+    for annotation in annotations:
         name = annotation[2].strip()
         # manually fix some bug in annotation
         if name == '':
@@ -74,10 +109,10 @@ def parse_annotation(layer, session_id, N):
 
         if not name in label_dict:
             label_dict[name] = len(label_dict.keys())
-        
+
         start = int(np.round(annotation[0] / 1000.)) * 3
 
-        end = int(np.round(annotation[1] / 1000.)) * 3 
+        end = int(np.round(annotation[1] / 1000.)) * 3
 
         ###### remove short events ########
         if end - start < 5:
@@ -97,48 +132,65 @@ def parse_annotation(layer, session_id, N):
 
     return label
 
+def parse_annotation(layer, session_id, N, label_dict):
+    """
+    Label vector of one layer ('goal' or 'stimuli') of one session
+    """
 
-"""
-extract unoverlapped events, we are intereseted in the layers:
-u'\u88ab\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Stimuli-driven'
-u'\u4e3b\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Goal-oriented'
-u'\u539f\u56e0 Cause'
-"""
-
-
-layers = u'\u88ab\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Stimuli-driven'
-#layers = u'\u4e3b\u52d5\u7684\u99d5\u99db\u884c\u70ba Operation_Goal-oriented'
+    return build_label(read_annotations(session_id)[layer], N, label_dict)
 
-label_dict['background'] = 0
+def main():
 
-feature_files = glob.glob(feature_dir+'*sensors.npy')
-feature_files = sorted(feature_files)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', type=str, default='goal,stimuli',
+            help='layers to generate labels for, e.g. goal,stimuli')
+    parser.add_argument('--num_workers', type=int, default=8,
+            help='number of EAF files parsed in parallel')
+    args = parser.parse_args()
+    layer_types = args.layers.split(',')
 
-for fin in feature_files:
-    session_id = os.path.basename(fin).split('_')[0]
-    print ("Session: " + session_id)
+    feature_files = glob.glob(feature_dir+'*sensors.npy')
+    feature_files = sorted(feature_files)
+    session_ids = [os.path.basename(fin).split('_')[0] for fin in feature_files]
 
-    N = np.load(fin).shape[0]
+    start_time = time.time()
+    label_dicts = {key: {'background': 0} for key in layer_types}
 
-    label = parse_annotation(layers, session_id, N)
+    # EAF files are parsed in parallel, labels are numbered in session order
+    # in the main process, so the outputs do not depend on the scheduling
+    pool = Pool(args.num_workers)
+    for fin, session_id, annotations in zip(feature_files, session_ids,
+                                    pool.imap(read_annotations, session_ids)):
+        print ("Session: " + session_id)
 
-    ################# Note: remove some rare events #############
-#    label[0,label[0,:]==6] = 0    # avoid parked car
-#    label[0,label[0,:]==7] = 0    # avoid bycyclist
-#    label[1,label[1,:]==12] = 0    # park
+        N = num_frames(fin)
 
+        for key in layer_types:
+            label = build_label(annotations[key], N, label_dicts[key])
 
-    s, G = convert_seg(label)
+            ################# Note: remove some rare events #############
+#            label[0,label[0,:]==6] = 0    # avoid parked car
+#            label[0,label[0,:]==7] = 0    # avoid bycyclist
+#            label[1,label[1,:]==12] = 0    # park
 
-    pickle.dump({'label': label, 's':s, 'G':G}, open(label_dir+session_id+'_stimuli.pkl', 'wb'))
+            s, G = convert_seg(label)
 
+            _, label_dir, appendix = layers[key]
+            pickle.dump({'label': label, 's':s, 'G':G}, open(label_dir+session_id+appendix, 'wb'))
+    pool.close()
+    pool.join()
 
-print ("Save label dictionary")
+    print ("Save label dictionary")
 
-num2label={}
-for key in label_dict:
-    num2label[label_dict[key]] = key
-pickle.dump({'num2label':num2label, 'label2num':label_dict}, 
-        open(label_dir+'label_goal.pkl', 'wb'))
+    for key in layer_types:
+        num2label={}
+        for name in label_dicts[key]:
+            num2label[label_dicts[key][name]] = name
+        _, label_dir, _ = layers[key]
+        pickle.dump({'num2label':num2label, 'label2num':label_dicts[key]},
+                open(label_dir+'label_goal.pkl', 'wb'))
 
+    print ("Total time: %.1f s" % (time.time()-start_time))
 
+if __name__ == "__main__":
+    main()
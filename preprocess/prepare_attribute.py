@@ -1,42 +1,34 @@
-import glob
-import pickle as pkl
 import numpy as np
-import sys
-import os
-import pdb
+import time
 
 data_root = '/mnt/work/CUB_200_2011/'
 output_root = data_root+'data/'
 
-with open(data_root+'attributes/image_attribute_labels.txt', 'r') as fin:
-    lines = fin.read().strip().split('\n')
-
-
-train_att = np.zeros((5864, 312), dtype='float32')
-test_att = np.zeros((5924, 312), dtype='float32')
-
-for i in range(len(lines)):
-    line = lines[i].split(' ')
-    img_id = int(line[0])
-    att_id = int(line[1])
-    att_flag = int(line[2])
-    att_conf = int(line[3])
-
-    if img_id <= 5864:
-        if att_flag == 1:
-            if att_conf == 3:
-                att_flag *= 0.75
-            elif att_conf == 2:
-                att_flag *= 0.5
-            train_att[img_id-1, att_id-1] = att_flag
-    else:
-        if att_flag == 1:
-            if att_conf == 3:
-                att_flag *= 0.75
-            elif att_conf == 2:
-                att_flag *= 0.5
-            test_att[img_id-5895, att_id-1] = att_flag
-pdb.set_trace()
+NUM_TRAIN = 5864    # images of the first 100 classes
+NUM_TEST = 5924
+NUM_ATT = 312
+
+start_time = time.time()
+
+# <image_id> <attribute_id> <is_present> <certainty_id> <time>
+labels = np.loadtxt(data_root+'attributes/image_attribute_labels.txt',
+                    usecols=(0,1,2,3), dtype='int64')
+img_id, att_id, att_flag, att_conf = labels.T
+
+# certainty weighting of present attributes: 3 (probably) -> 0.75, 2 (guessing) -> 0.5
+weight = np.ones(att_conf.shape, dtype='float32')
+weight[att_conf == 3] = 0.75
+weight[att_conf == 2] = 0.5
+value = att_flag * weight
+
+# scatter into one matrix of all images, then split train / test
+att = np.zeros((NUM_TRAIN+NUM_TEST, NUM_ATT), dtype='float32')
+present = att_flag == 1
+att[img_id[present]-1, att_id[present]-1] = value[present]
+
+train_att = att[:NUM_TRAIN]
+test_att = att[NUM_TRAIN:]
 
 np.save(output_root+'att_train.npy', train_att)
 np.save(output_root+'att_test.npy', test_att)
+print ("Saved attributes of %d train / %d test images (%.1f s)" % (train_att.shape[0], test_att.shape[0], time.time()-start_time))
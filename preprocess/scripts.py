@@ -119,37 +119,7 @@ Normalize canbus sensor data
         ○ -1, 1 for left and right
 """
 
-#all_feats = []
-#with open('/mnt/work/honda_100h/all_session.txt') as fin:
-#    for line in fin:
-#        session_id = line.strip()
-#
-#        feats = np.load('/mnt/work/honda_100h/features/'+session_id+'_sensors.npy')
-#        all_feats.append(feats)
-#
-#all_feats = np.concatenate(all_feats, axis=0)
-#mu = np.mean(all_feats, axis=0)
-#std = np.std(all_feats, axis=0) + np.finfo(float).tiny
-#
-#with open('/mnt/work/honda_100h/all_session.txt') as fin:
-#    for line in fin:
-#        session_id = line.strip()
-#
-#        feats = np.load('/mnt/work/honda_100h/features/'+session_id+'_sensors.npy')
-##        new_feats = (feats-mu) / std
-#        new_feats = feats
-#        new_feats[:,0] = (feats[:,0]-mu[0]) / std[0]
-#        new_feats[:,3] = (feats[:,3]-mu[3]) / std[3]
-#        new_feats[:,4] = (feats[:,4]-mu[4]) / std[4]
-#
-#        new_feats[:,1] = feats[:,1] / std[1]
-#        new_feats[:,2] = feats[:,2] / std[2]
-#        new_feats[:,7] = feats[:,7] / std[7]
-#
-#        new_feats[np.where(feats[:,5]==0)[0],5] = -1
-#        new_feats[np.where(feats[:,6]==0)[0],6] = -1
-#
-#        np.save('/mnt/work/honda_100h/features/'+session_id+'_sensors_normalized.npy', new_feats)
+# see normalize_sensors.py
 
 
 """
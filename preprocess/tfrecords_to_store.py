@@ -0,0 +1,65 @@
+"""
+Convert the event-based tfrecords (tfrecords2/, see generate_tfrecords.py)
+to the event store (see event_store.py)
+
+Sessions already in the store are skipped, so the conversion can be resumed.
+"""
+
+import os
+import glob
+import time
+import numpy as np
+import tensorflow as tf
+
+import event_store
+
+tf_root = '/mnt/work/honda_100h/tfrecords2/'
+store_root = '/mnt/work/honda_100h/event_store/'
+
+# frame shapes of the flattened FloatList features
+feat_shape = {'resnet': (8,8,1536), 'sensors': (8,)}
+
+def parse_event(path):
+    """
+    Parse one tfrecords file written by generate_tfrecords.py
+
+    return (event_id, label, {name: frames})
+    """
+
+    serialized = next(tf.python_io.tf_record_iterator(path))
+    example = tf.train.SequenceExample.FromString(serialized)
+    context = example.context.feature
+    event_id = context['event_id'].int64_list.value[0]
+    label = context['label'].int64_list.value[0]
+
+    feats = {}
+    for name, feature_list in example.feature_lists.feature_list.items():
+        frames = np.asarray([f.float_list.value for f in feature_list.feature], dtype='float32')
+        feats[name] = frames.reshape((-1,)+feat_shape.get(name, frames.shape[1:]))
+    return event_id, label, feats
+
+def main():
+
+    if not os.path.isdir(store_root):
+        os.makedirs(store_root)
+
+    # group event files by session, ordered by event id
+    sessions = {}
+    for path in glob.glob(tf_root+'*.tfrecords'):
+        session_id, event_id = os.path.basename(path)[:-len('.tfrecords')].split('_')
+        sessions.setdefault(session_id, []).append((int(event_id), path))
+
+    done = set(event_store.list_sessions(store_root))
+    for count, session_id in enumerate(sorted(sessions)):
+        if session_id in done:
+            print ("{}: {} already converted".format(count, session_id))
+            continue
+
+        start_time = time.time()
+        paths = [path for _, path in sorted(sessions[session_id])]
+        index = event_store.write_session(store_root, session_id, (parse_event(p) for p in paths))
+        print ("{}: {}, {} events, {} frames, {:.1f} s".format(count, session_id,
+                    len(index), int(np.sum(index['length'])), time.time()-start_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Approximate nearest neighbour index for event embeddings
+
+Inverted file index (IVF): the database is partitioned by k-means into nlist
+cells, and a query only scans the nprobe cells with the closest centroids.
+nlist and nprobe trade recall for latency (nprobe = nlist is exact search).
+Distances are euclidean, as in utils.retrieve_one / utils.retrieve.
+"""
+
+import numpy as np
+
+from distance import pairwise_dist
+
+def kmeans(x, k, niter=20, seed=0):
+    """
+    Lloyd's k-means
+
+    x -- float32, [N, dim]
+    k -- number of centroids
+    return centroids, [k, dim]
+    """
+
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].astype('float32')
+    for it in range(niter):
+        assign = np.argmin(pairwise_dist(x, centroids), axis=1)
+        count = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        nonempty = count > 0
+        centroids[nonempty] = sums[nonempty] / count[nonempty].reshape(-1,1)
+        # reseed empty cells with random points
+        if not np.all(nonempty):
+            centroids[~nonempty] = x[rng.choice(x.shape[0], np.sum(~nonempty), replace=False)]
+    return centroids
+
+class IVFIndex(object):
+    """
+    Inverted file index over L2-normalized embeddings
+    """
+
+    def name(self):
+        return "IVFIndex"
+
+    def __init__(self, dim, nlist=256):
+        self.dim = dim
+        self.nlist = nlist
+        self.centroids = None
+
+        self.vectors = np.zeros((0, dim), dtype='float32')
+        self.ids = np.zeros((0,), dtype='int64')
+        self.assign = np.zeros((0,), dtype='int64')
+        self._dirty = True
+
+    def train(self, x, niter=20, max_train=None, seed=0):
+        """
+        Learn the coarse centroids
+
+        x -- float32, [N, dim]
+        max_train -- maximum number of training points (random subset), default 256 per cell
+        """
+
+        if max_train is None:
+            max_train = 256 * self.nlist
+        if x.shape[0] > max_train:
+            x = x[np.random.RandomState(seed).choice(x.shape[0], max_train, replace=False)]
+        self.nlist = min(self.nlist, x.shape[0])
+        self.centroids = kmeans(np.asarray(x, dtype='float32'), self.nlist, niter, seed)
+
+    def add(self, x, ids=None):
+        """
+        Add vectors to the index
+
+        x -- float32, [N, dim]
+        ids -- int, [N,], default consecutive ids after the existing ones
+        """
+
+        if self.centroids is None:
+            raise ValueError("Index is not trained")
+        x = np.asarray(x, dtype='float32')
+        if ids is None:
+            ids = np.arange(self.ids.shape[0], self.ids.shape[0]+x.shape[0])
+
+        self.vectors = np.concatenate((self.vectors, x), axis=0)
+        self.ids = np.concatenate((self.ids, np.asarray(ids, dtype='int64')))
+        self.assign = np.concatenate((self.assign, np.argmin(pairwise_dist(x, self.centroids), axis=1)))
+        self._dirty = True
+
+    def _sort_lists(self):
+        """
+        Store the vectors contiguously by cell, cell c is [offsets[c], offsets[c+1])
+        """
+
+        order = np.argsort(self.assign, kind='stable')
+        self.vectors = self.vectors[order]
+        self.ids = self.ids[order]
+        self.assign = self.assign[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(self.assign, minlength=self.nlist))))
+        self._dirty = False
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        Top-k neighbours of a batch of queries
+
+        queries -- float32, [Q, dim] (or [dim,])
+        nprobe -- number of cells scanned per query
+        return (dist [Q, k], ids [Q, k]) sorted by distance, padded with inf / -1
+        """
+
+        if self._dirty:
+            self._sort_lists()
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.dim)
+        Q = queries.shape[0]
+        nprobe = min(nprobe, self.nlist)
+
+        dist = np.full((Q, k), np.inf, dtype='float32')
+        ids = np.full((Q, k), -1, dtype='int64')
+
+        coarse = pairwise_dist(queries, self.centroids)
+        if nprobe < self.nlist:
+            probes = np.argpartition(coarse, nprobe-1, axis=1)[:, :nprobe]
+        else:
+            probes = np.tile(np.arange(self.nlist), (Q, 1))
+
+        for q in range(Q):
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c+1]) for c in probes[q]])
+            if rows.shape[0] == 0:
+                continue
+            d = pairwise_dist(queries[q:q+1], self.vectors[rows], metric='euclidean')[0]
+            kk = min(k, rows.shape[0])
+            top = np.argpartition(d, kk-1)[:kk] if kk < rows.shape[0] else np.arange(rows.shape[0])
+            top = top[np.argsort(d[top], kind='stable')]
+            dist[q, :kk] = d[top]
+            ids[q, :kk] = self.ids[rows[top]]
+
+        return dist, ids
+
+    def save(self, path):
+        np.savez(path, dim=self.dim, nlist=self.nlist, centroids=self.centroids,
+                 vectors=self.vectors, ids=self.ids, assign=self.assign)
+
+def load_index(path):
+    """
+    Load an IVFIndex saved by IVFIndex.save
+    """
+
+    data = np.load(path)
+    index = IVFIndex(int(data['dim']), int(data['nlist']))
+    index.centroids = data['centroids']
+    index.vectors = data['vectors']
+    index.ids = data['ids']
+    index.assign = data['assign']
+    index._dirty = True
+    return index
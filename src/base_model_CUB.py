@@ -266,8 +266,8 @@ def main():
                 emb = sess.run(embedding, feed_dict={input_ph: feat_batch, dropout_ph: 1.0})
 
                 # get distance for all pairs
-                all_diff = utils.all_diffs(emb, emb)
-                triplet_input_idx, active_count = select_triplets_facenet(lab_batch,utils.cdist(all_diff,metric=cfg.metric),cfg.triplet_per_batch,cfg.alpha,num_negative=cfg.num_negative)
+                all_dist = utils.pairwise_dist(emb, metric=cfg.metric)
+                triplet_input_idx, active_count = select_triplets_facenet(lab_batch,all_dist,cfg.triplet_per_batch,cfg.alpha,num_negative=cfg.num_negative)
 
                 if triplet_input_idx is not None:
                     triplet_input = feat_batch[triplet_input_idx]
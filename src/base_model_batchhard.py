@@ -112,8 +112,7 @@ def main():
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
         # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
+        all_dist = utils.pairwise_dist_tf(embedding)
         tf.summary.histogram('embedding_dists', all_dist)
 
         # whether to use softplus
@@ -138,7 +137,7 @@ def main():
         # session iterator for session sampling
         feat_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = session_generator(feat_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=model.prepare_input)
+        train_data = session_generator(feat_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=model.prepare_input, prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
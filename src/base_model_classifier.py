@@ -18,6 +18,7 @@ from sklearn.metrics import accuracy_score
 
 sys.path.append('../')
 from configs.train_config import TrainConfig
+from preprocess import event_store
 from data_io import event_generator, load_data_and_label
 import networks
 import utils
@@ -56,9 +57,14 @@ def main():
 
     # prepare dataset
     train_session = cfg.train_session
-    tfrecords_files = glob.glob(cfg.tfrecords_root+'*.tfrecords')
-    tfrecords_files = sorted(tfrecords_files)
-    train_set = [f for f in tfrecords_files if os.path.basename(f).split('_')[0] in train_session]
+    if cfg.event_format == 'store':
+        train_set = [event_store.event_key(e) for e in event_store.load_index(cfg.event_store_root, train_session)]
+        store_root = cfg.event_store_root
+    else:
+        tfrecords_files = glob.glob(cfg.tfrecords_root+'*.tfrecords')
+        tfrecords_files = sorted(tfrecords_files)
+        train_set = [f for f in tfrecords_files if os.path.basename(f).split('_')[0] in train_session]
+        store_root = None
     print ("Number of training events: %d" % len(train_set))
 
     val_session = cfg.val_session
@@ -104,7 +110,7 @@ def main():
         tf_paths_ph = tf.placeholder(tf.string, shape=[None])
         train_data = event_generator(tf_paths_ph, cfg.feat_dict, cfg.context_dict,
                 event_per_batch=cfg.event_per_batch, num_threads=1, shuffled=True,
-                preprocess_func=model.prepare_input_tf)
+                preprocess_func=model.prepare_input_tf, store_root=store_root)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -16,6 +16,7 @@ import glob
 
 sys.path.append('../')
 from configs.train_config import TrainConfig
+from preprocess import event_store
 from data_io import event_generator, load_data_and_label, prepare_dataset
 import networks
 import utils
@@ -36,8 +37,7 @@ def select_triplets_facenet(lab, eve_embedding, triplet_per_batch, alpha=0.2, nu
     """
 
     # get distance for all pairs
-    all_diff = utils.all_diffs(eve_embedding, eve_embedding)
-    all_dist = utils.cdist(all_diff, metric=metric)
+    all_dist = utils.pairwise_dist(eve_embedding, metric=metric)
 
     idx_dict = {}
     for i, l in enumerate(lab):
@@ -114,9 +114,14 @@ def main():
 
     # prepare dataset
     train_session = cfg.train_session
-    tfrecords_files = glob.glob(cfg.tfrecords_root+'*.tfrecords')
-    tfrecords_files = sorted(tfrecords_files)
-    train_set = [f for f in tfrecords_files if os.path.basename(f).split('_')[0] in train_session]
+    if cfg.event_format == 'store':
+        train_set = [event_store.event_key(e) for e in event_store.load_index(cfg.event_store_root, train_session)]
+        store_root = cfg.event_store_root
+    else:
+        tfrecords_files = glob.glob(cfg.tfrecords_root+'*.tfrecords')
+        tfrecords_files = sorted(tfrecords_files)
+        train_set = [f for f in tfrecords_files if os.path.basename(f).split('_')[0] in train_session]
+        store_root = None
     print ("Number of training events: %d" % len(train_set))
 
     val_session = cfg.val_session
@@ -151,10 +156,8 @@ def main():
         emb_var = tf.Variable([0.0], name='embeddings')
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
-        # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
-        tf.summary.histogram('embedding_dists', all_dist)
+        # calculated for monitoring all-pair embedding distance, fetched every summary_steps steps
+        dist_summ = utils.dist_summary_tf(embedding)
 
         # split embedding into anchor, positive and negative and calculate triplet loss
         anchor, positive, negative = tf.unstack(tf.reshape(embedding, [-1,3,cfg.emb_dim]), 3, 1)
@@ -177,7 +180,7 @@ def main():
         context_dict = {'label': 'int', 'length':'int'}
         train_data = event_generator(tf_paths_ph, feat_dict, context_dict,
                 event_per_batch=cfg.event_per_batch, num_threads=4, shuffled=True,
-                preprocess_func=model.prepare_input_tf)
+                preprocess_func=model.prepare_input_tf, store_root=store_root)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -278,8 +281,10 @@ def main():
                             triplet_length = seq_len[triplet_input_idx]
 
                             start_time_train = time.time()
+                            # embedding_dists histogram only every summary_steps steps
+                            summary_ops = [summary_op, dist_summ] if step % cfg.summary_steps == 0 else [summary_op]
                             # perform training on the selected triplets
-                            err, _, step, summ = sess.run([total_loss, train_op, global_step, summary_op],
+                            err, _, step, summ = sess.run([total_loss, train_op, global_step, summary_ops],
                                     feed_dict = {input_ph: triplet_input,
                                                 seqlen_ph: triplet_length,
                                                 lr_ph: learning_rate})
@@ -292,7 +297,8 @@ def main():
                                 tf.Summary.Value(tag="negative_count", simple_value=negative_count),
                                 tf.Summary.Value(tag="select_time1", simple_value=select_time1)])
                             summary_writer.add_summary(summary, step)
-                            summary_writer.add_summary(summ, step)
+                            for summary_str in summ:
+                                summary_writer.add_summary(summary_str, step)
 
                         batch_count += 1
                     
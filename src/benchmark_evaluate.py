@@ -0,0 +1,72 @@
+"""
+Benchmark the blocked evaluator (utils.evaluate) against the
+per-query reference loop (utils.evaluate_loop) on synthetic embeddings
+
+The difference to the baseline loop (shift_labels=True, labels of the
+ranking shifted by one after the query) is the change of the reported
+mPrec, Recall@K and confusion matrix due to the label indexing fix.
+"""
+
+import argparse
+import time
+import numpy as np
+
+import utils
+
+def print_difference(title, fast, slow):
+    print (title)
+    print ("mAP: %.2e" % abs(fast[0] - slow[0]))
+    print ("mAP_event: %.2e" % max([abs(fast[1][key] - slow[1][key]) for key in slow[1]]))
+    print ("mPrec: %.2e" % abs(fast[2] - slow[2]))
+    print ("confusion: %.2e" % np.max(np.abs(fast[3]['confusion_matrix'] - slow[3]['confusion_matrix'])))
+    print ("count: %d" % np.max(np.abs(fast[4] - slow[4])))
+    print ("recall: %.2e" % np.max(np.abs(np.asarray(fast[5]) - np.asarray(slow[5]))))
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_events', type=int, default=5000,
+            help='number of events in the synthetic test set')
+    parser.add_argument('--emb_dim', type=int, default=256,
+            help='dimensionality of embedding')
+    parser.add_argument('--num_class', type=int, default=12,
+            help='number of classes, including background 0')
+    parser.add_argument('--block_size', type=int, default=128,
+            help='number of queries evaluated together')
+    parser.add_argument('--skip_loop', action='store_true',
+            help='only time the blocked evaluator')
+    parser.add_argument('--seed', type=int, default=12345,
+            help='seed')
+    args = parser.parse_args()
+
+    np.random.seed(seed=args.seed)
+    # clustered embeddings so that the metrics are not trivial
+    centers = np.random.randn(args.num_class, args.emb_dim)
+    labels = np.random.randint(args.num_class, size=args.num_events).astype('int32')
+    embeddings = centers[labels] + 2 * np.random.randn(args.num_events, args.emb_dim)
+    embeddings /= np.linalg.norm(embeddings, axis=1).reshape(-1,1)
+    embeddings = embeddings.astype('float32')
+
+    start_time = time.time()
+    fast = utils.evaluate(embeddings, labels, block_size=args.block_size)
+    fast_time = time.time() - start_time
+    print ("Blocked evaluate: %d events, dim %d, %.3f s" % (args.num_events, args.emb_dim, fast_time))
+    print ("mAP = %.4f\tmPrec@0.5 = %.4f\tRecall@1 = %.4f" % (fast[0], fast[2], fast[5][0]))
+
+    if args.skip_loop:
+        return
+
+    start_time = time.time()
+    slow = utils.evaluate_loop(embeddings, labels)
+    slow_time = time.time() - start_time
+    print ("Reference loop: %.3f s (speedup %.1fx)" % (slow_time, slow_time / fast_time))
+
+    print_difference("Max abs difference to the reference loop:", fast, slow)
+
+    baseline = utils.evaluate_loop(embeddings, labels, shift_labels=True)
+    print_difference("Max abs difference to the baseline loop (before the label indexing fix):", fast, baseline)
+    print ("mPrec@0.5: %.4f -> %.4f" % (baseline[2], fast[2]))
+    print ("Recall@K: " + "\t".join(["%.4f -> %.4f" % (b, f) for b, f in zip(baseline[5], fast[5])]))
+
+if __name__ == "__main__":
+    main()
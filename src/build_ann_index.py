@@ -0,0 +1,84 @@
+"""
+Build an IVF index (ann_index.py) over stored event embeddings and check its
+recall against exact retrieval (utils.retrieve) for several nprobe values
+"""
+
+import os
+import argparse
+import time
+import numpy as np
+
+from ann_index import IVFIndex, load_index
+from utils import retrieve
+from embedding_store import EmbeddingStore
+
+def recall_check(index, database, queries, k=10, nprobe_list=[1,4,16,64]):
+    """
+    Recall@k of the index w.r.t. the exact top-k (same ranking as retrieve_one), and latency per query
+
+    database -- embeddings in the index, ids are row numbers
+    queries -- float32, [Q, dim]
+    return list of (nprobe, recall, ms per query)
+    """
+
+    _, exact, _ = retrieve(queries, database, k)
+
+    results = []
+    for nprobe in nprobe_list:
+        start_time = time.time()
+        _, ids = index.search(queries, k, nprobe)
+        duration = (time.time() - start_time) / queries.shape[0]
+        recall = np.mean([len(np.intersect1d(ids[i], exact[i])) / float(len(exact[i]))
+                            for i in range(queries.shape[0])])
+        results.append((nprobe, recall, duration*1000))
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, default=None,
+            help='embedding store folder (embedding_store.py), e.g. written by embed.py, all its sessions are indexed')
+    parser.add_argument('--embedding_path', type=str, default=None,
+            help='.npy of L2-normalized embeddings, [N, emb_dim], used if --store is not given')
+    parser.add_argument('--index_path', type=str, default=None,
+            help='where to save the index (.npz), load it instead of building if it exists and --rebuild is not set')
+    parser.add_argument('--rebuild', action='store_true',
+            help='build the index even if index_path exists')
+    parser.add_argument('--nlist', type=int, default=256,
+            help='number of IVF cells')
+    parser.add_argument('--nprobe', type=str, default='1,4,16,64',
+            help='comma separated nprobe values for the recall check')
+    parser.add_argument('--k', type=int, default=10,
+            help='number of neighbours')
+    parser.add_argument('--num_queries', type=int, default=200,
+            help='number of database embeddings used as queries for the recall check')
+    parser.add_argument('--seed', type=int, default=12345,
+            help='seed')
+    args = parser.parse_args()
+
+    if args.store is not None:
+        database, _ = EmbeddingStore(args.store).load()
+    else:
+        database = np.load(args.embedding_path).astype('float32')
+    print ("Database: %d embeddings with dim %d" % database.shape)
+
+    if args.index_path is not None and os.path.isfile(args.index_path) and not args.rebuild:
+        index = load_index(args.index_path)
+        print ("Loaded index: %s" % args.index_path)
+    else:
+        start_time = time.time()
+        index = IVFIndex(database.shape[1], args.nlist)
+        index.train(database, seed=args.seed)
+        index.add(database)
+        print ("Built index with %d cells, %.3f s" % (index.nlist, time.time()-start_time))
+        if args.index_path is not None:
+            index.save(args.index_path)
+
+    rng = np.random.RandomState(args.seed)
+    queries = database[rng.choice(database.shape[0], min(args.num_queries, database.shape[0]), replace=False)]
+    nprobe_list = [int(n) for n in args.nprobe.split(',')]
+    for nprobe, recall, ms in recall_check(index, database, queries, args.k, nprobe_list):
+        print ("nprobe = %d\tRecall@%d = %.4f\t%.3f ms/query" % (nprobe, args.k, recall, ms))
+
+if __name__ == "__main__":
+    main()
@@ -92,7 +92,7 @@ def main():
         feat_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         feat2_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=[model_emb.prepare_input, utils.mean_pool_input])
+        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=[model_emb.prepare_input, utils.mean_pool_input], prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -4,10 +4,20 @@ import pickle as pkl
 import tensorflow as tf
 import random
 import pdb
+import multiprocessing
+import tempfile
+import atexit
+import uuid
+import zlib
 
 import sys
 sys.path.append('../')
 from preprocess.label_transfer import label_transfer, MIN_LENGTH, MAX_LENGTH, MIN_LENGTH_BACKGROUND
+from preprocess import event_store
+
+# cache of segmented events (see load_session_events), stored in DATA_ROOT/event_cache/ by default
+USE_EVENT_CACHE = True
+EVENT_CACHE_VERSION = 1
 
 def prepare_dataset(data_dir, sessions, feat, label_dir=None, label_type='goal'):
 
@@ -70,19 +80,16 @@ def prepare_multimodal_dataset(data_dir, sessions, feat_list, label_dir=None, la
 
     return dataset
 
-def load_data_and_label(feat_path, label_path, preprocess_func=None, transfer=True):
-    """
-    Load one session (data + label)
+def segment_session(label, transfer=True):
     """
+    Get the events of one session from its label
 
-    if preprocess_func is None:
-        # identity function
-        preprocess_func = lambda x: x
+    label -- label dictionary loaded from *_goal.pkl / *_stimuli.pkl
+    transfer -- bool, whether to apply label_transfer
 
-    feats = np.load(feat_path, 'r')
-    label = pkl.load(open(label_path, 'rb'))
+    Return labels of events and boundary [(start, end), ...] of frames kept for each event
+    """
 
-    events = []
     labels = []
     boundary = []
     for i in range(len(label['G'])):
@@ -92,7 +99,6 @@ def load_data_and_label(feat_path, label_path, preprocess_func=None, transfer=Tr
                 continue
 
             length = min(length, MAX_LENGTH)
-            events.append(preprocess_func(feats[label['s'][i] : label['s'][i]+length]))
             # label transfer
             if transfer:
                 labels.append(label_transfer[label['G'][i]])
@@ -100,22 +106,141 @@ def load_data_and_label(feat_path, label_path, preprocess_func=None, transfer=Tr
                 labels.append(label['G'][i])
             boundary.append((label['s'][i], label['s'][i]+length))
 
+    return labels, boundary
+
+def _event_cache_paths(feat_path, label_path, transfer, cache_dir):
+    """
+    Cache files for one (session, feature type, label type, transfer) combination
+    """
+
+    if cache_dir is None:
+        # DATA_ROOT/features/xxx.npy -> DATA_ROOT/event_cache/
+        cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(feat_path))), 'event_cache')
+    feat_name = os.path.basename(feat_path).split('.')[0]
+    label_type = os.path.basename(label_path).split('.')[0].split('_')[-1]
+    name = '{}_{}_{}'.format(feat_name, label_type, 'transfer' if transfer else 'raw')
+
+    return os.path.join(cache_dir, name+'.npy'), os.path.join(cache_dir, name+'_index.pkl')
+
+def _event_cache_signature(feat_path, label_path, transfer):
+    """
+    Everything the cached events depend on, cache is invalid if any of them changes
+    """
+
+    feat_stat = os.stat(feat_path)
+    label_stat = os.stat(label_path)
+    return {'version': EVENT_CACHE_VERSION,
+            'feat': (feat_stat.st_mtime, feat_stat.st_size),
+            'label': (label_stat.st_mtime, label_stat.st_size),
+            'length': (MIN_LENGTH, MIN_LENGTH_BACKGROUND, MAX_LENGTH),
+            'label_transfer': sorted(label_transfer.items()) if transfer else None}
+
+def _atomic_save(path, save_func):
+    """
+    Write to a temporary file and rename, so that readers never see partial files
+    """
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        save_func(fout)
+    os.rename(tmp_path, path)
+
+def load_session_events(feat_path, label_path, transfer=True, cache_dir=None, segments=None):
+    """
+    Load the segmented events of one session (without preprocessing)
+
+    The frames of all events are cached as one array (memory-mapped when loaded)
+    with an index of event offsets, so that the label parsing and event slicing
+    are only done once per session, feature type, label type and transfer flag.
+
+    feat_path -- path of feature file, [time_steps, (dims)]
+    label_path -- path of label file
+    transfer -- bool, whether to apply label_transfer
+    cache_dir -- folder storing the cache, DATA_ROOT/event_cache/ if None
+    segments -- (labels, boundary) from segment_session, parsed from label_path if None
+
+    Return:
+    frames -- frames of all events concatenated, [num_frames, (dims)]
+    offsets -- frames[offsets[i]:offsets[i+1]] is event i, [num_events+1,]
+    labels -- list of event labels
+    boundary -- list of event (start, end) in the session
+    """
+
+    signature = None
+    if USE_EVENT_CACHE:
+        cache_path, index_path = _event_cache_paths(feat_path, label_path, transfer, cache_dir)
+        signature = _event_cache_signature(feat_path, label_path, transfer)
+        if os.path.isfile(index_path):
+            try:
+                index = pkl.load(open(index_path, 'rb'))
+                if index['signature'] == signature:
+                    frames = np.load(cache_path, 'r')
+                    return frames, index['offsets'], index['labels'], index['boundary']
+            except (IOError, OSError, EOFError, ValueError, KeyError, pkl.UnpicklingError):
+                pass    # broken cache, build again
+
+    feats = np.load(feat_path, 'r')
+    if segments is None:
+        segments = segment_session(pkl.load(open(label_path, 'rb')), transfer)
+    labels, boundary = segments
+
+    lengths = [end - start for start, end in boundary]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+    frames = np.empty((offsets[-1],)+feats.shape[1:], dtype=feats.dtype)
+    for i, (start, end) in enumerate(boundary):
+        frames[offsets[i] : offsets[i+1]] = feats[start : end]
+
+    if signature is not None:
+        try:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            # index is written last, it marks the cache as complete
+            _atomic_save(cache_path, lambda fout: np.save(fout, frames))
+            _atomic_save(index_path, lambda fout: pkl.dump({'signature': signature,
+                                                            'offsets': offsets,
+                                                            'labels': labels,
+                                                            'boundary': boundary}, fout))
+        except (IOError, OSError):
+            print ("WARNING: cannot write event cache for {}".format(feat_path))
+
+    return frames, offsets, labels, boundary
+
+def load_data_and_label(feat_path, label_path, preprocess_func=None, transfer=True, cache_dir=None):
+    """
+    Load one session (data + label)
+    """
+
+    if preprocess_func is None:
+        # identity function
+        preprocess_func = lambda x: x
+
+    frames, offsets, labels, boundary = load_session_events(feat_path, label_path, transfer, cache_dir)
+
+    events = []
+    for i in range(len(labels)):
+        events.append(preprocess_func(frames[offsets[i] : offsets[i+1]]))
+
     events = np.concatenate(events, axis=0).astype('float32')
     labels = np.asarray(labels, dtype='int32').reshape(-1,1)
 
     return events, labels, boundary
 
 
-def event_generator(tf_paths, feat_dict, context_dict, event_per_batch, num_threads=2, shuffled=True, preprocess_func=None):
+def event_generator(tf_paths, feat_dict, context_dict, event_per_batch, num_threads=2, shuffled=True, preprocess_func=None, store_root=None):
     """
     Generator iterator of sesssions
 
-    feat_paths -- placeholder for tfrecord paths
+    feat_paths -- placeholder for tfrecord paths, or event keys if store_root is given
     feat_dict -- feature dictionary for parsing feature_lists, e.g. {'resnet': 98304, 'sensors':8}
     context_dict -- dictionary for parsing context, e.g. {'label': 'int', 'length': 'int'}
     preprocess_func -- preprocessing function, if needed
+    store_root -- read events from the event store (preprocess/event_store.py) instead of tfrecords
     """
 
+    if store_root is not None:
+        return store_event_generator(tf_paths, feat_dict, context_dict, event_per_batch,
+                store_root, num_threads, shuffled, preprocess_func)
+
     dataset = tf.data.TFRecordDataset(tf_paths)
     
     def _get_context_feature(ctype):
@@ -162,100 +287,259 @@ def event_generator(tf_paths, feat_dict, context_dict, event_per_batch, num_thre
     
     return dataset
 
+def store_event_generator(event_keys, feat_dict, context_dict, event_per_batch, store_root, num_threads=2, shuffled=True, preprocess_func=None):
+    """
+    Generator iterator of events from the event store, same outputs as event_generator
+
+    event_keys -- placeholder for event keys, see event_store.event_key
+    store_root -- folder of the event store
+    """
+
+    index = event_store.load_index(store_root)
+    lookup = {event_store.event_key(entry): entry for entry in index}
+
+    context_types = {'int': tf.int64, 'float': tf.float32, 'str': tf.string}
+    context_keys = list(context_dict.keys())
+    feat_keys = list(feat_dict.keys())
+
+    def _read_event(key):
+        entry = lookup[key.decode('utf-8')]
+        context = []
+        for name in context_keys:
+            if context_dict[name] == 'str':
+                context.append(np.array(str(entry[name]).encode('utf-8')))
+            else:
+                context.append(np.array(entry[name], dtype=context_types[context_dict[name]].as_numpy_dtype))
+        # same [length, dim] layout as the FloatList frames of tfrecords
+        feats = [np.asarray(event_store.read_event(store_root, entry, name),
+                        dtype='float32').reshape(-1, feat_dict[name]) for name in feat_keys]
+        return context + feats
+
+    def _input_parser(key):
+        outputs = tf.py_func(_read_event, [key],
+                [context_types[context_dict[name]] for name in context_keys] + [tf.float32]*len(feat_keys))
+        context = {}
+        for name, value in zip(context_keys, outputs[:len(context_keys)]):
+            value.set_shape([])
+            context[name] = value
+        feature_lists = {}
+        for name, value in zip(feat_keys, outputs[len(context_keys):]):
+            value.set_shape([None, feat_dict[name]])
+            if preprocess_func is not None:
+                value = preprocess_func(value)
+            feature_lists[name] = value
+        return context, feature_lists
+
+    dataset = tf.data.Dataset.from_tensor_slices(event_keys)
+    if shuffled:
+        # shuffling keys is cheap, so shuffle the whole set before reading
+        dataset = dataset.shuffle(buffer_size=tf.cast(tf.shape(event_keys)[0], tf.int64))
+    dataset = dataset.map(_input_parser, num_parallel_calls=num_threads)
+    dataset = dataset.batch(event_per_batch)
+    dataset = dataset.prefetch(1)
+
+    return dataset
+
 
-def session_generator(feat_paths, label_paths, sess_per_batch, num_threads=2, shuffled=True, preprocess_func=None):
+def load_multimodal_data_and_label(feat_paths, label_path, preprocess_funcs=None, transfer=True, cache_dir=None):
+    """
+    Load one session for multiple modalities (data + label)
+
+    The label is parsed once and the same event boundaries are used to slice
+    every modality. For each event, all preprocess_funcs start from the same
+    random state, so that random sampling (e.g. tsn_prepare_input) picks the
+    same frames in all modalities.
+
+    feat_paths -- list of feature paths, one for each modality
+    label_path -- path of label file
+    preprocess_funcs -- list of preprocessing functions, one for each modality
+    """
+
+    if preprocess_funcs is None:
+        # identity function
+        preprocess_funcs = [lambda x: x] * len(feat_paths)
+
+    segments = segment_session(pkl.load(open(label_path, 'rb')), transfer)
+    sessions = [load_session_events(feat_path, label_path, transfer, cache_dir, segments)
+                    for feat_path in feat_paths]
+    labels, boundary = segments
+
+    events = [[] for _ in feat_paths]
+    for i in range(len(labels)):
+        state = np.random.get_state()
+        for m, (frames, offsets, _, _) in enumerate(sessions):
+            np.random.set_state(state)    # shared random offsets across modalities
+            events[m].append(preprocess_funcs[m](frames[offsets[i] : offsets[i+1]]))
+
+    events = [np.concatenate(eve, axis=0).astype('float32') for eve in events]
+    labels = np.asarray(labels, dtype='int32').reshape(-1,1)
+
+    return events, labels, boundary
+
+def load_session_batch(feat_paths, label_paths, preprocess_funcs, shuffled=True):
+    """
+    Load a batch of sessions for one or more modalities
+
+    feat_paths -- list of feature paths for each modality, [num_modality][sess_per_batch]
+    label_paths -- label paths, [sess_per_batch]
+    preprocess_funcs -- preprocessing function for each modality
+    shuffled -- bool, whether to shuffle events (same order for all modalities)
+
+    Return a list of events for each modality, labels and session ids of events
+    """
+
+    events = [[] for _ in feat_paths]
+    labels = []
+    sess = []
+    for s in range(len(label_paths)):
+        eve_batch, lab_batch, bou_batch = load_multimodal_data_and_label([path[s] for path in feat_paths],
+                                                                         label_paths[s], preprocess_funcs)
+        for m in range(len(feat_paths)):
+            events[m].append(eve_batch[m])
+        labels.append(lab_batch)
+        sess.extend([os.path.basename(feat_paths[0][s]).split('.')[0]] * lab_batch.shape[0])
+
+    events = [np.concatenate(eve, axis=0) for eve in events]
+    labels = np.concatenate(labels, axis=0)
+    sess = np.asarray(sess).reshape(-1,1)
+
+    if shuffled:
+        idx = np.random.permutation(labels.shape[0])
+        events = [eve[idx] for eve in events]
+        labels = labels[idx]
+        sess = sess[idx]
+
+    return events, labels, sess
+
+
+############### Multi-process session loading ###############
+
+# worker processes are forked, so that preprocessing functions (bound methods of models) need not be pickled
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+_worker_preprocess_funcs = None
+
+def _init_loader_worker(preprocess_funcs, seed):
+    global _worker_preprocess_funcs
+    _worker_preprocess_funcs = preprocess_funcs
+    if seed is None:
+        # forked workers share the random state of the parent
+        np.random.seed()
+        random.seed()
+
+def _to_shared(arr):
+    """
+    Write array into a file in shared memory, which is read once by the parent
+    """
+
+    path = os.path.join(SHARED_DIR, 'session_loader_{}_{}.npy'.format(os.getpid(), uuid.uuid4().hex))
+    np.save(path, arr)
+    return path
+
+def _from_shared(path):
+    arr = np.load(path)
+    os.remove(path)
+    return arr
+
+def _loader_task(index, feat_paths, label_paths, shuffled, seed):
+    """
+    Load one batch of sessions in worker process
+    Events are returned through shared memory files instead of pickling
+    """
+
+    if seed is not None:
+        # seed depends only on the batch, not on the worker running it
+        task_seed = (seed + index + zlib.crc32(''.join(label_paths).encode())) % (2**32)
+        np.random.seed(task_seed)
+        random.seed(task_seed)
+
+    events, labels, sess = load_session_batch(feat_paths, label_paths, _worker_preprocess_funcs, shuffled)
+
+    return [_to_shared(eve) for eve in events], labels, sess
+
+def session_loader(num_workers, preprocess_funcs, seed=None):
+    """
+    Create a pool of worker processes for loading sessions
+    Should be created before tf.Session is started (workers are forked)
+
+    num_workers -- int, number of worker processes
+    preprocess_funcs -- preprocessing function for each modality
+    seed -- int, seed for sampling in preprocessing functions, not reproducible if None
+    """
+
+    pool = multiprocessing.get_context('fork').Pool(num_workers,
+                initializer=_init_loader_worker, initargs=(preprocess_funcs, seed))
+    atexit.register(pool.terminate)
+
+    def _load(index, feat_paths, label_paths, shuffled):
+        # wait for the result without holding the GIL, so batches are loaded in parallel
+        events_paths, labels, sess = pool.apply_async(_loader_task,
+                (int(index), feat_paths, label_paths, shuffled, seed)).get()
+        return [_from_shared(path) for path in events_paths], labels, sess
+
+    return _load
+
+
+def session_generator(feat_paths, label_paths, sess_per_batch, num_threads=2, shuffled=True, preprocess_func=None, prefetch=1, seed=None):
     """
     Generator iterator of sesssions (Old version without using tfrecords)
 
+    Sessions are loaded and preprocessed in num_threads worker processes,
+    batches come out in the order of feat_paths
+
     feat_paths -- placeholder for feature paths
     label_paths -- placeholder for label_paths
+    num_threads -- number of worker processes (batches loaded in parallel)
     preprocess_func -- preprocessing function, if needed
+    prefetch -- number of batches prefetched
+    seed -- int, seed for reproducible sampling in preprocess_func
     """
 
-    dataset = tf.data.Dataset.from_tensor_slices((feat_paths, label_paths))
+    dataset = tf.data.Dataset.zip((tf.data.Dataset.range(2**62),
+                tf.data.Dataset.from_tensor_slices((feat_paths, label_paths))))
+    load = session_loader(num_threads, [preprocess_func], seed)
     
-    def _input_parser(feat_path, label_path):
-        events = []
-        sess = []
-        labels = []
-#        lengths = []
-        for s in range(sess_per_batch):
-            #### very important to have decode() for tf r1.6 ####
-            eve_batch, lab_batch, bou_batch = load_data_and_label(feat_path[s].decode(), label_path[s].decode(), preprocess_func)
-
-            events.append(eve_batch)
-            labels.append(lab_batch)
-            sess.extend([os.path.basename(feat_path[s].decode()).split('.')[0]] * eve_batch.shape[0])
-#            lengths.extend([b[1]-b[0] for b in bou_batch])
-
-        events = np.concatenate(events, axis=0)
-        sess = np.asarray(sess).reshape(-1,1)
-        labels = np.concatenate(labels, axis=0)
-#        lengths = np.asarray(lengths).reshape(-1,1)
-
-        if shuffled:
-            idx = np.random.permutation(events.shape[0])
-            events = events[idx]
-            sess = sess[idx]
-            labels = labels[idx]
-
-        return events, sess, labels
+    def _input_parser(index, feat_path, label_path):
+        #### very important to have decode() for tf r1.6 ####
+        events, labels, sess = load(index, [[p.decode() for p in feat_path]],
+                                    [p.decode() for p in label_path], shuffled)
+
+        return events[0], sess, labels
 
     # fix doc issue according to https://github.com/tensorflow/tensorflow/issues/11786
-    dataset = dataset.map(lambda feat_path, label_path:
-                        tuple(tf.py_func(_input_parser, [feat_path, label_path],
+    dataset = dataset.map(lambda index, paths:
+                        tuple(tf.py_func(_input_parser, [index, paths[0], paths[1]],
                             [tf.float32, tf.string, tf.int32])),
                         num_parallel_calls = num_threads)
-    dataset = dataset.prefetch(1)
+    dataset = dataset.prefetch(prefetch)
     
     return dataset
 
-def multimodal_session_generator(feat_paths, feat2_paths, feat3_paths, label_paths, sess_per_batch, num_threads=2, shuffled=True, preprocess_func=None):
+def multimodal_session_generator(feat_paths, feat2_paths, feat3_paths, label_paths, sess_per_batch, num_threads=2, shuffled=True, preprocess_func=None, prefetch=1, seed=None):
+    """
+    Generator iterator of sessions with three modalities, see session_generator
+
+    preprocess_func -- list of preprocessing functions, one for each modality
+    """
 
-    dataset = tf.data.Dataset.from_tensor_slices((feat_paths, feat2_paths, feat3_paths, label_paths))
+    dataset = tf.data.Dataset.zip((tf.data.Dataset.range(2**62),
+                tf.data.Dataset.from_tensor_slices((feat_paths, feat2_paths, feat3_paths, label_paths))))
+    load = session_loader(num_threads, preprocess_func, seed)
     
-    def _input_parser(feat_path, feat2_path, feat3_path, label_path):
-        events = []
-        events2 = []
-        events3 = []
-        labels = []
-        sess = []
-        for s in range(sess_per_batch):
-            #### very important to have decode() for tf r1.6 ####
-            eve_batch, lab_batch, bou_batch = load_data_and_label(feat_path[s].decode(), label_path[s].decode(), preprocess_func[0])
-            events.append(eve_batch)
-            labels.append(lab_batch)
-
-            eve2_batch, _, _  = load_data_and_label(feat2_path[s].decode(), label_path[s].decode(), preprocess_func[1])
-            events2.append(eve2_batch)
-
-            eve3_batch, _, _  = load_data_and_label(feat3_path[s].decode(), label_path[s].decode(), preprocess_func[1])
-            events3.append(eve3_batch)
-
-            sess.extend([os.path.basename(feat_path[s].decode()).split('.')[0]] * eve_batch.shape[0])
-
-        events = np.concatenate(events, axis=0)
-        events2 = np.concatenate(events2, axis=0)
-        events3 = np.concatenate(events3, axis=0)
-        labels = np.concatenate(labels, axis=0)
-        sess = np.asarray(sess).reshape(-1,1)
-
-        if shuffled:
-            idx = np.random.permutation(events.shape[0])
-            events = events[idx]
-            events2 = events2[idx]
-            events3 = events3[idx]
-            labels = labels[idx]
-            sess = sess[idx]
-
-        return events, events2, events3, labels, sess
+    def _input_parser(index, feat_path, feat2_path, feat3_path, label_path):
+        #### very important to have decode() for tf r1.6 ####
+        events, labels, sess = load(index,
+                                    [[p.decode() for p in feat_path],
+                                     [p.decode() for p in feat2_path],
+                                     [p.decode() for p in feat3_path]],
+                                    [p.decode() for p in label_path], shuffled)
+
+        return events[0], events[1], events[2], labels, sess
 
     # fix doc issue according to https://github.com/tensorflow/tensorflow/issues/11786
-    dataset = dataset.map(lambda feat_path, feat2_path, feat3_path, label_path:
-                        tuple(tf.py_func(_input_parser, [feat_path, feat2_path, feat3_path, label_path],
+    dataset = dataset.map(lambda index, paths:
+                        tuple(tf.py_func(_input_parser, [index, paths[0], paths[1], paths[2], paths[3]],
                             [tf.float32, tf.float32, tf.float32, tf.int32, tf.string])),
                         num_parallel_calls = num_threads)
-    dataset = dataset.prefetch(1)
+    dataset = dataset.prefetch(prefetch)
     
     return dataset
-
@@ -115,10 +115,8 @@ def main():
         emb_var = tf.Variable([0.0], name='embeddings')
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
-        # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
-        tf.summary.histogram('embedding_dists', all_dist)
+        # calculated for monitoring all-pair embedding distance, fetched every summary_steps steps
+        dist_summ = utils.dist_summary_tf(embedding)
 
         # split embedding into anchor, positive and negative and calculate triplet loss
         anchor, positive, negative = tf.unstack(tf.reshape(embedding, [-1,3,cfg.emb_dim]), 3, 1)
@@ -165,7 +163,7 @@ def main():
         feat2_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         feat3_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, feat3_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input, model_emb_segment.prepare_input])
+        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, feat3_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input, model_emb_segment.prepare_input], prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -277,8 +275,8 @@ def main():
                             eve_embedding[start:end] = np.copy(emb)
     
                         # sample triplets within sampled sessions
-                        all_diff = utils.all_diffs(eve_embedding, eve_embedding)
-                        triplet_input_idx, active_count = utils.select_triplets_facenet(lab,utils.cdist(all_diff,metric=cfg.metric),cfg.triplet_per_batch,cfg.alpha,num_negative=cfg.num_negative)
+                        all_dist = utils.pairwise_dist(eve_embedding, metric=cfg.metric)
+                        triplet_input_idx, active_count = utils.select_triplets_facenet(lab,all_dist,cfg.triplet_per_batch,cfg.alpha,num_negative=cfg.num_negative)
                         if triplet_input_idx is None:
                             continue
                         
@@ -292,9 +290,11 @@ def main():
                             pdb.set_trace()
     
                         ##################### Start training  ########################
+                        # embedding_dists histogram only every summary_steps steps
+                        summary_ops = [summary_op, dist_summ] if step % cfg.summary_steps == 0 else [summary_op]
     
                         err, metric_err, hal_err, _, step, summ = sess.run(
-                                [total_loss, metric_loss, hal_loss, train_op, global_step, summary_op],
+                                [total_loss, metric_loss, hal_loss, train_op, global_step, summary_ops],
                                 feed_dict = {input_ph: triplet_input,
                                              input_sensors_ph: sensors_input,
                                              input_segment_ph: segment_input,
@@ -310,7 +310,8 @@ def main():
                                     tf.Summary.Value(tag="hallucination_loss", simple_value=hal_err)])
     
                         summary_writer.add_summary(summary, step)
-                        summary_writer.add_summary(summ, step)
+                        for summary_str in summ:
+                            summary_writer.add_summary(summary_str, step)
 
                         batch_count += 1
                     
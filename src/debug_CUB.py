@@ -202,8 +202,7 @@ def main():
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
         # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
+        all_dist = utils.pairwise_dist_tf(embedding)
         tf.summary.histogram('embedding_dists', all_dist)
 
         # use tensorflow implementation...
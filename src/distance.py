@@ -0,0 +1,72 @@
+"""
+Memory-bounded pairwise distances
+
+Computes the [N, M] distance matrix directly instead of building the
+[N, M, dim] difference tensor of utils.all_diffs
+"""
+
+import numpy as np
+
+# default ceiling (in bytes) for the temporary buffers of one tile
+MAX_MEMORY = 256 * 1024 * 1024
+
+def _row_tile(num_rows, bytes_per_row, max_memory):
+    """
+    Number of rows processed together so that one tile fits into max_memory
+    """
+    return int(max(1, min(num_rows, max_memory // max(bytes_per_row, 1))))
+
+def pairwise_dist(a, b=None, metric='squaredeuclidean', max_memory=MAX_MEMORY, out=None):
+    """
+    Return the distance between all pairs of rows in a and b according to metric,
+    same values as utils.cdist(utils.all_diffs(a, b), metric)
+
+    a -- [N, dim]
+    b -- [M, dim], use a if None
+    metric  --   "squaredeuclidean": squared euclidean
+                 "euclidean": euclidean (without squared)
+                 "l1": manhattan distance
+    max_memory -- int, ceiling (in bytes) for temporary buffers, excluding the output
+    out -- optional preallocated output, [N, M]
+    """
+
+    if b is None:
+        b = a
+    dtype = np.result_type(a.dtype, b.dtype, np.float32)
+    N, dim = a.shape
+    M = b.shape[0]
+    if out is None:
+        out = np.empty((N, M), dtype=dtype)
+    itemsize = np.dtype(dtype).itemsize
+
+    if metric == "squaredeuclidean" or metric == "euclidean":
+        # ||a-b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+        b_sq = np.sum(np.square(b, dtype=dtype), axis=1).reshape(1,-1)
+        tile = _row_tile(N, 2 * M * itemsize, max_memory)
+        for start in range(0, N, tile):
+            end = min(start+tile, N)
+            a_tile = a[start:end].astype(dtype, copy=False)
+            dist = np.dot(a_tile, b.T.astype(dtype, copy=False))
+            dist *= -2
+            dist += np.sum(np.square(a_tile), axis=1).reshape(-1,1)
+            dist += b_sq
+            np.maximum(dist, 0, out=dist)    # clamp rounding errors
+            if metric == "euclidean":
+                dist += 1e-12
+                np.sqrt(dist, out=dist)
+            out[start:end] = dist
+    elif metric == "l1":
+        # tile over both rows and columns to bound the [rows, cols, dim] buffer
+        col_tile = _row_tile(M, dim * itemsize, max_memory)
+        row_tile = _row_tile(N, col_tile * dim * itemsize, max_memory)
+        for r_start in range(0, N, row_tile):
+            r_end = min(r_start+row_tile, N)
+            a_tile = np.expand_dims(a[r_start:r_end].astype(dtype, copy=False), axis=1)
+            for c_start in range(0, M, col_tile):
+                c_end = min(c_start+col_tile, M)
+                diff = a_tile - np.expand_dims(b[c_start:c_end].astype(dtype, copy=False), axis=0)
+                out[r_start:r_end, c_start:c_end] = np.sum(np.abs(diff, out=diff), axis=-1)
+    else:
+        raise NotImplementedError
+
+    return out
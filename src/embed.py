@@ -0,0 +1,141 @@
+"""
+Run a checkpoint over a session list once and save the embeddings to the
+embedding store (embedding_store.py), where evaluate_model.py and the other
+evaluation tools read them from
+
+python embed.py --model_path MODEL_DIR/model-XXX --feat resnet --network convtsn --embed_split test,val
+"""
+
+import sys
+import os
+import tensorflow as tf
+
+sys.path.append('../')
+from configs.eval_config import EvalConfig
+import networks
+from data_io import prepare_dataset
+import embedding_store
+from frozen_graph import FrozenEncoder, INPUT_NAME, OUTPUT_NAME
+
+def build_model(cfg):
+    """
+    Backbone model of cfg.network
+    """
+
+    if cfg.network == "tsn":
+        model = networks.TSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim)
+    elif cfg.network == "rtsn":
+        model = networks.RTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim, n_input=cfg.n_input)
+    elif cfg.network == "convtsn":
+        model = networks.ConvTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim)
+    elif cfg.network == "convrtsn":
+        model = networks.ConvRTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim, n_h=cfg.n_h, n_w=cfg.n_w, n_C=cfg.n_C, n_input=cfg.n_input)
+    elif cfg.network == "seq2seqtsn":
+        model = networks.Seq2seqTSN(n_seg=cfg.num_seg, n_input=cfg.n_input, emb_dim=cfg.emb_dim, reverse=cfg.reverse)
+    elif cfg.network == "convbirtsn":
+        model = networks.ConvBiRTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim)
+    else:
+        raise NotImplementedError
+    return model
+
+def build_graph(cfg, keep_prob):
+    """
+    Embedding graph of cfg.network
+
+    keep_prob -- dropout keep probability, placeholder or constant
+    return model, input placeholder, L2-normalized embedding
+    """
+
+    model = build_model(cfg)
+
+    if cfg.feat == "sensors" or cfg.feat == "segment":
+        input_ph = tf.placeholder(tf.float32, shape=[None, cfg.num_seg, None], name=INPUT_NAME)
+    elif cfg.feat == "resnet" or cfg.feat == "segment_down":
+        input_ph = tf.placeholder(tf.float32, shape=[None, cfg.num_seg, None, None, None], name=INPUT_NAME)
+    model.forward(input_ph, keep_prob)
+    embedding = tf.nn.l2_normalize(model.hidden, axis=1, epsilon=1e-10, name=OUTPUT_NAME)
+
+    return model, input_ph, embedding
+
+def restore(cfg, sess):
+    """
+    Restore the variables of the current graph from cfg.model_path
+    """
+
+    var_list = {}
+    for v in tf.global_variables():
+        var_list[cfg.variable_name+v.op.name] = v
+
+    saver = tf.train.Saver(var_list)
+    sess.run(tf.global_variables_initializer())
+
+    # load the model (note that model_path already contains snapshot number
+    saver.restore(sess, cfg.model_path)
+
+def open_store(cfg):
+    config = embedding_store.model_config(cfg, ['network', 'num_seg', 'emb_dim', 'variable_name',
+                                                'n_input', 'n_h', 'n_w', 'n_C', 'reverse', 'emb_dtype'])
+    return embedding_store.open_store(cfg.model_path, cfg.feat, cfg.label_type, cfg.transfer, config=config)
+
+def embed(cfg, dataset):
+    """
+    Embed the sessions of dataset that are not in the store of cfg.model_path
+
+    dataset -- list of (feat_path, label_path), see data_io.prepare_dataset
+    return the store, number of events embedded and run time
+    """
+
+    store = open_store(cfg)
+    if not cfg.recompute_embedding and len(store.missing(dataset)) == 0:
+        return store, 0, 0.0
+
+    if cfg.use_frozen:
+        # frozen graph exported by export_graph.py, no model classes or checkpoint restoring
+        encoder = FrozenEncoder(cfg.model_path, cfg.gpu)
+        count, duration = embedding_store.embed_sessions([store], lambda eve_batch: [encoder.run(eve_batch)],
+                dataset, encoder.prepare_input_test, cfg.transfer, batch_size=cfg.eval_batch_size, dtype=cfg.emb_dtype,
+                recompute=cfg.recompute_embedding)
+        encoder.close()
+        return store, count, duration
+
+    dropout_ph = tf.placeholder(tf.float32, shape=[])
+    model, input_ph, embedding = build_graph(cfg, dropout_ph)
+
+    if cfg.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = cfg.gpu
+
+    gpu_options = tf.GPUOptions(allow_growth=True)
+    sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+
+    with sess.as_default():
+        restore(cfg, sess)
+
+        count, duration = embedding_store.embed_sessions([store],
+                lambda eve_batch: [sess.run(embedding, feed_dict={input_ph: eve_batch, dropout_ph: 1.0})],
+                dataset, model.prepare_input_test, cfg.transfer, batch_size=cfg.eval_batch_size, dtype=cfg.emb_dtype,
+                recompute=cfg.recompute_embedding)
+    sess.close()
+    tf.reset_default_graph()
+
+    return store, count, duration
+
+def main():
+
+    cfg = EvalConfig().parse()
+    print ("Embed with the model: {}".format(os.path.basename(cfg.model_path)))
+
+    split_sessions = {'train': cfg.train_session,
+                      'val': cfg.val_session,
+                      'test': cfg.test_session,
+                      'all': cfg.all_session}
+    sessions = []
+    for split in cfg.embed_split.split(','):
+        sessions.extend([s for s in split_sessions[split] if s not in sessions])
+    dataset = prepare_dataset(cfg.feature_root, sessions, cfg.feat, cfg.label_root, cfg.label_type)
+
+    store, count, duration = embed(cfg, dataset)
+    print ("%d events embedded, run time: %.3f s" % (count, duration))
+    print ("Embedding store: {}".format(store.root))
+
+if __name__ == '__main__':
+    main()
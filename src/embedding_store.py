@@ -0,0 +1,303 @@
+"""
+On-disk store of event embeddings computed by a checkpoint
+
+One folder per (checkpoint, feature, label type, transfer, embedding name),
+next to the checkpoint: MODEL_DIR/embeddings/<snapshot>_<feat>_<label_type>_<transfer|raw>_<name>/
+For each session:
+    <session>.npy    embeddings, [num_events, emb_dim], float32 or float16
+    <session>_meta.npy    metadata table, structured array with META_DTYPE fields
+    <session>_index.pkl    signature of the inputs, written last (marks the session as complete)
+All .npy files can be memory-mapped. A session is recomputed when the
+checkpoint, model configuration (see model_config), feature file, label file
+or event segmentation changes.
+"""
+
+import os
+import glob
+import time
+import threading
+import numpy as np
+import pickle as pkl
+from queue import Queue
+from collections import deque
+
+import sys
+sys.path.append('../')
+from preprocess.label_transfer import label_transfer, MIN_LENGTH, MAX_LENGTH, MIN_LENGTH_BACKGROUND
+from data_io import load_data_and_label
+
+EMBEDDING_STORE_VERSION = 1
+
+META_DTYPE = np.dtype([('session_id', 'U16'),
+                       ('start', 'int64'),
+                       ('end', 'int64'),
+                       ('label', 'int32')])
+
+def store_root(model_path, feat, label_type='goal', transfer=True, name='embedding'):
+    """
+    Folder of the store for one checkpoint and feature
+
+    model_path -- checkpoint path, including snapshot number
+    name -- which embedding of the model, e.g. embedding | sensors
+    """
+
+    store_name = '{}_{}_{}_{}_{}'.format(os.path.basename(model_path), feat, label_type,
+                                         'transfer' if transfer else 'raw', name)
+    return os.path.join(os.path.dirname(model_path), 'embeddings', store_name)
+
+def model_config(cfg, keys, preprocess='tsn_prepare_input_test'):
+    """
+    Settings the embeddings depend on besides the checkpoint, part of the store signature
+
+    keys -- attributes of cfg used to build and run the model, e.g. network, num_seg, emb_dim
+    preprocess -- name of the event preprocessing (prepare_input_test of the model)
+    """
+
+    config = {key: getattr(cfg, key) for key in keys}
+    config['preprocess'] = preprocess
+    return config
+
+def session_id_of(label_path):
+    return os.path.basename(label_path).split('_')[0]
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+def _atomic_save(path, save_func):
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        save_func(fout)
+    os.rename(tmp_path, path)
+
+class EmbeddingStore(object):
+    """
+    Embeddings and metadata of the sessions of one store folder
+    """
+
+    def name(self):
+        return "EmbeddingStore"
+
+    def __init__(self, root, model_path=None, transfer=True, config=None):
+        """
+        root -- store folder, see store_root
+        model_path -- checkpoint of the embeddings, stored sessions are not checked against the inputs if None
+        transfer -- bool, whether labels are transferred (label_transfer)
+        config -- dictionary of the model settings, see model_config
+        """
+
+        self.root = root
+        self.model_path = model_path
+        self.transfer = transfer
+        self.config = config if config is not None else {}
+
+    def paths(self, session_id):
+        return (os.path.join(self.root, session_id+'.npy'),
+                os.path.join(self.root, session_id+'_meta.npy'),
+                os.path.join(self.root, session_id+'_index.pkl'))
+
+    def sessions(self):
+        """
+        Sorted list of complete sessions in the store
+        """
+
+        return sorted([os.path.basename(p)[:-len('_index.pkl')]
+                        for p in glob.glob(os.path.join(self.root, '*_index.pkl'))])
+
+    def signature(self, feat_path, label_path):
+        """
+        Everything the embeddings of a session depend on
+        """
+
+        # a checkpoint is a group of files with model_path as prefix
+        ckpt_path = self.model_path+'.index' if os.path.isfile(self.model_path+'.index') else self.model_path
+        return {'version': EMBEDDING_STORE_VERSION,
+                'checkpoint': _file_signature(ckpt_path),
+                'config': sorted(self.config.items()),
+                'feat': _file_signature(feat_path),
+                'label': _file_signature(label_path),
+                'length': (MIN_LENGTH, MIN_LENGTH_BACKGROUND, MAX_LENGTH),
+                'label_transfer': sorted(label_transfer.items()) if self.transfer else None}
+
+    def is_complete(self, feat_path, label_path):
+        index_path = self.paths(session_id_of(label_path))[2]
+        if not os.path.isfile(index_path):
+            return False
+        if self.model_path is None:
+            return True
+        try:
+            return pkl.load(open(index_path, 'rb'))['signature'] == self.signature(feat_path, label_path)
+        except (IOError, OSError, EOFError, KeyError, pkl.UnpicklingError):
+            return False
+
+    def missing(self, dataset):
+        """
+        Sessions of dataset that are not (or no longer) in the store
+
+        dataset -- list of (feat_path, label_path), see data_io.prepare_dataset
+        """
+
+        return [session for session in dataset if not self.is_complete(session[0], session[1])]
+
+    def write(self, feat_path, label_path, embeddings, labels, boundary, dtype='float32'):
+        """
+        Save the embeddings of one session
+
+        embeddings -- [num_events, emb_dim]
+        labels -- event labels, [num_events,] or [num_events, 1]
+        boundary -- list of event (start, end) in the session
+        dtype -- float32 | float16
+        """
+
+        session_id = session_id_of(label_path)
+        emb_path, meta_path, index_path = self.paths(session_id)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        meta = np.zeros((embeddings.shape[0],), dtype=META_DTYPE)
+        meta['session_id'] = session_id
+        meta['start'] = [b[0] for b in boundary]
+        meta['end'] = [b[1] for b in boundary]
+        meta['label'] = np.reshape(labels, (-1,))
+
+        signature = self.signature(feat_path, label_path) if self.model_path is not None else None
+        _atomic_save(emb_path, lambda fout: np.save(fout, np.asarray(embeddings, dtype=dtype)))
+        _atomic_save(meta_path, lambda fout: np.save(fout, meta))
+        _atomic_save(index_path, lambda fout: pkl.dump({'signature': signature}, fout))
+
+    def open_session(self, session_id):
+        """
+        Memory-mapped (embeddings, meta) of one session
+        """
+
+        emb_path, meta_path, _ = self.paths(session_id)
+        return np.load(emb_path, mmap_mode='r'), np.load(meta_path)
+
+    def load(self, sessions=None, dtype='float32'):
+        """
+        Embeddings and metadata of a list of sessions, concatenated in order
+
+        sessions -- list of session ids, all sessions in the store if None
+        return embeddings [N, emb_dim], meta [N,]
+        """
+
+        if sessions is None:
+            sessions = self.sessions()
+        embeddings = []
+        meta = []
+        for session_id in sessions:
+            emb, m = self.open_session(session_id)
+            embeddings.append(emb)
+            meta.append(m)
+        return np.concatenate(embeddings, axis=0).astype(dtype), np.concatenate(meta, axis=0)
+
+def _load_sessions(dataset, preprocess_func, transfer, loaded):
+    """
+    Background loader, puts (session, (events, labels, boundary)) to the queue loaded, then None
+    """
+
+    try:
+        for session in dataset:
+            loaded.put((session, load_data_and_label(session[0], session[1], preprocess_func, transfer=transfer)))
+    except Exception as e:
+        loaded.put(e)
+        return
+    loaded.put(None)
+
+def embed_sessions(stores, run_func, dataset, preprocess_func, transfer=True, batch_size=None, dtype='float32', recompute=False, prefetch=2):
+    """
+    Compute and store the embeddings of the sessions missing from any of the stores
+
+    Events of consecutive sessions are packed into batches of batch_size (the
+    last one may be smaller), while the next sessions are loaded and
+    preprocessed in a background thread. The embeddings are in the same order
+    as embedding each session on its own.
+
+    stores -- list of EmbeddingStore, one per output of run_func
+    run_func -- function mapping a batch of preprocessed events to a list of embeddings (one per store)
+    dataset -- list of (feat_path, label_path)
+    preprocess_func -- preprocessing of each event, e.g. model.prepare_input_test
+    batch_size -- number of events per run_func call, one call per session if None
+    recompute -- embed all sessions of dataset, even if they are in the stores
+    prefetch -- number of sessions loaded ahead of the inference
+    return number of events embedded, total run time
+    """
+
+    if recompute:
+        todo = dataset
+    else:
+        todo = [session for session in dataset if any([not s.is_complete(session[0], session[1]) for s in stores])]
+    if len(todo) == 0:
+        return 0, 0.0
+
+    start_time = time.time()
+    loaded = Queue(maxsize=prefetch)
+    loader = threading.Thread(target=_load_sessions, args=(todo, preprocess_func, transfer, loaded))
+    loader.daemon = True
+    loader.start()
+
+    # sessions whose embeddings are not complete yet, in order:
+    # [session, labels, boundary, number of embeddings still to come, outputs per store]
+    pending = deque()
+    latency = []
+
+    def run_batch(pieces):
+        batch = pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis=0)
+        batch_start = time.time()
+        outputs = run_func(batch)
+        latency.append(time.time() - batch_start)
+
+        # hand the rows of the batch back to their sessions
+        offset = 0
+        while offset < batch.shape[0]:
+            p = pending[0]
+            n = min(p[3], batch.shape[0] - offset)
+            for j, emb in enumerate(outputs):
+                p[4][j].append(emb[offset:offset+n])
+            p[3] -= n
+            offset += n
+            if p[3] == 0:
+                for s, emb in zip(stores, p[4]):
+                    s.write(p[0][0], p[0][1], np.concatenate(emb, axis=0), p[1], p[2], dtype)
+                pending.popleft()
+
+    count = 0
+    pieces = []
+    filled = 0
+    for i in range(len(todo)):
+        item = loaded.get()
+        if isinstance(item, Exception):
+            raise item
+        session, (eve_batch, lab_batch, boundary) = item
+        print ("Embed {0} / {1}: {2}".format(i, len(todo), session_id_of(session[1])))
+
+        num_events = eve_batch.shape[0]
+        pending.append([session, lab_batch, boundary, num_events, [[] for s in stores]])
+        count += num_events
+        if batch_size is None:
+            run_batch([eve_batch])
+            continue
+
+        start = 0
+        while start < num_events:
+            n = min(batch_size - filled, num_events - start)
+            pieces.append(eve_batch[start:start+n])
+            filled += n
+            start += n
+            if filled == batch_size:
+                run_batch(pieces)
+                pieces = []
+                filled = 0
+    if filled > 0:
+        run_batch(pieces)
+    loader.join()
+
+    duration = time.time() - start_time
+    latency = np.asarray(latency) * 1000
+    print ("%d events in %d batches, %.1f events/s, batch latency p50 = %.1f ms, p99 = %.1f ms" % (
+            count, latency.shape[0], count / duration, np.percentile(latency, 50), np.percentile(latency, 99)))
+
+    return count, duration
+
+def open_store(model_path, feat, label_type='goal', transfer=True, name='embedding', config=None):
+    return EmbeddingStore(store_root(model_path, feat, label_type, transfer, name), model_path, transfer, config)
@@ -8,19 +8,17 @@ sys.path.append('../')
 from configs.eval_config import EvalConfig
 import networks
 from utils import evaluate
-from data_io import load_data_and_label, prepare_dataset
+from data_io import prepare_dataset
+import embedding_store
 from preprocess.label_transfer import honda_num2labels
 import pdb
 
-def main():
-
-    cfg = EvalConfig().parse()
-    print ("Evaluate the model: {}".format(os.path.basename(cfg.model_path)))
-    np.random.seed(seed=cfg.seed)
-
-    test_session = cfg.test_session
-    test_set = prepare_dataset(cfg.feature_root, test_session, cfg.feat, cfg.label_root)
+def embed(cfg, dataset, stores):
+    """
+    Embed the sessions of dataset with the core branch and the hallucinated sensors branch
 
+    stores -- [core store, hallucination store]
+    """
 
     # get the embedding
     with tf.variable_scope("modality_core"):
@@ -56,9 +54,6 @@ def main():
         embedding = model_emb.hidden
         embedding_hal_sensors = hal_emb_sensors.hidden
 
-    embedding_fused = tf.concat((embedding, embedding_hal_sensors), axis=1)
-
-
     # Testing
     if cfg.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = cfg.gpu
@@ -73,24 +68,36 @@ def main():
         # load the model (note that model_path already contains snapshot number
         saver.restore(sess, cfg.model_path)
 
-        duration = 0.0
-        eve_embeddings = []
-        labels = []
-        for i, session in enumerate(test_set):
-            session_id = os.path.basename(session[1]).split('_')[0]
-            print ("{0} / {1}: {2}".format(i, len(test_set), session_id))
+        count, duration = embedding_store.embed_sessions(stores,
+                lambda eve_batch: sess.run([embedding, embedding_hal_sensors], feed_dict={input_ph: eve_batch, dropout_ph: 1.0}),
+                dataset, model_emb.prepare_input_test, batch_size=cfg.eval_batch_size, dtype=cfg.emb_dtype, recompute=cfg.recompute_embedding)
+    sess.close()
+
+    return count, duration
 
-            eve_batch, lab_batch, _ = load_data_and_label(session[0], session[1], model_emb.prepare_input_test)    # use prepare_input_test for testing time
+def main():
 
-            start_time = time.time()
-            emb = sess.run(embedding_fused, feed_dict={input_ph: eve_batch, dropout_ph: 1.0})
-            duration += time.time() - start_time
+    cfg = EvalConfig().parse()
+    print ("Evaluate the model: {}".format(os.path.basename(cfg.model_path)))
+    np.random.seed(seed=cfg.seed)
 
-            eve_embeddings.append(emb)
-            labels.append(lab_batch)
+    test_session = cfg.test_session
+    test_set = prepare_dataset(cfg.feature_root, test_session, cfg.feat, cfg.label_root)
 
-        eve_embeddings = np.concatenate(eve_embeddings, axis=0)
-        labels = np.concatenate(labels, axis=0)
+    # embeddings are computed once per checkpoint and read from the embedding store,
+    # the fused embedding is the concatenation of both branches
+    suffix = '' if cfg.normalized else '_hidden'
+    config = embedding_store.model_config(cfg, ['network', 'num_seg', 'emb_dim', 'normalized', 'emb_dtype'])
+    stores = [embedding_store.open_store(cfg.model_path, cfg.feat, name='core'+suffix, config=config),
+              embedding_store.open_store(cfg.model_path, cfg.feat, name='hal_sensors'+suffix, config=config)]
+    num_embedded, duration = 0, 0.0
+    if cfg.recompute_embedding or any([len(store.missing(test_set)) > 0 for store in stores]):
+        num_embedded, duration = embed(cfg, test_set, stores)
+
+    core_embeddings, meta = stores[0].load(test_session)
+    hal_embeddings, _ = stores[1].load(test_session)
+    eve_embeddings = np.concatenate((core_embeddings, hal_embeddings), axis=1)
+    labels = meta['label'].reshape(-1,1)
 
     # evaluate the results
     mAP, mAP_event, mPrec, confusion, count, recall = evaluate(eve_embeddings, np.squeeze(labels))
@@ -100,7 +107,7 @@ def main():
         mAP_macro += mAP_event[key]
     mAP_macro /= len(list(mAP_event.keys()))
 
-    print ("%d events with dim %d for evaluation, run time: %.3f." % (labels.shape[0], eve_embeddings.shape[1], duration))
+    print ("%d events with dim %d for evaluation, %d embedded, run time: %.3f." % (labels.shape[0], eve_embeddings.shape[1], num_embedded, duration))
     print ("mAP = {:.4f}".format(mAP))
     print ("mAP_macro = {:.4f}".format(mAP_macro))
     print ("mPrec@0.5 = {:.4f}".format(mPrec))
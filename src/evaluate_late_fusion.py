@@ -8,16 +8,16 @@ sys.path.append('../')
 from configs.eval_config import EvalConfig
 import networks
 from utils import evaluate
-from data_io import load_data_and_label, prepare_dataset
+from data_io import prepare_dataset
+import embedding_store
 from preprocess.label_transfer import honda_num2labels
 
-def main():
+def embed(cfg, dataset, stores):
+    """
+    Embed the sessions of dataset with the core model (model_path) and the sensors model (sensors_path)
 
-    cfg = EvalConfig().parse()
-    np.random.seed(seed=cfg.seed)
-
-    test_session = cfg.test_session
-    test_set = prepare_dataset(cfg.feature_root, test_session, cfg.feat, cfg.label_root)
+    stores -- [core store, sensors store]
+    """
 
     ####################### Load models here ########################
 
@@ -81,7 +81,6 @@ def main():
     gpu_options = tf.GPUOptions(allow_growth=True)
     sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
 
-    saver = tf.train.Saver()
     with sess.as_default():
         sess.run(tf.global_variables_initializer())
 
@@ -91,25 +90,34 @@ def main():
         restore_saver_sensors.restore(sess, cfg.sensors_path)
         print ("Restoring the model: {}".format(os.path.basename(cfg.sensors_path)))
 
-        eve_embeddings = []
-        sensors_embeddings = []
-        labels = []
-        for i, session in enumerate(test_set):
-            session_id = os.path.basename(session[1]).split('_')[0]
-            print ("{0} / {1}: {2}".format(i, len(test_set), session_id))
+        embedding_store.embed_sessions(stores,
+                lambda eve_batch: sess.run([embedding, embedding_sensors], feed_dict={input_ph: eve_batch, dropout_ph: 1.0}),
+                dataset, model_emb.prepare_input_test, batch_size=cfg.eval_batch_size, dtype=cfg.emb_dtype, recompute=cfg.recompute_embedding)
+    sess.close()
 
-            eve_batch, lab_batch, _ = load_data_and_label(session[0], session[1], model_emb.prepare_input_test)    # use prepare_input_test for testing time
+def main():
 
-            emb, emb_s = sess.run([embedding, embedding_sensors], 
-                    feed_dict={input_ph: eve_batch, dropout_ph: 1.0})
+    cfg = EvalConfig().parse()
+    np.random.seed(seed=cfg.seed)
 
-            eve_embeddings.append(emb)
-            sensors_embeddings.append(emb_s)
-            labels.append(lab_batch)
+    test_session = cfg.test_session
+    test_set = prepare_dataset(cfg.feature_root, test_session, cfg.feat, cfg.label_root)
 
-        eve_embeddings = np.concatenate(eve_embeddings, axis=0)
-        sensors_embeddings = np.concatenate(sensors_embeddings, axis=0)
-        labels = np.concatenate(labels, axis=0)
+    # embeddings are computed once per checkpoint and read from the embedding store
+    if cfg.use_output:
+        sensors_name = 'output' if cfg.normalized else 'logits'
+    else:
+        sensors_name = 'embedding'
+    config = embedding_store.model_config(cfg, ['network', 'num_seg', 'emb_dim', 'emb_dtype'])
+    sensors_config = embedding_store.model_config(cfg, ['network', 'num_seg', 'emb_dim', 'use_output', 'normalized', 'emb_dtype'])
+    stores = [embedding_store.open_store(cfg.model_path, cfg.feat, name='core', config=config),
+              embedding_store.open_store(cfg.sensors_path, cfg.feat, name=sensors_name, config=sensors_config)]
+    if cfg.recompute_embedding or any([len(store.missing(test_set)) > 0 for store in stores]):
+        embed(cfg, test_set, stores)
+
+    eve_embeddings, meta = stores[0].load(test_session)
+    sensors_embeddings, _ = stores[1].load(test_session)
+    labels = meta['label'].reshape(-1,1)
 
     # evaluate the results
     fused_embeddings = np.concatenate((eve_embeddings, sensors_embeddings), axis=1)
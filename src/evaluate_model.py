@@ -1,15 +1,13 @@
 import sys
 import os
-import tensorflow as tf
 import numpy as np
 import pickle as pkl
-import time
 
 sys.path.append('../')
 from configs.eval_config import EvalConfig
-import networks
-from utils import evaluate, mean_pool_input
-from data_io import load_data_and_label, prepare_dataset
+from utils import evaluate
+from data_io import prepare_dataset
+from embed import embed
 from preprocess.label_transfer import honda_num2labels, stimuli_num2labels
 import pdb
 
@@ -22,71 +20,10 @@ def main():
     test_session = cfg.test_session
     test_set = prepare_dataset(cfg.feature_root, test_session, cfg.feat, cfg.label_root, cfg.label_type)
 
-    # load backbone model
-    if cfg.network == "tsn":
-        model = networks.TSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim)
-    elif cfg.network == "rtsn":
-        model = networks.RTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim, n_input=cfg.n_input)
-    elif cfg.network == "convtsn":
-        model = networks.ConvTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim)
-    elif cfg.network == "convrtsn":
-        model = networks.ConvRTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim, n_h=cfg.n_h, n_w=cfg.n_w, n_C=cfg.n_C, n_input=cfg.n_input)
-    elif cfg.network == "seq2seqtsn":
-        model = networks.Seq2seqTSN(n_seg=cfg.num_seg, n_input=n_input, emb_dim=cfg.emb_dim, reverse=cfg.reverse)
-    elif cfg.network == "convbirtsn":
-        model = networks.ConvBiRTSN(n_seg=cfg.num_seg, emb_dim=cfg.emb_dim)
-    else:
-        raise NotImplementedError
-
-
-    # get the embedding
-    if cfg.feat == "sensors" or cfg.feat == "segment":
-        input_ph = tf.placeholder(tf.float32, shape=[None, cfg.num_seg, None])
-    elif cfg.feat == "resnet" or cfg.feat == "segment_down":
-        input_ph = tf.placeholder(tf.float32, shape=[None, cfg.num_seg, None, None, None])
-    dropout_ph = tf.placeholder(tf.float32, shape=[])
-    model.forward(input_ph, dropout_ph)
-    embedding = tf.nn.l2_normalize(model.hidden, axis=1, epsilon=1e-10, name='embedding')
-
-    # Testing
-    if cfg.gpu:
-        os.environ['CUDA_VISIBLE_DEVICES'] = cfg.gpu
-
-    gpu_options = tf.GPUOptions(allow_growth=True)
-    sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
-
-    # restore variables
-    var_list = {}
-    for v in tf.global_variables():
-        var_list[cfg.variable_name+v.op.name] = v
-
-    saver = tf.train.Saver(var_list)
-    with sess.as_default():
-        sess.run(tf.global_variables_initializer())
-
-        # load the model (note that model_path already contains snapshot number
-        saver.restore(sess, cfg.model_path)
-
-        duration = 0.0
-        eve_embeddings = []
-        labels = []
-        for i, session in enumerate(test_set):
-            session_id = os.path.basename(session[1]).split('_')[0]
-            print ("{0} / {1}: {2}".format(i, len(test_set), session_id))
-
-#            eve_batch, lab_batch, _ = load_data_and_label(session[0], session[1], mean_pool_input, transfer=cfg.transfer)    # use prepare_input_test for testing time
-            eve_batch, lab_batch, _ = load_data_and_label(session[0], session[1], model.prepare_input_test, transfer=cfg.transfer)    # use prepare_input_test for testing time
-
-            start_time = time.time()
-            emb = sess.run(embedding, feed_dict={input_ph: eve_batch, dropout_ph: 1.0})
-#            emb = eve_batch
-            duration += time.time() - start_time
-
-            eve_embeddings.append(emb)
-            labels.append(lab_batch)
-
-        eve_embeddings = np.concatenate(eve_embeddings, axis=0)
-        labels = np.concatenate(labels, axis=0)
+    # embeddings are computed once per checkpoint and read from the embedding store
+    store, num_embedded, duration = embed(cfg, test_set)
+    eve_embeddings, meta = store.load(test_session)
+    labels = meta['label'].reshape(-1,1)
 
     # evaluate the results
     mAP, mAP_event, mPrec, confusion, count, recall = evaluate(eve_embeddings, np.squeeze(labels))
@@ -96,7 +33,7 @@ def main():
         mAP_macro += mAP_event[key]
     mAP_macro /= len(list(mAP_event.keys()))
 
-    print ("%d events with dim %d for evaluation, run time: %.3f." % (labels.shape[0], eve_embeddings.shape[1], duration))
+    print ("%d events with dim %d for evaluation, %d embedded, run time: %.3f." % (labels.shape[0], eve_embeddings.shape[1], num_embedded, duration))
     print ("mAP = {:.4f}".format(mAP))
     print ("mAP_macro = {:.4f}".format(mAP_macro))
     print ("mPrec@0.5 = {:.4f}".format(mPrec))
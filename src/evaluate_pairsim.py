@@ -35,8 +35,7 @@ def select_triplets(lab, eve_embedding, triplet_per_batch, alpha=0.2, num_negati
     """
 
     # get distance for all pairs
-    all_diff = utils.all_diffs(eve_embedding, eve_embedding)
-    all_dist = utils.cdist(all_diff, metric=metric)
+    all_dist = utils.pairwise_dist(eve_embedding, metric=metric)
 
     idx_dict = {}
     for i, l in enumerate(lab):
@@ -0,0 +1,52 @@
+"""
+Export the encoder of a checkpoint as a frozen inference graph (frozen_graph.py)
+
+python export_graph.py --model_path MODEL_DIR/model-XXX --feat resnet --network convtsn --variable_name modality_core/
+"""
+
+import sys
+import os
+import time
+import tensorflow as tf
+
+sys.path.append('../')
+from configs.eval_config import EvalConfig
+from embed import build_graph, restore
+from frozen_graph import freeze_graph, save_frozen, frozen_paths, FrozenEncoder
+
+def main():
+
+    cfg = EvalConfig().parse()
+    print ("Export the model: {}".format(os.path.basename(cfg.model_path)))
+
+    # keep_prob is a constant, so dropout is folded away
+    keep_prob = tf.constant(1.0, dtype=tf.float32, name='keep_prob')
+    model, input_ph, embedding = build_graph(cfg, keep_prob)
+
+    if cfg.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = cfg.gpu
+
+    gpu_options = tf.GPUOptions(allow_growth=True)
+    sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+    with sess.as_default():
+        restore(cfg, sess)
+        num_nodes = len(sess.graph.as_graph_def().node)
+        graph_def = freeze_graph(sess)
+    sess.close()
+
+    save_frozen(graph_def, {'n_seg': cfg.num_seg,
+                            'feat': cfg.feat,
+                            'feat_shape': cfg.feat_dim.get(cfg.feat),
+                            'emb_dim': cfg.emb_dim,
+                            'network': cfg.network,
+                            'model_path': cfg.model_path}, cfg.model_path)
+    print ("Frozen graph: {} ({} nodes, {} before freezing)".format(frozen_paths(cfg.model_path)[0], len(graph_def.node), num_nodes))
+
+    # cold start of the frozen graph
+    start_time = time.time()
+    encoder = FrozenEncoder(cfg.model_path, cfg.gpu)
+    print ("Loaded in %.3f s" % (time.time() - start_time))
+    encoder.close()
+
+if __name__ == "__main__":
+    main()
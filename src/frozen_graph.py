@@ -0,0 +1,111 @@
+"""
+Frozen inference graphs of the embedding encoders
+
+A frozen graph holds the encoder and the L2 normalization with the variables
+folded into constants and keep_prob fixed to 1.0. Its only input is the
+'input' placeholder and its only output the 'embedding' tensor, so it can be
+loaded without the model classes in networks.py or the training checkpoint.
+Written by export_graph.py next to the checkpoint:
+    <model_path>_frozen.pb    GraphDef
+    <model_path>_frozen.pkl    {'n_seg', 'feat', 'feat_shape', 'emb_dim', 'network', 'model_path'}
+"""
+
+import os
+import functools
+import pickle as pkl
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from utils import tsn_prepare_input_test
+
+INPUT_NAME = 'input'
+OUTPUT_NAME = 'embedding'
+
+def frozen_paths(model_path):
+    return model_path+'_frozen.pb', model_path+'_frozen.pkl'
+
+def freeze_graph(sess, output_names=[OUTPUT_NAME]):
+    """
+    Frozen and pruned GraphDef of the current graph of sess
+
+    Variables become constants, nodes not needed for output_names and
+    training-only nodes are removed, then constants are folded.
+    """
+
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+
+    return TransformGraph(graph_def, [INPUT_NAME], output_names,
+                          ['strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'fold_batch_norms'])
+
+def save_frozen(graph_def, info, model_path):
+    """
+    Write the frozen graph and its info next to the checkpoint
+    """
+
+    for path, save_func in zip(frozen_paths(model_path),
+                               [lambda fout: fout.write(graph_def.SerializeToString()),
+                                lambda fout: pkl.dump(info, fout)]):
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fout:
+            save_func(fout)
+        os.rename(tmp_path, path)
+
+class FrozenEncoder(object):
+    """
+    Embedding encoder loaded from a frozen graph
+    """
+
+    def name(self):
+        return "FrozenEncoder"
+
+    def __init__(self, model_path, gpu=None):
+        """
+        model_path -- checkpoint path the graph was exported from, see frozen_paths
+        gpu -- set CUDA_VISIBLE_DEVICES if given, CPU only if ''
+        """
+
+        graph_path, info_path = frozen_paths(model_path)
+        self.info = pkl.load(open(info_path, 'rb'))
+        self.n_seg = self.info['n_seg']
+        self.feat_shape = self.info.get('feat_shape')    # None for graphs exported without it
+        self.prepare_input_test = functools.partial(tsn_prepare_input_test, self.n_seg)
+
+        graph_def = tf.GraphDef()
+        with open(graph_path, 'rb') as fin:
+            graph_def.ParseFromString(fin.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.input = self.graph.get_tensor_by_name(INPUT_NAME+':0')
+        self.embedding = self.graph.get_tensor_by_name(OUTPUT_NAME+':0')
+
+        if gpu is not None:
+            os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+        gpu_options = tf.GPUOptions(allow_growth=True)
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(gpu_options=gpu_options))
+
+    def check_input(self, feat):
+        """
+        Raise ValueError if feat, [time_steps, (dims)], does not fit the input of the graph
+        """
+
+        ndims = self.input.shape.ndims
+        if ndims is not None and feat.ndim != ndims - 1:
+            raise ValueError("Features must have {} dimensions, got shape {}".format(ndims-1, feat.shape))
+        if self.feat_shape is not None and tuple(feat.shape[1:]) != tuple(self.feat_shape):
+            raise ValueError("Features must have shape [time_steps, {}], got {}".format(
+                    ", ".join(str(d) for d in self.feat_shape), feat.shape))
+        if feat.shape[0] == 0:
+            raise ValueError("Features have no time steps")
+
+    def run(self, eve_batch):
+        """
+        Embeddings of a batch of preprocessed events, [N, emb_dim]
+        """
+
+        return self.sess.run(self.embedding, feed_dict={self.input: eve_batch})
+
+    def close(self):
+        self.sess.close()
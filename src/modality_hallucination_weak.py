@@ -111,10 +111,8 @@ def main():
         emb_var = tf.Variable([0.0], name='embeddings')
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
-        # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
-        tf.summary.histogram('embedding_dists', all_dist)
+        # calculated for monitoring all-pair embedding distance, fetched every summary_steps steps
+        dist_summ = utils.dist_summary_tf(embedding)
 
         # split embedding into anchor, positive and negative and calculate triplet loss
         anchor, positive, negative = tf.unstack(tf.reshape(embedding, [-1,3,cfg.emb_dim]), 3, 1)
@@ -156,7 +154,7 @@ def main():
         feat_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         feat2_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input])
+        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input], prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -291,11 +289,13 @@ def main():
 
     
                         ##################### Start training  ########################
+                        # embedding_dists histogram only every summary_steps steps
+                        summary_ops = [summary_op, dist_summ] if step % cfg.summary_steps == 0 else [summary_op]
     
                         # supervised initialization
                         if epoch < cfg.multimodal_epochs:
                             err, metric_err, hal_err, _, step, summ = sess.run(
-                                    [total_loss, metric_loss, hal_loss, train_op, global_step, summary_op],
+                                    [total_loss, metric_loss, hal_loss, train_op, global_step, summary_ops],
                                     feed_dict = {input_ph: triplet_input,
                                                 input_sensors_ph: sensors_input,
                                                 dropout_ph: cfg.keep_prob,
@@ -307,7 +307,7 @@ def main():
                             # supervised training if labeled sessions available
                             if len(eve_labeled):
                                 err, metric_err, hal_err, _, step, summ = sess.run(
-                                        [total_loss, metric_loss, hal_loss, train_op, global_step, summary_op],
+                                        [total_loss, metric_loss, hal_loss, train_op, global_step, summary_ops],
                                         feed_dict = {input_ph: triplet_input,
                                                     input_sensors_ph: sensors_input,
                                                     dropout_ph: cfg.keep_prob,
@@ -319,7 +319,7 @@ def main():
                             if len(eve_labeled):
                                 sess.run(subtract_global_step_op)
                             err, metric_err, hal_err, _, step, summ = sess.run(
-                                    [total_loss, metric_loss, hal_loss, train_op, global_step, summary_op],
+                                    [total_loss, metric_loss, hal_loss, train_op, global_step, summary_ops],
                                     feed_dict = {input_ph: all_triplet_input,
                                                 input_sensors_ph: all_sensors_input,
                                                 dropout_ph: cfg.keep_prob,
@@ -337,7 +337,8 @@ def main():
                                     tf.Summary.Value(tag="hallucination_loss", simple_value=hal_err)])
     
                         summary_writer.add_summary(summary, step)
-                        summary_writer.add_summary(summ, step)
+                        for summary_str in summ:
+                            summary_writer.add_summary(summary_str, step)
 
                         batch_count += 1
                     
@@ -235,10 +235,8 @@ def main():
         emb_var = tf.Variable([0.0], name='embeddings')
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
-        # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
-        tf.summary.histogram('embedding_dists', all_dist)
+        # calculated for monitoring all-pair embedding distance, fetched every summary_steps steps
+        dist_summ = utils.dist_summary_tf(embedding)
 
         # split embedding into anchor, positive and negative and calculate triplet loss
         anchor, positive, negative = tf.unstack(tf.reshape(embedding[:(tf.shape(embedding)[0]-mul_num_ph)], [-1,3,cfg.emb_dim]), 3, 1)
@@ -265,6 +263,11 @@ def main():
         prob_AB = 0.5 * (pddm_AB_sensors + pddm_AB_segment)
         prob_AC = 0.5 * (pddm_AC_sensors + pddm_AC_segment)
 
+        # similarity of all pairs from embeddings computed once per event
+        model_pairsim_sensors.forward_all_pairs(emb_sensors)
+        model_pairsim_segment.forward_all_pairs(emb_segment)
+        prob_all = 0.5 * (model_pairsim_sensors.pair_prob + model_pairsim_segment.pair_prob)
+
         ############################# Calculate loss #############################
 
         # triplet loss for labeled inputs
@@ -314,7 +317,7 @@ def main():
         feat2_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         feat3_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, feat3_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input, model_emb_segment.prepare_input])
+        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, feat3_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input, model_emb_segment.prepare_input], prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -387,8 +390,7 @@ def main():
             dist_dict = {}
             for i in range(np.max(val_labels)+1):
                 temp_emb = val_embeddings[np.where(val_labels==i)[0]]
-                dist_dict[i] = [np.mean(utils.cdist(utils.all_diffs(temp_emb, temp_emb),
-                                    metric=cfg.metric))]
+                dist_dict[i] = [np.mean(utils.pairwise_dist(temp_emb, metric=cfg.metric))]
 
             epoch = -1
             while epoch < cfg.max_epochs-1:
@@ -448,8 +450,8 @@ def main():
                             eve_embedding[start:end] = np.copy(emb)
     
                         # sample triplets within sampled sessions
-                        all_diff = utils.all_diffs(eve_embedding, eve_embedding)
-                        triplet_input_idx, active_count = utils.select_triplets_facenet(lab,utils.cdist(all_diff,metric=cfg.metric),cfg.triplet_per_batch,cfg.alpha,num_negative=cfg.num_negative)
+                        all_dist = utils.pairwise_dist(eve_embedding, metric=cfg.metric)
+                        triplet_input_idx, active_count = utils.select_triplets_facenet(lab,all_dist,cfg.triplet_per_batch,cfg.alpha,num_negative=cfg.num_negative)
                         if len(triplet_input_idx) == 0:
                             continue
 
@@ -458,21 +460,30 @@ def main():
                         struct_count = 0
                         if epoch >= cfg.multimodal_epochs:
                             # Get the similarity of all events
-                            sim_prob = np.zeros((eve.shape[0], eve.shape[0]), dtype='float32')*np.nan
-                            comb = list(itertools.combinations(range(eve.shape[0]), 2))
-                            for start, end in zip(range(0, len(comb), cfg.batch_size),
-                                                range(cfg.batch_size, len(comb)+cfg.batch_size, cfg.batch_size)):
-                                end = min(end, len(comb))
-                                comb_idx = []
-                                for c in comb[start:end]:
-                                    comb_idx.extend([c[0], c[1], c[1]])
-                                sim = sess.run(prob_AB, feed_dict={
-                                                input_sensors_ph: eve_sensors[comb_idx],
-                                                input_segment_ph: eve_segment[comb_idx],
+                            if cfg.pair_sim == 'cached':
+                                sim_prob = sess.run(prob_all, feed_dict={
+                                                input_sensors_ph: eve_sensors,
+                                                input_segment_ph: eve_segment,
                                                 dropout_ph: 1.0})
-                                for i in range(sim.shape[0]):
-                                    sim_prob[comb[start+i][0], comb[start+i][1]] = sim[i]
-                                    sim_prob[comb[start+i][1], comb[start+i][0]] = sim[i]
+                                # symmetric as the pairwise version, similarity to itself is not defined
+                                sim_prob = np.triu(sim_prob, 1) + np.triu(sim_prob, 1).T
+                                np.fill_diagonal(sim_prob, np.nan)
+                            else:
+                                sim_prob = np.zeros((eve.shape[0], eve.shape[0]), dtype='float32')*np.nan
+                                comb = list(itertools.combinations(range(eve.shape[0]), 2))
+                                for start, end in zip(range(0, len(comb), cfg.batch_size),
+                                                    range(cfg.batch_size, len(comb)+cfg.batch_size, cfg.batch_size)):
+                                    end = min(end, len(comb))
+                                    comb_idx = []
+                                    for c in comb[start:end]:
+                                        comb_idx.extend([c[0], c[1], c[1]])
+                                    sim = sess.run(prob_AB, feed_dict={
+                                                    input_sensors_ph: eve_sensors[comb_idx],
+                                                    input_segment_ph: eve_segment[comb_idx],
+                                                    dropout_ph: 1.0})
+                                    for i in range(sim.shape[0]):
+                                        sim_prob[comb[start+i][0], comb[start+i][1]] = sim[i]
+                                        sim_prob[comb[start+i][1], comb[start+i][0]] = sim[i]
 
                             # sample triplets from similarity prediction
                             # maximum number not exceed the cfg.triplet_per_batch
@@ -495,13 +506,15 @@ def main():
                             pdb.set_trace()
     
                         ##################### Start training  ########################
+                        # embedding_dists histogram only every summary_steps steps
+                        summary_ops = [summary_op, dist_summ] if step % cfg.summary_steps == 0 else [summary_op]
 
                         # supervised initialization
                         if multimodal_count == 0:
                             if triplet_count == 0:
                                 continue
                             err, metric_err1,  _, step, summ = sess.run(
-                                    [total_loss, metric_loss1, train_op, global_step, summary_op],
+                                    [total_loss, metric_loss1, train_op, global_step, summary_ops],
                                     feed_dict = {input_ph: triplet_input,
                                                  dropout_ph: cfg.keep_prob,
                                                  mul_num_ph: 0,
@@ -510,7 +523,7 @@ def main():
                             metric_err3 = 0
                         else:
                             err, metric_err1, metric_err2, metric_err3, _, step, summ, s_AB, s_AC = sess.run(
-                                    [total_loss, metric_loss1, metric_loss2, metric_loss3, train_op, global_step, summary_op, summ_prob_AB, summ_prob_AC],
+                                    [total_loss, metric_loss1, metric_loss2, metric_loss3, train_op, global_step, summary_ops, summ_prob_AB, summ_prob_AC],
                                     feed_dict = {input_ph: triplet_input,
                                                  input_sensors_ph: sensors_input,
                                                  input_segment_ph: segment_input,
@@ -535,7 +548,8 @@ def main():
                                     tf.Summary.Value(tag="metric_loss2", simple_value=metric_err2)])
     
                         summary_writer.add_summary(summary, step)
-                        summary_writer.add_summary(summ, step)
+                        for summary_str in summ:
+                            summary_writer.add_summary(summary_str, step)
 
                         batch_count += 1
                     
@@ -567,8 +581,7 @@ def main():
                 if (epoch+1) == 50 or (epoch+1) % 200 == 0:
                     for i in dist_dict.keys():
                         temp_emb = val_embeddings[np.where(val_labels==i)[0]]
-                        dist_dict[i].append(np.mean(utils.cdist(utils.all_diffs(temp_emb, temp_emb),
-                                        metric=cfg.metric)))
+                        dist_dict[i].append(np.mean(utils.pairwise_dist(temp_emb, metric=cfg.metric)))
 
                     pickle.dump(dist_dict, open(os.path.join(result_dir, 'dist_dict.pkl'), 'wb'))
 
@@ -211,10 +211,8 @@ def main():
         emb_var = tf.Variable([0.0], name='embeddings')
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
-        # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
-        tf.summary.histogram('embedding_dists', all_dist)
+        # calculated for monitoring all-pair embedding distance, fetched every summary_steps steps
+        dist_summ = utils.dist_summary_tf(embedding)
 
         # split embedding into anchor, positive and negative and calculate triplet loss
         anchor, positive, negative = tf.unstack(tf.reshape(embedding, [-1,3,cfg.emb_dim]), 3, 1)
@@ -275,7 +273,7 @@ def main():
         feat_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         feat2_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input])
+        train_data = multimodal_session_generator(feat_paths_ph, feat2_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=[model_emb.prepare_input, model_emb_sensors.prepare_input], prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -429,18 +427,20 @@ def main():
                             pdb.set_trace()
     
                         ##################### Start training  ########################
+                        # embedding_dists histogram only every summary_steps steps
+                        summary_ops = [summary_op, dist_summ] if step % cfg.summary_steps == 0 else [summary_op]
     
                         # be careful that for multimodal_count = 0 we just optimize unimodal part
                         if epoch < cfg.multimodal_epochs or multimodal_count == 0:
                             err, metric_err, _, step, summ = sess.run(
-                                [unimodal_loss, metric_loss1, unimodal_train_op, global_step, summary_op],
+                                [unimodal_loss, metric_loss1, unimodal_train_op, global_step, summary_ops],
                                 feed_dict = {input_ph: triplet_input,
                                              dropout_ph: cfg.keep_prob,
                                              lr_ph: learning_rate})
                             mul_err = 0.0
                         else:
                             err, w, metric_err, mul_err, _, step, summ, histo_w = sess.run(
-                                [multimodal_loss, weights, metric_loss2, weighted_metric_loss, multimodal_train_op, global_step, summary_op, summ_weights],
+                                [multimodal_loss, weights, metric_loss2, weighted_metric_loss, multimodal_train_op, global_step, summary_ops, summ_weights],
                                 feed_dict = {input_ph: triplet_input,
                                              input_sensors_ph: sensors_input,
                                              dropout_ph: cfg.keep_prob,
@@ -459,7 +459,8 @@ def main():
                                     tf.Summary.Value(tag="weghted_metric_loss", simple_value=mul_err)])
     
                         summary_writer.add_summary(summary, step)
-                        summary_writer.add_summary(summ, step)
+                        for summary_str in summ:
+                            summary_writer.add_summary(summary_str, step)
 
                         batch_count += 1
                     
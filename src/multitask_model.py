@@ -40,8 +40,7 @@ def select_triplets_facenet(eve, lab, eve_embedding, triplet_per_batch, alpha=0.
     """
 
     # get distance for all pairs
-    all_diff = utils.all_diffs(eve_embedding, eve_embedding)
-    all_dist = utils.cdist(all_diff, metric=metric)
+    all_dist = utils.pairwise_dist(eve_embedding, metric=metric)
 
     idx_dict = {}
     for i, l in enumerate(lab):
@@ -161,10 +160,8 @@ def main():
         emb_var = tf.Variable([0.0], name='embeddings')
         set_emb = tf.assign(emb_var, embedding, validate_shape=False)
 
-        # calculated for monitoring all-pair embedding distance
-        diffs = utils.all_diffs_tf(embedding, embedding)
-        all_dist = utils.cdist_tf(diffs)
-        tf.summary.histogram('embedding_dists', all_dist)
+        # calculated for monitoring all-pair embedding distance, fetched every summary_steps steps
+        dist_summ = utils.dist_summary_tf(embedding)
 
         # split embedding into anchor, positive and negative and calculate triplet loss
         anchor, positive, negative = tf.unstack(tf.reshape(embedding, [-1,3,cfg.emb_dim]), 3, 1)
@@ -199,7 +196,7 @@ def main():
         # session iterator for session sampling
         feat_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
         label_paths_ph = tf.placeholder(tf.string, shape=[None, cfg.sess_per_batch])
-        train_data = session_generator(feat_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=2, shuffled=False, preprocess_func=model_emb.prepare_input)
+        train_data = session_generator(feat_paths_ph, label_paths_ph, sess_per_batch=cfg.sess_per_batch, num_threads=cfg.num_threads, shuffled=False, preprocess_func=model_emb.prepare_input, prefetch=cfg.prefetch, seed=cfg.seed)
         train_sess_iterator = train_data.make_initializable_iterator()
         next_train = train_sess_iterator.get_next()
 
@@ -299,9 +296,11 @@ def main():
 
                         if triplet_input is not None:
                             start_time_train = time.time()
+                            # embedding_dists histogram only every summary_steps steps
+                            summary_ops = [summary_op, dist_summ] if step % cfg.summary_steps == 0 else [summary_op]
                             # perform training on the selected triplets
                             err, metric_err, ver_err, y_pred, _, step, summ = sess.run(
-                                    [total_loss, metric_loss, ver_loss, pred, train_op, global_step, summary_op],
+                                    [total_loss, metric_loss, ver_loss, pred, train_op, global_step, summary_ops],
                                     feed_dict = {input_ph: triplet_input,
                                                 dropout_ph: cfg.keep_prob,
                                                 lr_ph: learning_rate})
@@ -321,7 +320,8 @@ def main():
                                 tf.Summary.Value(tag="acc", simple_value=acc),
                                 tf.Summary.Value(tag="negative_count", simple_value=negative_count)])
                             summary_writer.add_summary(summary, step)
-                            summary_writer.add_summary(summ, step)
+                            for summary_str in summ:
+                                summary_writer.add_summary(summary_str, step)
 
                         batch_count += 1
                     
@@ -318,6 +318,41 @@ class PDDM(object):
         self.logits = tf.nn.xw_plus_b(c, self.W_s, self.b_s)
         self.prob = tf.nn.softmax(self.logits)
 
+    def forward_all_pairs(self, x, tile_size=64):
+        """
+        Similarity of all pairs of samples, same as forward on each pair
+        Pairs are evaluated in tiles of [tile_size, N] to bound memory
+
+        x -- features, [N, n_input]
+        Output: self.pair_prob, probability of being similar, [N, N]
+        """
+
+        N = tf.shape(x)[0]
+        num_tiles = (N + tile_size - 1) // tile_size
+        pad = num_tiles * tile_size - N
+
+        # v = 0.5 * (x_i + x_j) is linear, so project each sample only once
+        xv = tf.matmul(x, self.W_v)
+
+        x_tiles = tf.reshape(tf.pad(x, [[0, pad], [0, 0]]), [num_tiles, tile_size, self.n_input])
+        xv_tiles = tf.reshape(tf.pad(xv, [[0, pad], [0, 0]]), [num_tiles, tile_size, self.n_input])
+
+        def _tile_prob(inputs):
+            x_t, xv_t = inputs
+
+            u = tf.reshape(tf.abs(tf.expand_dims(x_t, 1) - tf.expand_dims(x, 0)), [-1, self.n_input])
+            v = tf.reshape(0.5 * (tf.expand_dims(xv_t, 1) + tf.expand_dims(xv, 0)), [-1, self.n_input])
+
+            uu = tf.nn.l2_normalize(tf.nn.relu(tf.nn.xw_plus_b(u, self.W_u, self.b_u)), axis=-1,epsilon=1e-10)
+            vv = tf.nn.l2_normalize(tf.nn.relu(v + self.b_v), axis=-1,epsilon=1e-10)
+
+            c = tf.nn.relu(tf.nn.xw_plus_b(tf.concat((uu,vv), axis=1), self.W_c, self.b_c))
+            logits = tf.nn.xw_plus_b(c, self.W_s, self.b_s)
+            return tf.reshape(tf.nn.softmax(logits)[:, 1], [tile_size, N])
+
+        prob = tf.map_fn(_tile_prob, (x_tiles, xv_tiles), dtype=tf.float32)
+        self.pair_prob = tf.reshape(prob, [-1, N])[:N]
+
 
 class OutputLayer(object):
     def name(self):
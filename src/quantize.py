@@ -0,0 +1,180 @@
+"""
+Compressed storage of event embeddings for retrieval
+
+Codecs:
+    float16 -- half precision, 2 bytes per dimension
+    int8 -- symmetric per-dimension scale, 1 byte per dimension
+    pq -- product quantization, the vector is split into m sub-vectors, each
+          coded by the id of its nearest of 2^nbits k-means centroids (m bytes)
+Distances are asymmetric (ADC): float32 queries against coded database
+vectors, euclidean as in utils.retrieve, so the queries are never quantized.
+"""
+
+import numpy as np
+
+from distance import pairwise_dist
+from ann_index import kmeans
+
+MAX_MEMORY = 2**28    # bytes of decoded database vectors held at once
+
+class Float16Codec(object):
+
+    def name(self):
+        return "float16"
+
+    def train(self, x):
+        pass
+
+    def encode(self, x):
+        return np.asarray(x, dtype='float16')
+
+    def decode(self, codes):
+        return codes.astype('float32')
+
+    def code_size(self, dim):
+        return 2 * dim
+
+    def state(self):
+        return {}
+
+    def adc_dist(self, queries, codes):
+        return _decoded_dist(self, queries, codes)
+
+class Int8Codec(object):
+    """
+    x ~= scale * code, code in [-127, 127], one scale per dimension
+    """
+
+    def name(self):
+        return "int8"
+
+    def __init__(self):
+        self.scale = None
+
+    def train(self, x):
+        self.scale = np.max(np.abs(x), axis=0).astype('float32') / 127.
+        self.scale[self.scale == 0] = 1.
+
+    def encode(self, x):
+        return np.clip(np.round(x / self.scale), -127, 127).astype('int8')
+
+    def decode(self, codes):
+        return codes.astype('float32') * self.scale
+
+    def code_size(self, dim):
+        return dim
+
+    def state(self):
+        return {'scale': self.scale}
+
+    def adc_dist(self, queries, codes):
+        return _decoded_dist(self, queries, codes)
+
+class PQCodec(object):
+    """
+    Product quantizer with m sub-quantizers of 2^nbits centroids each
+    """
+
+    def name(self):
+        return "pq{}".format(self.m) if self.nbits == 8 else "pq{}x{}".format(self.m, self.nbits)
+
+    def __init__(self, m=16, nbits=8):
+        self.m = m
+        self.nbits = nbits
+        self.ksub = 2 ** nbits
+        self.centroids = None    # [m, ksub, dim / m]
+
+    def _split(self, x):
+        if x.shape[1] % self.m != 0:
+            raise ValueError("Dimension {} is not divisible by m = {}".format(x.shape[1], self.m))
+        return x.reshape(x.shape[0], self.m, -1)
+
+    def train(self, x, niter=20, max_train=65536, seed=0):
+        """
+        k-means in each sub-space
+
+        max_train -- maximum number of training points (random subset)
+        """
+
+        if x.shape[0] > max_train:
+            x = x[np.random.RandomState(seed).choice(x.shape[0], max_train, replace=False)]
+        sub = self._split(np.asarray(x, dtype='float32'))
+        self.ksub = min(self.ksub, sub.shape[0])
+        self.centroids = np.stack([kmeans(np.ascontiguousarray(sub[:, j]), self.ksub, niter, seed)
+                                    for j in range(self.m)])
+
+    def encode(self, x, block_size=65536):
+        sub = self._split(np.asarray(x, dtype='float32'))
+        codes = np.zeros((sub.shape[0], self.m), dtype='uint8' if self.ksub <= 256 else 'uint16')
+        for start in range(0, sub.shape[0], block_size):
+            for j in range(self.m):
+                codes[start:start+block_size, j] = np.argmin(
+                        pairwise_dist(sub[start:start+block_size, j], self.centroids[j]), axis=1)
+        return codes
+
+    def decode(self, codes):
+        return np.stack([self.centroids[j][codes[:, j]] for j in range(self.m)], axis=1).reshape(codes.shape[0], -1)
+
+    def code_size(self, dim):
+        return self.m * np.dtype('uint8' if self.ksub <= 256 else 'uint16').itemsize
+
+    def state(self):
+        return {'m': self.m, 'ksub': self.ksub, 'centroids': self.centroids}
+
+    def adc_dist(self, queries, codes):
+        """
+        Distances through lookup tables: ||q - c||^2 is the sum over sub-spaces
+        of the squared distance between the query sub-vector and the centroid
+        """
+
+        sub = self._split(np.asarray(queries, dtype='float32'))
+        dist = np.zeros((sub.shape[0], codes.shape[0]), dtype='float32')
+        for j in range(self.m):
+            table = pairwise_dist(sub[:, j], self.centroids[j])    # [Q, ksub]
+            dist += table[:, codes[:, j]]
+        return np.sqrt(np.maximum(dist, 0))
+
+def _decoded_dist(codec, queries, codes):
+    """
+    Euclidean distances from float32 queries to the database, decoded block by block
+    """
+
+    queries = np.asarray(queries, dtype='float32')
+    dist = np.zeros((queries.shape[0], codes.shape[0]), dtype='float32')
+    block_size = max(1, MAX_MEMORY // (4 * queries.shape[1]))
+    for start in range(0, codes.shape[0], block_size):
+        end = min(start+block_size, codes.shape[0])
+        dist[:, start:end] = pairwise_dist(queries, codec.decode(codes[start:end]), metric='euclidean')
+    return dist
+
+def get_codec(name):
+    """
+    Codec by name: float16 | int8 | pq<m>, e.g. pq16, or pq<m>x<nbits>, e.g. pq32x4
+    """
+
+    if name == 'float16':
+        return Float16Codec()
+    elif name == 'int8':
+        return Int8Codec()
+    elif name.startswith('pq'):
+        spec = name[2:].split('x')
+        return PQCodec(int(spec[0]), int(spec[1]) if len(spec) > 1 else 8)
+    else:
+        raise NotImplementedError
+
+def save_codes(path, codec, codes):
+    np.savez(path, codec=codec.name(), codes=codes, **codec.state())
+
+def load_codes(path):
+    """
+    Load a codec and codes saved by save_codes
+    """
+
+    data = np.load(path)
+    codec = get_codec(str(data['codec']))
+    if isinstance(codec, Int8Codec):
+        codec.scale = data['scale']
+    elif isinstance(codec, PQCodec):
+        codec.ksub = int(data['ksub'])
+        codec.centroids = data['centroids']
+    return codec, data['codes']
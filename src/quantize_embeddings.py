@@ -0,0 +1,87 @@
+"""
+Compress the embeddings of embedding stores (quantize.py) and report the
+change of mAP / Recall@K against float32, to choose the compression level
+
+Several stores (e.g. core + sensors of evaluate_late_fusion.py) are concatenated
+along the embedding dimension.
+
+python quantize_embeddings.py --store STORE_CORE,STORE_SENSORS --codecs float16,int8,pq32,pq16
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import pickle as pkl
+
+from utils import evaluate
+from embedding_store import EmbeddingStore
+from quantize import get_codec, save_codes
+
+Ks = [1, 2, 4, 8, 16, 32]    # Recall@K of utils.evaluate
+
+def load_stores(roots):
+    """
+    Embeddings of the common sessions of the stores concatenated along the dimension, and the labels
+    """
+
+    stores = [EmbeddingStore(root) for root in roots]
+    sessions = sorted(set.intersection(*[set(s.sessions()) for s in stores]))
+    embeddings = []
+    labels = None
+    for s in stores:
+        emb, meta = s.load(sessions)
+        if labels is not None and not np.array_equal(labels, meta['label']):
+            raise ValueError("Events of {} do not match".format(s.root))
+        embeddings.append(emb)
+        labels = meta['label']
+    return np.concatenate(embeddings, axis=1), labels
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, required=True,
+            help='comma separated embedding store folders (embedding_store.py)')
+    parser.add_argument('--codecs', type=str, default='float16,int8,pq32,pq16',
+            help='comma separated codecs: float16 | int8 | pq<m> | pq<m>x<nbits>')
+    parser.add_argument('--output_dir', type=str, default=None,
+            help='where the codes and the report are saved, default: quantized/ in the (first) store')
+    args = parser.parse_args()
+
+    roots = args.store.split(',')
+    output_dir = args.output_dir if args.output_dir is not None else os.path.join(roots[0], 'quantized')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    embeddings, labels = load_stores(roots)
+    N, dim = embeddings.shape
+    print ("%d events with dim %d" % (N, dim))
+
+    mAP, _, _, _, _, recall = evaluate(embeddings, labels)
+    report = [{'codec': 'float32', 'bytes': 4*dim, 'mAP': mAP, 'recall': recall}]
+
+    for name in args.codecs.split(','):
+        codec = get_codec(name)
+        start_time = time.time()
+        codec.train(embeddings)
+        codes = codec.encode(embeddings)
+        duration = time.time() - start_time
+        save_codes(os.path.join(output_dir, codec.name()+'.npz'), codec, codes)
+
+        start_time = time.time()
+        mAP, _, _, _, _, recall = evaluate(embeddings, labels, dist_func=lambda q: codec.adc_dist(q, codes))
+        report.append({'codec': codec.name(), 'bytes': codec.code_size(dim), 'mAP': mAP, 'recall': recall,
+                       'encode_sec': duration, 'evaluate_sec': time.time() - start_time})
+
+    base = report[0]
+    print ("codec\tbytes\tratio\tmAP\tdelta\t" + "\t".join(["R@%d delta" % k for k in Ks]))
+    for r in report:
+        print ("%s\t%d\t%.1f\t%.4f\t%+.4f\t" % (r['codec'], r['bytes'], float(base['bytes']) / r['bytes'],
+                    r['mAP'], r['mAP'] - base['mAP'])
+                + "\t".join(["%+.4f" % (a - b) for a, b in zip(r['recall'], base['recall'])]))
+
+    pkl.dump(report, open(os.path.join(output_dir, 'report.pkl'), 'wb'))
+    print ("Codes and report saved in {}".format(output_dir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Load test of similarity_service.py: concurrent clients querying random events of the store
+
+python similarity_client.py --store MODEL_DIR/embeddings/model-XXX_resnet_goal_transfer_embedding --num_clients 16
+"""
+
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from urllib.request import Request, urlopen
+
+from embedding_store import EmbeddingStore
+
+def post(url, query):
+    request = Request(url, data=json.dumps(query).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+def run_client(url, queries, latency, errors):
+    for query in queries:
+        start_time = time.time()
+        try:
+            post(url, query)
+            latency.append(time.time() - start_time)
+        except Exception as e:
+            errors.append(str(e))
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, required=True,
+            help='embedding store served by similarity_service.py, queries are random events of it')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8765',
+            help='address of the service')
+    parser.add_argument('--num_clients', type=int, default=8,
+            help='number of concurrent clients')
+    parser.add_argument('--num_requests', type=int, default=1000,
+            help='total number of requests')
+    parser.add_argument('--k', type=int, default=10,
+            help='number of neighbours')
+    parser.add_argument('--seed', type=int, default=12345,
+            help='seed')
+    args = parser.parse_args()
+
+    _, meta = EmbeddingStore(args.store).load()
+    rng = np.random.RandomState(args.seed)
+    rows = rng.choice(meta.shape[0], args.num_requests)
+    queries = [{'session_id': str(meta[i]['session_id']), 'start': int(meta[i]['start']), 'k': args.k} for i in rows]
+
+    latency = []
+    errors = []
+    clients = [threading.Thread(target=run_client, args=(args.url+'/search', queries[c::args.num_clients], latency, errors))
+                for c in range(args.num_clients)]
+    start_time = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    duration = time.time() - start_time
+
+    latency = np.asarray(latency) * 1000
+    print ("%d requests, %d errors, %d clients, %.1f s" % (args.num_requests, len(errors), args.num_clients, duration))
+    if latency.shape[0] > 0:
+        print ("%.1f requests/s, latency p50 = %.1f ms, p99 = %.1f ms" % (
+                latency.shape[0] / duration, np.percentile(latency, 50), np.percentile(latency, 99)))
+    if len(errors) > 0:
+        print ("First error: " + errors[0])
+
+    print ("Server stats:")
+    print (json.dumps(json.loads(urlopen(args.url+'/stats').read().decode('utf-8')), indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Local similarity-search service over the event embeddings of an embedding store
+
+Queries are either an event of the store (session_id + start frame) or the raw
+features of an event ([time_steps, (dims)], e.g. sensors or resnet frames),
+embedded with the frozen encoder of the checkpoint (export_graph.py).
+Concurrent requests are grouped into micro-batches: one encoder run and one
+retrieval (utils.retrieve, same ranking as retrieve_one) per batch.
+
+python similarity_service.py --store MODEL_DIR/embeddings/model-XXX_resnet_goal_transfer_embedding --model_path MODEL_DIR/model-XXX
+
+POST /search    {"session_id": "201704151140", "start": 120, "k": 10}
+                {"features": [[...], ...], "k": 10}
+GET /stats    request / batch counters and latency percentiles
+"""
+
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from queue import Queue, Empty
+from collections import deque
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from utils import retrieve
+from embedding_store import EmbeddingStore
+from frozen_graph import FrozenEncoder
+
+FPS = 3    # frame rate of the features, see preprocess/parse_annotation.py
+
+class MicroBatcher(object):
+    """
+    Groups requests submitted from many threads into batches for one worker thread
+    """
+
+    def name(self):
+        return "MicroBatcher"
+
+    def __init__(self, batch_func, max_batch=32, max_wait=0.005):
+        """
+        batch_func -- function mapping a list of requests to a list of results
+        max_batch -- maximum number of requests per batch
+        max_wait -- seconds to wait for more requests after the first one of a batch
+        """
+
+        self.batch_func = batch_func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = Queue()
+
+        self.worker = threading.Thread(target=self._loop)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, request):
+        """
+        Process one request in the next batch, blocks until the result is ready
+        """
+
+        item = {'request': request, 'done': threading.Event(), 'result': None, 'error': None}
+        self.requests.put(item)
+        item['done'].wait()
+        if item['error'] is not None:
+            raise item['error']
+        return item['result']
+
+    def _loop(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except Empty:
+                    break
+
+            try:
+                results = self.batch_func([item['request'] for item in batch])
+                for item, result in zip(batch, results):
+                    item['result'] = result
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0]['error'] = e
+                else:
+                    # one bad request must not fail the others, run them one by one
+                    for item in batch:
+                        try:
+                            item['result'], = self.batch_func([item['request']])
+                        except Exception as item_error:
+                            item['error'] = item_error
+            for item in batch:
+                item['done'].set()
+
+class SimilarityService(object):
+    """
+    Top-K neighbours of events in the store, with counters
+    """
+
+    def name(self):
+        return "SimilarityService"
+
+    def __init__(self, store, encoder=None, max_batch=32, max_wait=0.005, max_k=100, window=10000):
+        """
+        store -- EmbeddingStore, all its sessions are searched
+        encoder -- FrozenEncoder for raw feature queries, only event queries are supported if None
+        window -- number of recent requests / batches kept for the latency percentiles
+        """
+
+        self.database, self.meta = store.load()
+        self.encoder = encoder
+        self.max_k = max_k
+        # (session_id, start) -> row
+        self.rows = {(str(m['session_id']), int(m['start'])): i for i, m in enumerate(self.meta)}
+
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {'requests': 0, 'errors': 0, 'batches': 0, 'encoded': 0}
+        self.request_latency = deque(maxlen=window)
+        self.batch_latency = deque(maxlen=window)
+        self.batch_size = deque(maxlen=window)
+
+        self.batcher = MicroBatcher(self.search_batch, max_batch, max_wait)
+
+    def parse(self, query):
+        """
+        Validate a query, return (row in the store or None, raw features or None, k)
+        """
+
+        k = int(query.get('k', 10))
+        if k < 1 or k > self.max_k:
+            raise ValueError("k must be in [1, {}]".format(self.max_k))
+
+        if 'features' in query:
+            if self.encoder is None:
+                raise ValueError("No encoder loaded, query by session_id and start")
+            features = np.asarray(query['features'], dtype='float32')
+            self.encoder.check_input(features)
+            return None, features, k
+
+        key = (str(query['session_id']), int(query['start']))
+        if key not in self.rows:
+            raise KeyError("Unknown event: {} {}".format(*key))
+        return self.rows[key], None, k
+
+    def search_batch(self, requests):
+        """
+        requests -- list of parsed queries, see parse
+        return list of (dist, rows) per request, excluding the query event itself
+        """
+
+        start_time = time.time()
+        queries = np.zeros((len(requests), self.database.shape[1]), dtype='float32')
+        raw = [i for i, r in enumerate(requests) if r[0] is None]
+        for i, r in enumerate(requests):
+            if r[0] is not None:
+                queries[i] = self.database[r[0]]
+        if len(raw) > 0:
+            events = np.concatenate([self.encoder.prepare_input_test(requests[i][1]) for i in raw], axis=0)
+            queries[raw] = self.encoder.run(events)
+
+        # one more neighbour, the query event itself is dropped
+        K = max([r[2] for r in requests]) + 1
+        dist, idx, _ = retrieve(queries, self.database, K)
+
+        results = []
+        for i, r in enumerate(requests):
+            keep = idx[i] != r[0]
+            results.append((dist[i][keep][:r[2]], idx[i][keep][:r[2]]))
+
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['encoded'] += len(raw)
+            self.batch_size.append(len(requests))
+            self.batch_latency.append(time.time() - start_time)
+        return results
+
+    def search(self, query):
+        """
+        Top-k neighbours of one query (dictionary, see module docstring)
+        """
+
+        start_time = time.time()
+        try:
+            dist, rows = self.batcher.submit(self.parse(query))
+        except Exception:
+            with self.lock:
+                self.counters['errors'] += 1
+            raise
+
+        neighbours = []
+        for d, row in zip(dist, rows):
+            m = self.meta[row]
+            neighbours.append({'session_id': str(m['session_id']),
+                               'start': int(m['start']),
+                               'end': int(m['end']),
+                               'start_sec': int(m['start']) / float(FPS),
+                               'end_sec': int(m['end']) / float(FPS),
+                               'label': int(m['label']),
+                               'distance': float(d)})
+
+        latency = time.time() - start_time
+        with self.lock:
+            self.counters['requests'] += 1
+            self.request_latency.append(latency)
+        return {'neighbours': neighbours, 'latency_ms': latency * 1000}
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            request_latency = np.asarray(self.request_latency) * 1000
+            batch_latency = np.asarray(self.batch_latency) * 1000
+            batch_size = np.asarray(self.batch_size)
+
+        uptime = time.time() - self.start_time
+        stats['uptime_sec'] = uptime
+        stats['requests_per_sec'] = stats['requests'] / uptime
+        stats['database_size'] = int(self.database.shape[0])
+        for name, values in [('request_latency_ms', request_latency), ('batch_latency_ms', batch_latency)]:
+            if values.shape[0] > 0:
+                stats[name] = {'p50': float(np.percentile(values, 50)),
+                               'p99': float(np.percentile(values, 99)),
+                               'mean': float(np.mean(values))}
+        if batch_size.shape[0] > 0:
+            stats['mean_batch_size'] = float(np.mean(batch_size))
+        return stats
+
+class SimilarityHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.service.stats())
+        else:
+            self._reply(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/search':
+            self._reply(404, {'error': 'Unknown path: ' + self.path})
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            self._reply(200, self.server.service.search(query))
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass    # no line per request
+
+class SimilarityServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, SimilarityHandler)
+        self.service = service
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type=str, required=True,
+            help='embedding store folder (embedding_store.py), e.g. written by embed.py')
+    parser.add_argument('--model_path', type=str, default=None,
+            help='checkpoint with a frozen graph (export_graph.py), needed for raw feature queries')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+            help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+            help='port to listen on')
+    parser.add_argument('--max_batch', type=int, default=32,
+            help='maximum number of requests per micro-batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+            help='time to wait for more requests after the first one of a micro-batch')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    encoder = None
+    if args.model_path is not None:
+        encoder = FrozenEncoder(args.model_path, gpu='')    # CPU only
+    service = SimilarityService(EmbeddingStore(args.store), encoder, args.max_batch, args.max_wait_ms / 1000.)
+    print ("Loaded %d events with dim %d (%.1f s)" % (service.database.shape[0], service.database.shape[1], time.time()-start_time))
+
+    server = SimilarityServer((args.host, args.port), service)
+    print ("Listening on http://%s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -16,23 +16,18 @@ sys.path.append('../')
 from configs.eval_config import EvalConfig
 import networks
 from utils import evaluate
-from data_io import load_data_and_label, prepare_dataset
+from data_io import prepare_dataset
+import embedding_store
 from preprocess.honda_labels import honda_labels2num, honda_num2labels
 
 
-def main():
-
-    cfg = EvalConfig().parse()
-    print ("Evaluate the model: {}".format(os.path.basename(cfg.model_path)))
-    np.random.seed(seed=cfg.seed)
-
-    all_session = cfg.train_session
-    all_set = prepare_dataset(cfg.feature_root, all_session, cfg.feat, cfg.label_root)
+def embed(cfg, dataset, store):
+    """
+    Embed the sessions of dataset that are not in the store
+    """
 
     n_input = cfg.feat_dim[cfg.feat]
 
-    ########################### Extract features ###########################
-
     # load backbone model
     model = networks.Seq2seqTSN(n_seg=cfg.num_seg, n_input=n_input, emb_dim=cfg.emb_dim, reverse=cfg.reverse)
 
@@ -59,26 +54,40 @@ def main():
         # load the model (note that model_path already contains snapshot number
         saver.restore(sess, cfg.model_path)
 
-        eve_embeddings = []
-        sessions = []
-        eids_all = []
-        for i, session in enumerate(all_set):
-            session_id = os.path.basename(session[1]).split('_')[0]
-            print ("{0} / {1}: {2}".format(i, len(all_set), session_id))
+        embedding_store.embed_sessions([store],
+                lambda eve_batch: [sess.run(embedding, feed_dict={input_ph: eve_batch, dropout_ph: 1.0})],
+                dataset, model.prepare_input_test, batch_size=cfg.batch_size, dtype=cfg.emb_dtype,
+                recompute=cfg.recompute_embedding)
+    sess.close()
+
+def load_embeddings(store, sessions):
+    """
+    Embeddings of the sessions, with session id and (start, end) of each event for tracking data sources
+    """
+
+    eve_embeddings, meta = store.load(sessions)
+    return eve_embeddings, meta['session_id'].tolist(), list(zip(meta['start'].tolist(), meta['end'].tolist()))
+
+def main():
+
+    cfg = EvalConfig().parse()
+    print ("Evaluate the model: {}".format(os.path.basename(cfg.model_path)))
+    np.random.seed(seed=cfg.seed)
 
-            eve_batch, _, boundary = load_data_and_label(session[0], session[1], model.prepare_input_test)
-            for start, end in zip(range(0, eve_batch.shape[0], cfg.batch_size),
-                                range(cfg.batch_size, eve_batch.shape[0]+cfg.batch_size, cfg.batch_size)):
-                end = min(end, eve_batch.shape[0])
-                emb = sess.run(embedding, feed_dict={input_ph: eve_batch[start:end],
-                                                     dropout_ph: 1.0})
-                eve_embeddings.append(emb)
+    all_session = cfg.train_session
+    all_set = prepare_dataset(cfg.feature_root, all_session, cfg.feat, cfg.label_root)
+    val_session = cfg.val_session
+    val_set = prepare_dataset(cfg.feature_root, val_session, cfg.feat, cfg.label_root)
 
-            # for tracking data sources
-            sessions.extend([session_id]*eve_batch.shape[0])
-            eids_all.extend(boundary)
+    ########################### Extract features ###########################
 
-        eve_embeddings = np.concatenate(eve_embeddings, axis=0)
+    # embeddings are computed once per checkpoint and read from the embedding store
+    config = embedding_store.model_config(cfg, ['num_seg', 'emb_dim', 'reverse', 'normalized', 'emb_dtype'])
+    store = embedding_store.open_store(cfg.model_path, cfg.feat, name='embedding' if cfg.normalized else 'hidden',
+                                       config=config)
+    if cfg.recompute_embedding or len(store.missing(all_set+val_set)) > 0:
+        embed(cfg, all_set+val_set, store)
+    eve_embeddings, sessions, eids_all = load_embeddings(store, all_session)
 
     print ("Feature extraction done!")
 
@@ -134,35 +143,7 @@ def main():
 
     ############################ Feature for validation #################################
 
-    val_session = cfg.val_session
-    val_set = prepare_dataset(cfg.feature_root, val_session, cfg.feat, cfg.label_root)
-
-    with sess.as_default():
-        sess.run(tf.global_variables_initializer())
-
-        # load the model (note that model_path already contains snapshot number
-        saver.restore(sess, cfg.model_path)
-
-        eve_embeddings = []
-        sessions = []
-        eids_all = []
-        for i, session in enumerate(val_set):
-            session_id = os.path.basename(session[1]).split('_')[0]
-            print ("{0} / {1}: {2}".format(i, len(all_set), session_id))
-
-            eve_batch, _, boundary = load_data_and_label(session[0], session[1], model.prepare_input_test)
-            for start, end in zip(range(0, eve_batch.shape[0], cfg.batch_size),
-                                range(cfg.batch_size, eve_batch.shape[0]+cfg.batch_size, cfg.batch_size)):
-                end = min(end, eve_batch.shape[0])
-                emb = sess.run(embedding, feed_dict={input_ph: eve_batch[start:end],
-                                                     dropout_ph: 1.0})
-                eve_embeddings.append(emb)
-
-            # for tracking data sources
-            sessions.extend([session_id]*eve_batch.shape[0])
-            eids_all.extend(boundary)
-
-        eve_embeddings = np.concatenate(eve_embeddings, axis=0)
+    eve_embeddings, sessions, eids_all = load_embeddings(store, val_session)
 
     cluster_idx = kmeans.predict(eve_embeddings)
     cluster_dist = kmeans.transform(eve_embeddings)
@@ -7,6 +7,8 @@ import pdb
 import os
 from six import iteritems
 
+from distance import pairwise_dist, MAX_MEMORY
+
 def optimize(loss, global_step, optimizer, learning_rate, update_gradient_vars, log_histograms=True):
 
     if optimizer == 'ADAGRAD':
@@ -52,7 +54,34 @@ def optimize(loss, global_step, optimizer, learning_rate, update_gradient_vars,
 
     return apply_gradient_op
 
-def retrieve_one(query, database, query_label=None, labels=None, normalize=False):
+def top_k(dist, K=None):
+    """
+    Indices of the K smallest distances in ascending order (ties by index)
+
+    dist -- [N,] or [Q, N]
+    K -- number of neighbours, full ranking if None
+    Uses argpartition, O(N + K log K) per row instead of O(N log N)
+    """
+
+    N = dist.shape[-1]
+    if K is None or K >= N:
+        return np.argsort(dist, axis=-1, kind='stable')
+
+    part = np.argpartition(dist, K-1, axis=-1)[..., :K]
+    part_dist = np.take_along_axis(dist, part, axis=-1)
+    order = np.lexsort((part, part_dist), axis=-1)
+    idx = np.take_along_axis(part, order, axis=-1)
+
+    # argpartition picks arbitrary elements among ties with the K-th distance,
+    # rank those (rare) rows fully so that ties are always broken by index
+    tied = np.sum(dist <= np.max(part_dist, axis=-1, keepdims=True), axis=-1) > K
+    if np.any(tied):
+        if dist.ndim == 1:
+            return np.argsort(dist, kind='stable')[:K]
+        idx[tied] = np.argsort(dist[tied], axis=-1, kind='stable')[:, :K]
+    return idx
+
+def retrieve_one(query, database, query_label=None, labels=None, normalize=False, K=None):
     """
     Retrieve from the database using given query
     Return AP if label is not None
@@ -62,16 +91,17 @@ def retrieve_one(query, database, query_label=None, labels=None, normalize=False
     query_label -- int32
     label -- int32, [N,]
     normalize -- bool, if true, normalize to unit vector
+    K -- int, only return the indices of the K nearest neighbours (all if None)
     """
 
     N, dim = database.shape
     if normalize:
-        query /= np.linalg.norm(output)
+        query /= np.linalg.norm(query)
         database /= np.linalg.norm(database, axis=1).reshape(-1,1)
 
     # Euclidean distance
     dist = np.linalg.norm(query.reshape(1,-1) - database, axis=1)
-    idx = np.argsort(dist)
+    idx = top_k(dist, K)
 
     ap = None
     if labels is not None:
@@ -80,19 +110,86 @@ def retrieve_one(query, database, query_label=None, labels=None, normalize=False
 
     return dist, idx, ap
 
-def evaluate_simple(embeddings, labels, normalize=False, standardize=False, alpha=0.5):
+def retrieve(queries, database, K=None, query_labels=None, labels=None, block_size=128, dist_func=None):
+    """
+    Retrieve from the database for a batch of queries
+
+    queries -- float32, [Q, emb_dim]
+    database -- float32, [N, emb_dim]
+    K -- int, number of neighbours returned (all if None)
+    query_labels -- int32, [Q,]
+    labels -- int32, [N,], AP of each query is returned if given
+    block_size -- number of queries processed together
+    dist_func -- function mapping a block of queries to their euclidean distances to the database, [B, N],
+                 e.g. asymmetric distances to quantized codes (quantize.py), then database is only used for its shape
+
+    Return (dist [Q, K], idx [Q, K], ap [Q,] or None), sorted by ascending euclidean distance
+    Only AP needs the distances to the whole database, the neighbours use partial sorting
+    """
+
+    queries = queries.reshape(-1, database.shape[1])
+    Q = queries.shape[0]
+    N = database.shape[0]
+    K = N if K is None else min(K, N)
+
+    dist = np.zeros((Q, K), dtype=np.result_type(queries.dtype, database.dtype, np.float32))
+    idx = np.zeros((Q, K), dtype='int64')
+    ap = None if labels is None else np.zeros((Q,), dtype='float64')
+    for start in range(0, Q, block_size):
+        end = min(start+block_size, Q)
+        if dist_func is None:
+            block_dist = pairwise_dist(queries[start:end], database, metric='euclidean')
+        else:
+            block_dist = dist_func(queries[start:end])
+        idx[start:end] = top_k(block_dist, K)
+        dist[start:end] = np.take_along_axis(block_dist, idx[start:end], axis=1)
+
+        if labels is not None:
+            for i in range(end-start):
+                ap[start+i] = average_precision_score(np.squeeze(labels==query_labels[start+i]),
+                        np.max(block_dist[i]) - block_dist[i])    # convert distance to score
+
+    return dist, idx, ap
+
+def evaluate_simple(embeddings, labels, normalize=False, standardize=False, alpha=0.5, block_size=128):
     """
     A simple version with only mean output
 
     Evaluate a given dataset with embeddings and labels
-    Loop for each element as query and the rest as database
+    Each foreground element is used as query and the rest as database
+    Calculate the mean AP, mean Precision@recall and Recall@1
+
+    embeddings -- float32, [N, emb_dim]
+    labels -- int32, [N, ]
+    normalize -- bool, whether to normalize feature to unit vector
+    standardize -- bool, whether to standardize each dimension to be zero mean and unit variance
+    alpha -- float, used for precision @ recall alpha
+    block_size -- int, number of queries evaluated together
+    """
+
+    mAP, _, mPrec, _, _, recall = evaluate(embeddings, labels, normalize, standardize, alpha, block_size)
+
+    return mAP, mPrec, recall[0]
+
+def evaluate(embeddings, labels, normalize=False, standardize=False, alpha=0.5, block_size=128, dist_func=None):
+    """
+    Evaluate a given dataset with embeddings and labels
+    Each foreground element is used as query and the rest as database
     Calculate the mean AP and mean Precision@recall
 
+    Queries are processed in blocks: the distances of a block to the whole
+    dataset are computed with one matrix product, the query itself is masked
+    out instead of deleted, and all metrics are computed with array ops.
+    Results are the same as evaluate_loop (up to the ordering of tied distances).
+
     embeddings -- float32, [N, emb_dim]
     labels -- int32, [N, ]
     normalize -- bool, whether to normalize feature to unit vector
     standardize -- bool, whether to standardize each dimension to be zero mean and unit variance
     alpha -- float, used for precision @ recall alpha
+    block_size -- int, number of queries evaluated together, memory is about 80 * block_size * N bytes
+    dist_func -- function mapping query embeddings [B, emb_dim] to their euclidean distances to the whole dataset [B, N],
+                 e.g. asymmetric distances to quantized codes of the dataset (quantize.py), exact if None
     """
 
     N, dim = embeddings.shape
@@ -105,40 +202,104 @@ def evaluate_simple(embeddings, labels, normalize=False, standardize=False, alph
 
     labels = np.squeeze(labels)
     unique_labels = sorted(set(labels.tolist()))
+    label_idx = np.searchsorted(unique_labels, labels)    # column in confusion matrix
+    num_class = len(unique_labels)
+
+    Ks = np.array([1, 2, 4, 8, 16, 32])
+    K_idx = np.minimum(Ks, N-1) - 1    # label_list[:K] is truncated for small database
+
+    emb = embeddings.astype('float64')
+    ranks = np.arange(N-1)
 
     aps = []
     lab = []
     precs = []
-    num_correct = []
-    for i in range(N):
-        if labels[i] > 0:    # only for foreground events
-            _, sorted_idx, ap = retrieve_one(embeddings[i], np.delete(embeddings,i,0),
-                                             labels[i], np.delete(labels,i))
+    confusion_matrix = np.zeros((num_class, num_class), dtype='float32')
+    count = np.zeros((num_class, 1), dtype='int32')
+    num_correct = np.zeros(Ks.shape[0], dtype='int64')
+
+    query_idx = np.where(labels > 0)[0]    # only for foreground events
+    for start in range(0, query_idx.shape[0], block_size):
+        q_idx = query_idx[start : start+block_size]
+        B = q_idx.shape[0]
+        rows = np.arange(B)
+
+        # Euclidean distance, the query itself is pushed to the end of the ranking
+        if dist_func is None:
+            dist = pairwise_dist(emb[q_idx], emb, metric='euclidean')
+        else:
+            dist = dist_func(embeddings[q_idx])
+        dist[rows, q_idx] = np.inf
+
+        sorted_idx = np.argsort(dist, axis=1, kind='stable')[:, :N-1]
+        sorted_dist = np.take_along_axis(dist, sorted_idx, axis=1)
+        hits = labels[sorted_idx] == labels[q_idx].reshape(-1,1)
+        cum_hits = np.cumsum(hits, axis=1)
+        num_pos = cum_hits[:, -1]
+
+        # AP, tied distances share the precision at the end of the tie (as sklearn)
+        is_last = np.ones(sorted_dist.shape, dtype=bool)
+        is_last[:, :-1] = sorted_dist[:, 1:] != sorted_dist[:, :-1]
+        tie_end = np.where(is_last, ranks, N-2)
+        tie_end = np.minimum.accumulate(tie_end[:, ::-1], axis=1)[:, ::-1]
+        prec_at_end = np.take_along_axis(cum_hits, tie_end, axis=1) / (tie_end + 1.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ap = np.sum(hits * prec_at_end, axis=1) / num_pos
+
+        # precision @ recall alpha, stop at the first rank reaching the recall
+        num_recall_alpha = (alpha * num_pos).astype('int64')
+        reached = cum_hits == num_recall_alpha.reshape(-1,1)
+        stop = np.where(np.any(reached, axis=1), np.argmax(reached, axis=1), N-2)
+        prec = cum_hits[rows, stop] / (stop + 1.)
+
+        # precisions for all classes (class histogram of the retrieved list)
+        within = ranks.reshape(1,-1) <= stop.reshape(-1,1)
+        flat = (rows.reshape(-1,1) * num_class + label_idx[sorted_idx])[within]
+        conf = np.bincount(flat, minlength=B*num_class).reshape(B, num_class) / (stop.reshape(-1,1) + 1.)
+
+        valid = num_pos > 0
+        for i in q_idx[~valid]:
+            print ("WARNING: encountered an AP of NaN!")
+            print ("This may occur when the event only appears once.")
+            print ("The event label here is {}.".format(labels[i]))
+            print ("Ignore this event and carry on.")
+
+        aps.extend(ap[valid].tolist())
+        lab.extend(labels[q_idx[valid]].astype('int64').tolist())
+        precs.extend(prec[valid].tolist())
+        np.add.at(confusion_matrix, label_idx[q_idx[valid]], conf[valid])
+        np.add.at(count[:, 0], label_idx[q_idx[valid]], 1)
+
+        # compute recall @ K
+        num_correct += np.sum(cum_hits[valid][:, K_idx] > 0, axis=0)
 
-            if np.isnan(ap):
-                print ("WARNING: encountered an AP of NaN!")
-                print ("This may occur when the event only appears once.")
-                print ("The event label here is {}.".format(labels[i]))
-                print ("Ignore this event and carry on.")
-            else:
-                aps.append(ap)
-                lab.append(int(labels[i]))
+    mAP = np.mean(aps)
+    mPrec = np.mean(precs)
 
-                # compute precision @ recall alpha (precisions are for all classes)
-                prec, _ = precision_at_recall(labels[sorted_idx], labels[i], alpha)
-                precs.append(prec)
+    # get mAP for each event
+    mAP_event = {}
+    for ap, l in zip(aps, lab):
+        if l not in mAP_event:
+            mAP_event[l] = [ap]
+        else:
+            mAP_event[l].append(ap)
+    for key in mAP_event:
+        mAP_event[key] = np.mean(mAP_event[key])
+
+    # get confusion matrix
+    confusion_matrix[1:] /= count[1:]
+    count[0] = (labels==0).sum()    # number of background
+    confusion = {"confusion_matrix": confusion_matrix, "labels": unique_labels}
 
-                # compute recall @ 1
-                num_correct.append(recall_at_K(labels[sorted_idx], labels[i], 1))
+    # get recall @ K
+    recall = [float(num) / len(lab) for num in num_correct]
 
-    mAP = np.mean(aps)
-    mPrec = np.mean(precs)
-    recall = np.mean(num_correct)
+    return mAP, mAP_event, mPrec, confusion, count, recall
 
-    return mAP, mPrec, recall
-    
-def evaluate(embeddings, labels, normalize=False, standardize=False, alpha=0.5):
+def evaluate_loop(embeddings, labels, normalize=False, standardize=False, alpha=0.5, shift_labels=False):
     """
+    Reference implementation of evaluate (slow, kept for checking and benchmarking)
+
     Evaluate a given dataset with embeddings and labels
     Loop for each element as query and the rest as database
     Calculate the mean AP and mean Precision@recall
@@ -148,6 +309,9 @@ def evaluate(embeddings, labels, normalize=False, standardize=False, alpha=0.5):
     normalize -- bool, whether to normalize feature to unit vector
     standardize -- bool, whether to standardize each dimension to be zero mean and unit variance
     alpha -- float, used for precision @ recall alpha
+    shift_labels -- bool, index the full label array with the ranking of the database without the query
+                    (labels after the query shifted by one) for mPrec, Recall@K and the confusion matrix,
+                    as before the fix, to compare with previously reported results
     """
 
     N, dim = embeddings.shape
@@ -169,8 +333,9 @@ def evaluate(embeddings, labels, normalize=False, standardize=False, alpha=0.5):
     num_correct = [0,0,0,0,0,0]
     for i in range(N):
         if labels[i] > 0:    # only for foreground events
+            db_labels = np.delete(labels,i)
             _, sorted_idx, ap = retrieve_one(embeddings[i], np.delete(embeddings,i,0),
-                                             labels[i], np.delete(labels,i))
+                                             labels[i], db_labels)
 
             if np.isnan(ap):
                 print ("WARNING: encountered an AP of NaN!")
@@ -181,20 +346,23 @@ def evaluate(embeddings, labels, normalize=False, standardize=False, alpha=0.5):
                 aps.append(ap)
                 lab.append(int(labels[i]))
 
+                # sorted_idx indexes the database without the query
+                sorted_labels = labels[sorted_idx] if shift_labels else db_labels[sorted_idx]
+
                 # compute precision @ recall alpha (precisions are for all classes)
-                prec, conf = precision_at_recall(labels[sorted_idx], labels[i], alpha)
+                prec, conf = precision_at_recall(sorted_labels, labels[i], alpha)
                 precs.append(prec)
                 confs.append(conf)
 
                 # compute recall @ K
-                num_correct[0] += recall_at_K(labels[sorted_idx], labels[i], 1)
-#                num_correct[1] += recall_at_K(labels[sorted_idx], labels[i], 10)
-#                num_correct[2] += recall_at_K(labels[sorted_idx], labels[i], 100)
-                num_correct[1] += recall_at_K(labels[sorted_idx], labels[i], 2)
-                num_correct[2] += recall_at_K(labels[sorted_idx], labels[i], 4)
-                num_correct[3] += recall_at_K(labels[sorted_idx], labels[i], 8)
-                num_correct[4] += recall_at_K(labels[sorted_idx], labels[i], 16)
-                num_correct[5] += recall_at_K(labels[sorted_idx], labels[i], 32)
+                num_correct[0] += recall_at_K(sorted_labels, labels[i], 1)
+#                num_correct[1] += recall_at_K(sorted_labels, labels[i], 10)
+#                num_correct[2] += recall_at_K(sorted_labels, labels[i], 100)
+                num_correct[1] += recall_at_K(sorted_labels, labels[i], 2)
+                num_correct[2] += recall_at_K(sorted_labels, labels[i], 4)
+                num_correct[3] += recall_at_K(sorted_labels, labels[i], 8)
+                num_correct[4] += recall_at_K(sorted_labels, labels[i], 16)
+                num_correct[5] += recall_at_K(sorted_labels, labels[i], 32)
 
     mAP = np.mean(aps)
     mPrec = np.mean(precs)
@@ -313,6 +481,7 @@ def all_diffs_tf(a, b):
 def all_diffs(a, b):
     """
     Return a tensor of all combinations of a - b
+    Note: allocates [batch_size1, batch_size2, dim], use pairwise_dist for distances
 
     a -- [batch_size1, dim]
     b -- [batch_size2, dim]
@@ -359,6 +528,49 @@ def cdist_tf(diff, metric='squaredeuclidean'):
     else:
         raise NotImplementedError
 
+def pairwise_dist_tf(a, b=None, metric='squaredeuclidean'):
+    """
+    Return the distance between all pairs of rows in a and b according to metric,
+    same values as cdist_tf(all_diffs_tf(a, b), metric) without the [batch_size1, batch_size2, dim] tensor
+
+    a -- [batch_size1, dim]
+    b -- [batch_size2, dim], use a if None
+    metric  --   "squaredeuclidean": squared euclidean
+                 "euclidean": euclidean (without squared)
+                 "l1": manhattan distance (no matmul form, falls back to all_diffs_tf)
+    """
+
+    if b is None:
+        b = a
+
+    if metric == "squaredeuclidean" or metric == "euclidean":
+        # ||a-b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+        sq_dist = tf.reduce_sum(tf.square(a), axis=1, keepdims=True) + \
+                  tf.expand_dims(tf.reduce_sum(tf.square(b), axis=1), 0) - \
+                  2 * tf.matmul(a, b, transpose_b=True)
+        # clamp rounding errors, negative values get zero gradient
+        sq_dist = tf.maximum(sq_dist, 0.)
+        if metric == "squaredeuclidean":
+            return sq_dist
+        # epsilon keeps the gradient of sqrt finite at zero distance
+        return tf.sqrt(sq_dist + 1e-12)
+    elif metric == "l1":
+        return cdist_tf(all_diffs_tf(a, b), metric)
+    else:
+        raise NotImplementedError
+
+def dist_summary_tf(embedding, metric='squaredeuclidean', name='embedding_dists'):
+    """
+    Histogram summary of all-pair embedding distances for monitoring
+
+    Not added to tf.summary.merge_all, so the distances are only computed
+    when the returned op is fetched (e.g. every summary_steps steps)
+
+    embedding -- [batch_size, dim]
+    """
+
+    return tf.summary.histogram(name, pairwise_dist_tf(embedding, metric=metric), collections=[])
+
 def rnn_prepare_input(max_time, feat):
     """
     feat -- feature sequence, [time_steps, n_h, n_w, n_input]
@@ -427,12 +639,114 @@ def write_configure_to_file(cfg, result_dir):
             fout.write('%s: %s\n' % (key, str(value)))
 
 
-def select_triplets_facenet(lab, all_dist, triplet_per_batch, alpha=0.2, num_negative=3):
+def select_triplets_facenet(lab, all_dist, triplet_per_batch, alpha=0.2, num_negative=3, rng=None):
     """
     Select the triplets for training
     1. Sample anchor-positive pair (try to balance imbalanced classes)
     2. Semi-hard negative mining used in facenet
 
+    Same selection as select_triplets_facenet_loop: anchor-positive pairs are
+    visited round-robin over classes, but the semi-hard negative masks are
+    computed for many pairs at once. With the same random state both return
+    the same triplets.
+
+    Arguments:
+    lab -- array of labels, [N,]
+    all_dist -- distance matrix
+    triplet_per_batch -- int
+    alpha -- float, margin
+    num_negative -- number of negative samples per anchor-positive pairs
+    rng -- np.random.RandomState for reproducible selection, use global random states if None
+    """
+
+    lab = np.asarray(lab).reshape(-1)
+    shuffle = random.shuffle if rng is None else rng.shuffle
+    randint = np.random.randint if rng is None else rng.randint
+
+    idx_dict = {}
+    for i, l in enumerate(lab):
+        l = int(l)
+        if l not in idx_dict:
+            idx_dict[l] = [i]
+        else:
+            idx_dict[l].append(i)
+    for key in idx_dict:
+        shuffle(idx_dict[key])
+
+    # anchor-positive pairs are enumerated in the order of itertools.permutations
+    foreground_keys = [key for key in idx_dict.keys() if not key == 0]
+    if len(foreground_keys) == 0:
+        return [], 0.
+    members = np.concatenate([idx_dict[key] for key in foreground_keys]).astype('int64')
+    class_size = np.asarray([len(idx_dict[key]) for key in foreground_keys], dtype='int64')
+    class_offset = np.cumsum(class_size) - class_size
+    num_pairs = class_size * (class_size - 1)
+    num_class = len(foreground_keys)
+
+    triplet_input_idx = []
+    all_neg_count = []    # for monitoring active count
+    # the masks of a chunk are [num_pairs_in_chunk, N], bound the rounds per chunk by MAX_MEMORY
+    bytes_per_pair = lab.shape[0] * (4 * all_dist.itemsize + 8 * num_negative)
+    max_rounds = max(1, MAX_MEMORY // (bytes_per_pair * num_class))
+    round_start = 0
+    num_rounds = min(triplet_per_batch // num_class + 1, max_rounds)
+    while round_start < np.max(num_pairs):
+        # pairs of the next rounds, ordered by (round, class)
+        t = np.repeat(np.arange(round_start, round_start+num_rounds), num_class)
+        k = np.tile(np.arange(num_class), num_rounds)
+        valid = t < num_pairs[k]
+        t, k = t[valid], k[valid]
+        round_start += num_rounds
+        num_rounds = min(num_rounds * 2, max_rounds)
+
+        an_pos = t // (class_size[k] - 1)
+        pos_pos = t % (class_size[k] - 1)
+        pos_pos += pos_pos >= an_pos
+        an_idx = members[class_offset[k] + an_pos]
+        pos_idx = members[class_offset[k] + pos_pos]
+
+        # semi-hard negatives of all pairs
+        pos_dist = all_dist[an_idx, pos_idx].reshape(-1,1)
+        neg_dist = all_dist[an_idx]
+        is_neg = np.logical_and(neg_dist-pos_dist < alpha, pos_dist < neg_dist)
+        is_neg &= lab.reshape(1,-1) != lab[an_idx].reshape(-1,1)
+        neg_count = np.sum(is_neg, axis=1)
+        num_sample = np.minimum(neg_count, num_negative)
+
+        # stop at the pair that reaches triplet_per_batch
+        remaining = triplet_per_batch - len(triplet_input_idx) // 3
+        cum_sample = np.cumsum(num_sample)
+        done = cum_sample.shape[0] > 0 and cum_sample[-1] >= remaining
+        if done:
+            last = np.argmax(cum_sample >= remaining)
+            num_sample = num_sample[:last+1]
+            num_sample[last] -= cum_sample[last] - remaining
+        all_neg_count.extend(neg_count[:num_sample.shape[0]].tolist())
+
+        # randomly pick the negatives, the u-th negative of the row
+        draw = np.repeat(np.arange(num_sample.shape[0]), num_sample)
+        if draw.shape[0] > 0:
+            u = randint(neg_count[draw])
+            neg_idx = np.argmax(np.cumsum(is_neg[draw], axis=1) > u.reshape(-1,1), axis=1)
+            triplets = np.stack([an_idx[draw], pos_idx[draw], neg_idx], axis=1)
+            triplet_input_idx.extend(triplets.reshape(-1).tolist())
+
+        if done:
+            break
+
+    if len(triplet_input_idx) > 0:
+        return triplet_input_idx, np.mean(all_neg_count)
+    else:
+        return [], 0.
+
+def select_triplets_facenet_loop(lab, all_dist, triplet_per_batch, alpha=0.2, num_negative=3):
+    """
+    Reference implementation of select_triplets_facenet (slow, kept for checking)
+
+    Select the triplets for training
+    1. Sample anchor-positive pair (try to balance imbalanced classes)
+    2. Semi-hard negative mining used in facenet
+
     Arguments:
     lab -- array of labels, [N,]
     all_dist -- distance matrix
@@ -474,7 +788,7 @@ def select_triplets_facenet(lab, all_dist, triplet_per_batch, alpha=0.2, num_neg
             
             pos_dist = all_dist[an_idx, pos_idx]
             neg_dist = np.copy(all_dist[an_idx])    # important to make a copy, otherwise is reference
-            neg_dist[idx_dict[key]] = np.NaN
+            neg_dist[idx_dict[key]] = np.nan
 
             all_neg = np.where(np.logical_and(neg_dist-pos_dist < alpha,
                                             pos_dist < neg_dist))[0]